@@ -2,62 +2,483 @@ import sys
 import cv2
 import numpy as np
 import os
+import json
+import functools
 import multiprocessing
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+import dtm_parse
+import pyramid
+import scheduler
 from stltools import stlgenerator
 
 NO_DATA = -9999
 
-def load_asc(file_name: str):
-    data = np.loadtxt(file_name, skiprows=7)
+# Raster bodies are cached next to the .asc as a .npy file that later runs can memory map
+SIDECAR_SUFFIX = '.npy'
 
-    # A bit of numpy black magic from stack overflow to remove rows/columns at the start without data
-    column_index = np.argwhere(np.all(data[..., :] == NO_DATA, axis=0))
-    data = np.delete(data, column_index, axis=1)
-    row_index = np.argwhere(np.all(data[:, ...] == NO_DATA, axis=1))
-    data = np.delete(data, row_index, axis=0)
+# Level of detail k of foo.asc is cached as foo.asc.lod<k>.npy
+LEVEL_SUFFIX = '.lod{factor}.npy'
+
+# Per-tile elevation stats used to find a common base for every STL
+STATS_INDEX = 'elevation_stats.json'
+
+# Default memory budget for meshing tiles side by side
+DEFAULT_MESH_MEMORY = 4 * 1024 * 1024 * 1024
+
+# How much STL data a tile meshed in a process of its own keeps in flight
+TILE_BAND_MEMORY = 32 * 1024 * 1024
+
+
+@dataclass
+class AscHeader:
+    ncols: int
+    nrows: int
+    xllcorner: float
+    yllcorner: float
+    cellsize: float
+    nodata_value: float = NO_DATA
+
+
+def read_asc_header(f):
+    # Header lines are "key value" pairs, the grid starts at the first line that's a number.
+    fields = {}
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            break
+        parts = line.split()
+        if not parts:
+            continue
+        if not parts[0][:1].isalpha():
+            f.seek(position)
+            break
+        fields[parts[0].decode().lower()] = float(parts[1])
+
+    cellsize = fields['cellsize']
+    # Some tools write the center of the lower left cell instead of its corner
+    xllcorner = fields['xllcorner'] if 'xllcorner' in fields else fields['xllcenter'] - cellsize / 2
+    yllcorner = fields['yllcorner'] if 'yllcorner' in fields else fields['yllcenter'] - cellsize / 2
+    return AscHeader(
+        ncols=int(fields['ncols']),
+        nrows=int(fields['nrows']),
+        xllcorner=xllcorner,
+        yllcorner=yllcorner,
+        cellsize=cellsize,
+        nodata_value=fields.get('nodata_value', NO_DATA),
+    )
+
+
+def _sidecar_is_fresh(file_name: str, sidecar_name: str):
+    return os.path.exists(sidecar_name) and os.path.getmtime(sidecar_name) >= os.path.getmtime(file_name)
+
+
+def _write_atomically(file_name: str, write, mode: str = 'wb'):
+    # Caches are written to a temp file of this process and thread's own, then moved
+    # into place, so jobs caching the same raster at once never share a half written file
+    temp_name = f'{file_name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_name, mode) as f:
+            write(f)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def read_asc(file_name: str, use_cache: bool = True):
+    """
+    Read an ASCII grid as (header, float32 grid) with the file's own nodata value
+    replaced by NO_DATA.  The grid is cached in a .npy sidecar the first time a
+    file is read, and memory mapped from it on every read after that.
+    """
+    with open(file_name, 'rb') as f:
+        header = read_asc_header(f)
+        sidecar_name = file_name + SIDECAR_SUFFIX
+        if use_cache and _sidecar_is_fresh(file_name, sidecar_name):
+            data = np.load(sidecar_name, mmap_mode='r')
+            if data.shape == (header.nrows, header.ncols):
+                return header, data
+        data = np.fromfile(f, dtype=np.float32, sep=' ')
+
+    if data.size != header.nrows * header.ncols:
+        raise ValueError(f'{file_name} has {data.size} values, expected {header.nrows}x{header.ncols}')
+    data = data.reshape(header.nrows, header.ncols)
+    if header.nodata_value != NO_DATA:
+        data[data == np.float32(header.nodata_value)] = NO_DATA
+
+    if use_cache:
+        _write_atomically(sidecar_name, lambda f: np.save(f, data))
+    return header, data
+
+
+def write_asc_header(f, header: AscHeader):
+    f.write(f'ncols {header.ncols}\n')
+    f.write(f'nrows {header.nrows}\n')
+    f.write(f'xllcorner {header.xllcorner}\n')
+    f.write(f'yllcorner {header.yllcorner}\n')
+    f.write(f'cellsize {header.cellsize}\n')
+    f.write(f'NODATA_value {NO_DATA}\n')
+
+
+def write_asc(file_name: str, header: AscHeader, data, sidecar: bool = True):
+    # Also leaves a fresh sidecar behind, so reading the file back is free
+    with open(file_name, 'w') as f:
+        write_asc_header(f, header)
+        np.savetxt(f, data, fmt='%.3f')
+    if sidecar:
+        np.save(file_name + SIDECAR_SUFFIX, np.asarray(data, dtype=np.float32))
+
+
+def is_dtm(source):
+    return isinstance(source, str) and source.lower().endswith('.dtm')
+
+
+def asc_header_from_dtm(header: dtm_parse.DtmHeader):
+    # A .dtm's origin is its lower left grid point, which is the center of the ASC's lower left cell
+    if not np.isclose(header.column_spacing, header.row_spacing):
+        raise ValueError(f'.dtm grids need square cells to be used as a DEM, not {header.column_spacing}x{header.row_spacing}')
+    return AscHeader(
+        ncols=header.ncols,
+        nrows=header.nrows,
+        xllcorner=header.origin_x - header.column_spacing / 2,
+        yllcorner=header.origin_y - header.row_spacing / 2,
+        cellsize=header.column_spacing,
+    )
+
+
+def dtm_header_from_asc(header: AscHeader, name: str = ''):
+    return dtm_parse.DtmHeader(
+        ncols=header.ncols,
+        nrows=header.nrows,
+        origin_x=header.xllcorner + header.cellsize / 2,
+        origin_y=header.yllcorner + header.cellsize / 2,
+        column_spacing=header.cellsize,
+        row_spacing=header.cellsize,
+        name=name,
+    )
+
+
+def read_dtm(file_name: str):
+    # A .dtm as (AscHeader, float32 grid), just like read_asc.  It's binary already, so there's no sidecar.
+    header, data = dtm_parse.read_dtm(file_name, nodata=NO_DATA)
+    return asc_header_from_dtm(header), data
+
+
+def write_dtm(file_name: str, header: AscHeader, data):
+    dtm_parse.write_dtm(file_name, dtm_header_from_asc(header, os.path.basename(file_name)), data, NO_DATA)
+
+
+def export_asc(dtm_name: str, asc_name: str, band_rows: int = 1024):
+    # Written a band of rows at a time straight out of the memory mapped .dtm,
+    # so even a merged DEM bigger than memory can be exported.
+    header, raw = dtm_parse.open_dtm(dtm_name)
+    with open(asc_name, 'w') as f:
+        write_asc_header(f, asc_header_from_dtm(header))
+        for stop in range(header.nrows, 0, -band_rows):
+            start = max(0, stop - band_rows)
+            np.savetxt(f, dtm_parse.to_rows(header, raw[:, start:stop], NO_DATA), fmt='%.3f')
+
+
+def read_raster(source, use_cache: bool = True):
+    # A raster source is either the name of an ASC or .dtm file on disk or a
+    # (header, grid) pair that's already in memory, like the ones las_grid produces.
+    if is_dtm(source):
+        return read_dtm(source)
+    if isinstance(source, str):
+        return read_asc(source, use_cache)
+    return source
+
+
+class RasterCache:
+    """
+    Decoded rasters kept in memory for reuse, least recently used out first
+    once they add up to more than max_bytes.  A file that changed on disk is
+    decoded again.  Safe to share between threads.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.rasters = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, file_name: str):
+        # (header, grid) of a raster file, from memory if it hasn't changed since it was cached
+        file_name = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.rasters.get(file_name)
+            if entry is not None and entry[0] == stamp:
+                self.rasters.move_to_end(file_name)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        header, data = read_raster(file_name)
+        # Copied out of any memory mapped sidecar, so it really is in memory
+        data = np.array(data)
+        with self.lock:
+            if file_name in self.rasters:
+                self.size -= self.rasters.pop(file_name)[2].nbytes
+            if data.nbytes <= self.max_bytes:
+                self.rasters[file_name] = (stamp, header, data)
+                self.size += data.nbytes
+                while self.size > self.max_bytes:
+                    self.size -= self.rasters.popitem(last=False)[1][2].nbytes
+        return header, data
+
+    def stats(self):
+        with self.lock:
+            return {'rasters': len(self.rasters), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def level_file(file_name: str, factor: int):
+    return file_name + LEVEL_SUFFIX.format(factor=factor)
+
+
+def load_level(source, factor: int, use_cache: bool = True):
+    """
+    Level of detail `factor` of a raster source (a file name or an in-memory
+    (header, grid) pair), as (header, grid).  Levels of files are cached and
+    memory mapped on later runs, for as long as they're newer than the file.
+    """
+    header, data = read_raster(source, use_cache)
+    if factor == 1:
+        return header, data
+    level_header = pyramid.downsample_header(header, factor)
+
+    if isinstance(source, str):
+        cached = level_file(source, factor)
+        if use_cache and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(source):
+            level = np.load(cached, mmap_mode='r')
+            if level.shape == (level_header.nrows, level_header.ncols):
+                return level_header, level
+
+    level = pyramid.downsample(data, factor, NO_DATA)
+    if isinstance(source, str) and use_cache:
+        _write_atomically(level_file(source, factor), lambda f: np.save(f, level))
+    return level_header, level
+
+
+def read_strided(source, stride: int):
+    """
+    Every stride'th cell of a raster source in each direction, as (header,
+    grid).  A .dtm is memory mapped, so only the sampled columns are read.
+    Cells are sampled from the northern edge down, like pyramid's levels.
+    """
+    if is_dtm(source):
+        header, raw = dtm_parse.open_dtm(source)
+        data = dtm_parse.to_rows(header, raw[::stride, (header.nrows - 1) % stride::stride], NO_DATA)
+        return pyramid.downsample_header(asc_header_from_dtm(header), stride), data
+    header, data = read_raster(source)
+    return pyramid.downsample_header(header, stride), np.array(data[::stride, ::stride])
+
+
+def read_window(source, rows: slice, cols: slice):
+    """
+    The cells in rows x cols of a raster source, rows counted from the north
+    like an ASC.  Files are memory mapped (a .dtm directly, an ASC through its
+    sidecar), so only the window is read.
+    """
+    if is_dtm(source):
+        header, raw = dtm_parse.open_dtm(source)
+        # The .dtm stores each column from the south
+        south = slice(header.nrows - rows.stop, header.nrows - rows.start)
+        return dtm_parse.to_rows(header, raw[cols, south], NO_DATA)
+    return np.array(read_raster(source)[1][rows, cols])
+
+
+def load_asc(source, use_cache: bool = True):
+    header, data = read_raster(source, use_cache)
+
+    # Remove rows/columns without any data
+    empty = data == NO_DATA
+    data = data[np.ix_(~np.all(empty, axis=1), ~np.all(empty, axis=0))]
 
     # If we don't do this, the data ends up mirrored.
     data = cv2.flip(data, 0)
     return data
 
-def gen_stls_from_ascs(list_of_asc: list, list_of_files: list, scale_adjustment = 1.0, vscale = 1.0, base = 0.0):
-    # This is a bit inefficient IMO, but it's important in order
-    # to ensure that we generate all stl files with a uniform height
-    list_of_depth_maps = [load_asc(x) for x in list_of_asc]
-    print(list_of_asc)
-    lowest_value = np.inf
-    for d in list_of_depth_maps:
-        for y in d:
-            for x in y:
-                if x < lowest_value and x != NO_DATA:
-                    lowest_value = x
-    if lowest_value != np.inf:
-        print(f'Lowest elevation found: {lowest_value}, using for base for all STLs')
+def tile_stats(source):
+    # Elevation stats for a single tile, without trimming or flipping it first
+    header, data = read_raster(source)
+    valid = data != NO_DATA
+    nodata_count = int(data.size - np.count_nonzero(valid))
+    has_data = nodata_count < data.size
+    return {
+        'mtime': os.path.getmtime(source) if isinstance(source, str) else None,
+        'nrows': header.nrows,
+        'ncols': header.ncols,
+        'min': float(data.min(where=valid, initial=np.inf)) if has_data else None,
+        'max': float(data.max(where=valid, initial=-np.inf)) if has_data else None,
+        'nodata': nodata_count,
+    }
+
+
+def load_tile_stats(list_of_asc: list, index_file: str):
+    """
+    First pass over the tiles: collect per-tile elevation stats, one tile at a
+    time, and save them to a small index.  Tiles that haven't changed since the
+    index was written aren't read again.
+    """
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+
+    stats = {}
+    for i, a in enumerate(list_of_asc):
+        if not isinstance(a, str):
+            # In-memory rasters are cheap to scan and have nothing to cache
+            stats[f'<raster {i}>'] = tile_stats(a)
+            continue
+        entry = index.get(a)
+        if entry is None or entry['mtime'] != os.path.getmtime(a):
+            print(f'Scanning {a}')
+            entry = tile_stats(a)
+        stats[a] = entry
+
+    _write_atomically(index_file, lambda f: json.dump({k: v for k, v in stats.items() if v['mtime'] is not None}, f, indent=1), 'w')
+    return stats
+
+
+def lowest_elevation(stats: dict):
+    minimums = [s['min'] for s in stats.values() if s['min'] is not None]
+    return np.float64(min(minimums)) if minimums else None
+
+
+def stl_names(name: str, lods: list = (1,), format: str = 'stl', directory: str = 'STL'):
+    # Every mesh format goes in the STL directory, only the extension changes
+    return [os.path.join(directory, f'{name}.{format}' if list(lods) == [1] else f'{name}_lod{k}.{format}') for k in lods]
+
+
+def gen_stl_from_asc(source, name: str, lowest_value, scale_adjustment = 1.0, vscale = 1.0, base = 0.0, max_error: float = None, lods: list = (1,), pool = None, format: str = 'stl', multiprocessing: bool = True, max_memory: int = stlgenerator.DEFAULT_MAX_MEMORY, directory: str = 'STL'):
+    # Every level of detail is averaged from the same full resolution DEM.  The
+    # vertical size is adjusted as if the DEM had been gridded at that level.
+    os.makedirs(directory, exist_ok=True)
+
+    for k, s in zip(lods, stl_names(name, lods, format, directory)):
+        depth_map = model_heightmap(load_level(source, k), lowest_value, vscale)
+        mesh_heightmap(depth_map, s, lowest_value, k, scale_adjustment, base, max_error, pool, format, multiprocessing, max_memory)
+        del depth_map
+
+
+def model_heightmap(raster, lowest_value, vscale = 1.0):
+    # The raster trimmed and flipped, with its voids at the base and scaled, the way every model is made
+    depth_map = load_asc(raster)
+    depth_map = np.where(depth_map == NO_DATA, np.float32(lowest_value), depth_map)
+    depth_map *= vscale
+    return depth_map
+
+
+def mesh_heightmap(depth_map, destination: str, lowest_value, factor: int = 1, scale_adjustment = 1.0, base = 0.0, max_error: float = None, pool = None, format: str = 'stl', multiprocessing: bool = True, max_memory: int = stlgenerator.DEFAULT_MAX_MEMORY):
+    # A heightmap at 1/factor of the DEM's resolution is sized as if it had been gridded that coarse
+    stlgenerator.generate_from_heightmap_array(
+        depth_map,
+        destination=destination,
+        hsep=0,
+        sep_dep=0,
+        tab_size=0,
+        tab_dep=0,
+        anchorsize=0,
+        hmin=lowest_value - base,
+        vsize=1/np.sqrt(scale_adjustment*factor+0.5),
+        max_error=max_error,
+        pool=pool,
+        format=format,
+        multiprocessing=multiprocessing,
+        max_memory=max_memory,
+    )
+
+
+def base_for_stls(list_of_asc: list, index_file: str = None, lowest_value = None):
+    # All STLs need to share the same base so they print with a uniform height.
+    # Rather than holding every tile in memory to find it, scan each tile once
+    # for its stats.
+    if lowest_value is not None:
+        lowest_value = np.float64(lowest_value)
+        print(f'Using {lowest_value} as the base for all STLs')
     else:
-        lowest_value = 0
-        print(f'DEM Missing data!  Needs further adjustment.  Setting lowest value to 0.')
-
-    for index, depth_map in enumerate(list_of_depth_maps):
-        list_of_depth_maps[index] = np.where(depth_map == NO_DATA, lowest_value, depth_map)
-        list_of_depth_maps[index] *= vscale
-
-    if not os.path.exists('STL'):
-        os.mkdir('STL')
-
-    list_of_stl = [f'STL\\{x}.stl' for x in list_of_files]
-
-    for d, s in zip(list_of_depth_maps, list_of_stl):
-        stlgenerator.generate_from_heightmap_array(
-            d,
-            destination=s,
-            hsep=0,
-            sep_dep=0,
-            tab_size=0,
-            tab_dep=0,
-            anchorsize=0,
-            hmin=lowest_value - base,
-            vsize=1/np.sqrt(scale_adjustment+0.5),
-        )
+        if index_file is None:
+            first_file = next((a for a in list_of_asc if isinstance(a, str)), '')
+            index_file = os.path.join(os.path.dirname(first_file), STATS_INDEX)
+        stats = load_tile_stats(list_of_asc, index_file)
+
+        lowest_value = lowest_elevation(stats)
+        if lowest_value is not None:
+            print(f'Lowest elevation found: {lowest_value}, using for base for all STLs')
+        else:
+            lowest_value = np.float64(0)
+            print(f'DEM Missing data!  Needs further adjustment.  Setting lowest value to 0.')
+    return lowest_value
+
+
+def raster_header(source):
+    # The AscHeader of a raster source, without reading a file's grid
+    if is_dtm(source):
+        with open(source, 'rb') as f:
+            return asc_header_from_dtm(dtm_parse.read_dtm_header(f))
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return read_asc_header(f)
+    return source[0]
+
+
+def raster_shape(source):
+    # (rows, columns) of a raster source, without reading a file's grid
+    if isinstance(source, str):
+        header = raster_header(source)
+        return header.nrows, header.ncols
+    return source[1].shape
+
+
+def plan_meshing(list_of_asc: list, max_memory: int, processes: int, max_error: float = None, format: str = 'stl'):
+    """
+    Split tiles into the ones to mesh side by side, each in a process of its
+    own, and the ones to mesh one at a time with their rows split across every
+    process.  A tile is meshed on its own if it's small enough that one per
+    process fits in max_memory, as long as there are enough of those tiles to
+    keep every process busy.  Returns (tile level, row level) lists of
+    (estimated memory, index into list_of_asc).
+    """
+    estimates  = [stlgenerator.estimate_memory(*raster_shape(a), TILE_BAND_MEMORY, max_error, format) for a in list_of_asc]
+    tile_level = [(e, i) for i, e in enumerate(estimates) if e * processes <= max_memory]
+    if len(tile_level) < processes:
+        tile_level = []
+    chosen = {i for _, i in tile_level}
+    row_level = [(e, i) for i, e in enumerate(estimates) if i not in chosen]
+    return tile_level, row_level
+
+
+def _mesh_tile(tile, **options):
+    source, name = tile
+    gen_stl_from_asc(source, name, multiprocessing=False, max_memory=TILE_BAND_MEMORY, **options)
+    return name
+
+
+def gen_stls_from_ascs(list_of_asc: list, list_of_files: list, scale_adjustment = 1.0, vscale = 1.0, base = 0.0, index_file: str = None, max_error: float = None, lods: list = (1,), lowest_value = None, format: str = 'stl', max_memory: int = DEFAULT_MESH_MEMORY, processes: int = None):
+    # Find the shared base, then mesh lots of small tiles side by side and big
+    # ones one at a time, with one pool of workers splitting up their rows.
+    lowest_value = base_for_stls(list_of_asc, index_file, lowest_value)
+    processes = processes or multiprocessing.cpu_count()
+    options = dict(lowest_value=lowest_value, scale_adjustment=scale_adjustment, vscale=vscale, base=base, max_error=max_error, lods=lods, format=format)
+    tile_level, row_level = plan_meshing(list_of_asc, max_memory, processes, max_error, format)
+
+    if tile_level:
+        print(f'Meshing {len(tile_level)} tiles side by side')
+        jobs = [(e, functools.partial(_mesh_tile, **options), (list_of_asc[i], list_of_files[i])) for e, i in tile_level]
+        scheduler.run_within_budget(jobs, max_memory, processes)
+    if row_level:
+        # Half the budget is left for the tile itself, the rest goes to bands in flight
+        with stlgenerator.StlWorkerPool(processes) as pool:
+            for _, i in row_level:
+                gen_stl_from_asc(list_of_asc[i], list_of_files[i], pool=pool, max_memory=max_memory // 2, **options)
 
 
 def main():
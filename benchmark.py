@@ -0,0 +1,233 @@
+"""
+Benchmarks for the hot paths of the pipeline, run on synthetic inputs so
+they're repeatable anywhere.  Each stage is timed on its own at a few sizes,
+and its peak memory is measured in a separate (slower) traced run.
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json --threshold 0.2
+
+The second run exits with an error if any stage got more than 20% slower.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import asc_parse
+import las_grid
+from multiprocessing import cpu_count
+from stltools import facetarray, indexedmesh, stlgenerator
+
+# Edge length (in cells) of the synthetic rasters for each size
+SIZES = {
+    'small': 256,
+    'medium': 1024,
+    'large': 2048,
+}
+
+# Cells of nodata around the edge of every synthetic ASC, like a clipped tile
+NODATA_BORDER = 8
+
+# Points per cell in the synthetic LAS files
+POINT_DENSITY = 2
+
+# Synthetic STLs skip the separators, tabs and anchor, so only the surface is measured
+STL_OPTIONS = dict(hsep=0, sep_dep=0, tab_size=0, tab_dep=0, anchorsize=0)
+
+
+def synthetic_heightmap(size: int, seed: int = 0):
+    # Rolling hills with some noise, in meters
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    hills = 40 * np.sin(6 * x) * np.cos(4 * y) + 25 * np.sin(15 * (x + y))
+    return (200 + hills + rng.normal(0, 0.5, hills.shape)).astype(np.float32)
+
+
+def write_synthetic_asc(file_name: str, size: int, seed: int = 0):
+    data = synthetic_heightmap(size, seed)
+    data[:NODATA_BORDER] = asc_parse.NO_DATA
+    data[-NODATA_BORDER:] = asc_parse.NO_DATA
+    data[:, :NODATA_BORDER] = asc_parse.NO_DATA
+    data[:, -NODATA_BORDER:] = asc_parse.NO_DATA
+    header = asc_parse.AscHeader(ncols=size, nrows=size, xllcorner=500000.0, yllcorner=4000000.0, cellsize=1.0)
+    # No sidecar, so reading it back really parses the text
+    asc_parse.write_asc(file_name, header, data, sidecar=False)
+
+
+def write_synthetic_las(file_name: str, size: int, seed: int = 0):
+    """A LAS 1.2 point format 1 file with POINT_DENSITY points per cell of a size x size meter tile."""
+    rng = np.random.default_rng(seed)
+    count = size * size * POINT_DENSITY
+    x = rng.uniform(0, size, count)
+    y = rng.uniform(0, size, count)
+    heightmap = synthetic_heightmap(size, seed)
+    z = heightmap[np.minimum(y.astype(int), size - 1), np.minimum(x.astype(int), size - 1)].astype(np.float64)
+    origin = (500000.0, 4000000.0, 0.0)
+    scale = (0.01, 0.01, 0.01)
+
+    header = bytearray(227)
+    header[0:4] = b'LASF'
+    header[24:26] = bytes((1, 2))
+    struct.pack_into('<HI', header, 94, 227, 227)
+    struct.pack_into('<BHI', header, 104, 1, 28, count)
+    struct.pack_into('<3d', header, 131, *scale)
+    struct.pack_into('<3d', header, 155, *origin)
+    struct.pack_into('<6d', header, 179, origin[0] + size, origin[0], origin[1] + size, origin[1], z.max(), z.min())
+
+    records = np.zeros(count, dtype=las_grid.point_dtype(las_grid.parse_las_header(bytes(header))))
+    records['X'] = np.round(x / scale[0])
+    records['Y'] = np.round(y / scale[1])
+    records['Z'] = np.round(z / scale[2])
+    records['classification'] = las_grid.GROUND_CLASS
+    with open(file_name, 'wb') as f:
+        f.write(header)
+        f.write(records.tobytes())
+
+
+def ply_faces(size: int):
+    # Faces in the indexed mesh of a synthetic heightmap, which shares its vertices
+    # and so has far fewer of them than the STL has facets
+    return indexedmesh.count_grid_faces(size, size)
+
+
+def measure(func, repeat: int):
+    """
+    Best wall time over repeat runs, then peak traced memory over one more.
+    Only memory allocated by this process is traced, not the pool's workers.
+    """
+    seconds = float('inf')
+    # The stages report their progress on stdout, keep it out of the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            seconds = min(seconds, time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(sizes: list, repeat: int, work_dir: str, pool_processes: int = None):
+    results = {}
+
+    def record(stage, size_name, func, **work):
+        # work maps a throughput unit (cells, facets, bytes...) to how much of it one run does
+        seconds, peak = measure(func, repeat)
+        throughput = {f'{unit}_per_s': amount / seconds for unit, amount in work.items()}
+        results[f'{stage}[{size_name}]'] = {'seconds': seconds, 'peak_memory': peak, **throughput}
+        rates = ', '.join(f'{v:,.0f} {k.replace("_per_s", "")}/s' for k, v in throughput.items())
+        print(f'{stage + "[" + size_name + "]":<40}{seconds:>10.4f}s  {peak / 1e6:>9.1f} MB peak  {rates}')
+
+    with stlgenerator.StlWorkerPool(pool_processes) as pool:
+        for size_name in sizes:
+            size = SIZES[size_name]
+            cells = size * size
+
+            asc_name = os.path.join(work_dir, f'{size_name}.asc')
+            write_synthetic_asc(asc_name, size)
+            record('load_asc', size_name, lambda: asc_parse.load_asc(asc_name, use_cache=False), cells=cells)
+            dtm_name = os.path.join(work_dir, f'{size_name}.dtm')
+            asc_parse.write_dtm(dtm_name, *asc_parse.read_asc(asc_name, use_cache=False))
+            record('load_dtm', size_name, lambda: asc_parse.load_asc(dtm_name), cells=cells)
+
+            # The scan for the shared base of every STL, without the stats index to short circuit it
+            tiles = [asc_name] * 4
+            def scan():
+                stats = {a: asc_parse.tile_stats(asc_parse.read_asc(a, use_cache=False)) for a in tiles}
+                return asc_parse.lowest_elevation(stats)
+            record('global_min_scan', size_name, scan, cells=cells * len(tiles))
+
+            las_name = os.path.join(work_dir, f'{size_name}.las')
+            write_synthetic_las(las_name, size)
+            record('grid_las', size_name, lambda: las_grid.grid_las([las_name]), points=cells * POINT_DENSITY, cells=cells)
+
+            heightmap = synthetic_heightmap(size)
+            facets = facetarray.count_row_facets(size - 1, size - 1, 0, size - 1)
+            def rows():
+                for y in range(size - 1):
+                    stlgenerator.CalculateRow(heightmap, y, 1.0 / size)
+            record('CalculateRow', size_name, rows, facets=facets)
+
+            stl_name = os.path.join(work_dir, f'{size_name}.stl')
+            stl_bytes = 84 + facets * facetarray.STL_FACET.itemsize
+            record('generate_serial', size_name,
+                   lambda: stlgenerator.generate_from_heightmap_array(heightmap, stl_name, multiprocessing=False, **STL_OPTIONS),
+                   facets=facets, bytes_written=stl_bytes)
+            record('generate_pool', size_name,
+                   lambda: stlgenerator.generate_from_heightmap_array(heightmap, stl_name, pool=pool, **STL_OPTIONS),
+                   facets=facets, bytes_written=stl_bytes)
+            ply_name = os.path.join(work_dir, f'{size_name}.ply')
+            record('generate_ply', size_name,
+                   lambda: stlgenerator.generate_from_heightmap_array(heightmap, ply_name, format='ply', **STL_OPTIONS),
+                   faces=ply_faces(size))
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Stages that got slower than their baseline by more than threshold (0.2 = 20%)."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        if change > threshold:
+            regressions.append((name, before['seconds'], result['seconds'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=lambda s: s.split(','), default=['small', 'medium'], help=f'A comma separated list of sizes to run, out of {", ".join(SIZES)}.  The default is small,medium.')
+    parser.add_argument('--repeat', type=int, default=3, help='How many times each stage is run, the fastest run is reported.  The default is 3.')
+    parser.add_argument('--processes', type=int, default=None, help='How many processes the STL worker pool uses.  The default is one per core.')
+    parser.add_argument('--save', type=str, default='benchmark_results.json', help='Where to write the results as JSON.  The default is benchmark_results.json.')
+    parser.add_argument('--baseline', type=str, default=None, help='A results file from an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='How much slower than the baseline (0.2 = 20%%) a stage may get before the run fails.  The default is 0.2.')
+    args = parser.parse_args()
+
+    unknown = [s for s in args.sizes if s not in SIZES]
+    if unknown:
+        parser.error(f'Unknown sizes: {", ".join(unknown)}')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args.sizes, args.repeat, work_dir, args.processes)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.save, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved to {args.save}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after, change in regressions:
+            print(f'REGRESSION {name}: {before:.4f}s -> {after:.4f}s ({change:+.0%})')
+        if regressions:
+            sys.exit(1)
+        print(f'No stage regressed more than {args.threshold:.0%} against {args.baseline}')
+
+
+if __name__ == "__main__":
+    main()
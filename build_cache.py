@@ -0,0 +1,125 @@
+"""
+A manifest based build cache for the pipeline's artifacts.
+
+Every artifact is recorded under a key made from the stage that built it,
+the content hashes of its inputs and the parameters that affect it.  A rerun
+only redoes a stage when that key changes (or the artifact is gone), so
+changing --reduce regrids every tile, while an untouched tile is skipped.
+Content hashes are remembered per file size and modification time, so
+unchanged inputs don't get hashed again.  The manifest is only written out
+every SAVE_INTERVAL seconds and when flush() is called, not on every record,
+so big runs don't spend their time rewriting it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+MANIFEST = 'build_cache.json'
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+# Longest a record can go unsaved while a run is going, in seconds
+SAVE_INTERVAL = 5.0
+
+
+class BuildCache:
+    def __init__(self, manifest_name: str = MANIFEST):
+        self.manifest_name = manifest_name
+        self.manifest = {'artifacts': {}, 'hashes': {}}
+        if os.path.exists(manifest_name):
+            with open(manifest_name) as f:
+                self.manifest = json.load(f)
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def content_hash(self, file_name: str):
+        st = os.stat(file_name)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            known = self.manifest['hashes'].get(file_name)
+        if known and known['stamp'] == stamp:
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            while chunk := f.read(HASH_CHUNK):
+                digest.update(chunk)
+        with self._lock:
+            self.manifest['hashes'][file_name] = {'stamp': stamp, 'sha256': digest.hexdigest()}
+            self._dirty = True
+        return digest.hexdigest()
+
+    def key(self, stage: str, inputs: list, params: dict):
+        description = {
+            'stage': stage,
+            'inputs': [self.content_hash(i) for i in inputs],
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, stage: str, outputs: list, inputs: list, params: dict):
+        """True if every output exists and was built from these exact inputs and parameters."""
+        fresh = all(os.path.exists(o) for o in outputs) and all(os.path.exists(i) for i in inputs)
+        if fresh:
+            key = self.key(stage, inputs, params)
+            with self._lock:
+                fresh = all(self.manifest['artifacts'].get(o) == key for o in outputs)
+        with self._lock:
+            (self.hits if fresh else self.misses)[stage] += 1
+        return fresh
+
+    def record(self, stage: str, outputs: list, inputs: list, params: dict):
+        key = self.key(stage, inputs, params)
+        with self._lock:
+            for o in outputs:
+                self.manifest['artifacts'][o] = key
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= SAVE_INTERVAL:
+                self._save()
+
+    def flush(self):
+        """Write out anything recorded since the manifest was last saved."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _save(self):
+        temp_name = self.manifest_name + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temp_name, self.manifest_name)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def stage_hooks(self, stage: str, spec):
+        """
+        skip/done hooks for a scheduler stage.  spec(item) returns the
+        (outputs, inputs, params) the stage would build for an item, or None if
+        the stage has nothing to do for it.
+        """
+        def skip(item):
+            artifact = spec(item)
+            if artifact is not None and self.is_fresh(stage, *artifact):
+                print(f'{stage}: {artifact[0][0]} is up to date, skipping...')
+                return True
+            return False
+
+        def done(item):
+            artifact = spec(item)
+            if artifact is not None:
+                self.record(stage, *artifact)
+
+        return dict(skip=skip, done=done)
+
+    def report(self):
+        lines = ['Build cache:', f'  {"stage":<10}{"hits":>8}{"misses":>8}']
+        for stage in sorted(set(self.hits) | set(self.misses)):
+            lines.append(f'  {stage:<10}{self.hits[stage]:>8}{self.misses[stage]:>8}')
+        lines.append(f'  {"total":<10}{sum(self.hits.values()):>8}{sum(self.misses.values()):>8}')
+        return '\n'.join(lines)
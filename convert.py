@@ -2,13 +2,26 @@ import os
 import sys
 import zipfile
 import asc_parse
+import las_grid
+import pyramid
 import wget
 import multiprocessing
 import urllib.request as request
+import downloader
 from contextlib import closing
 import argparse
 import shutil
 import glob
+import functools
+import scheduler
+import build_cache
+import instrument
+import preview
+import tile_index
+from stltools import stlgenerator
+from dataclasses import dataclass, field, replace
+
+# The defaults for every run's settings.  Nothing changes these, each run gets a Config of its own.
 
 # A decimal value that will decrease the output file size as it increases
 REDUCE_BY = 1.0
@@ -25,6 +38,56 @@ MERGE_LAS = False
 # Generate 3D models
 GENERATE_STLS = True
 
+# Only make quick low resolution previews of the models, instead of the models themselves
+PREVIEW = False
+
+# Simplify STLs so the surface is never more than this many mm from the full resolution model (None to disable)
+MAX_ERROR = None
+
+# Memory budget in MB for meshing, decides how many tiles are meshed at once
+MAX_MEMORY = 4096
+
+# File format for the 3D models, 'stl' or one of the smaller indexed formats 'ply' and '3mf'
+MESH_FORMAT = 'stl'
+
+# Levels of detail to generate STLs for, each one averages that many cells together in each direction
+LODS = [1]
+
+# Elevation to use as the bottom of every STL.  By default it's the lowest point in all of the data, which
+# means no STL can be made until every tile has been gridded.  Setting it lets STLs be made as tiles finish.
+BASE_ELEVATION = None
+
+# How many tiles each stage of the pipeline works on at once
+STAGE_WORKERS = {
+    'download': 16,
+    'unzip': 4,
+    'decode': multiprocessing.cpu_count(),
+    'grid': multiprocessing.cpu_count(),
+    'raster': multiprocessing.cpu_count(),
+    'stl': 1,
+}
+
+# Grid points straight out of the downloaded zips instead of extracting LAS files first (native gridder only)
+STREAM_ZIPS = False
+
+# Only make a model of this (min_x, min_y, max_x, max_y) box, in the DEMs' coordinates, out of whichever tiles it overlaps
+BBOX = None
+
+# Grid point clouds with the built in gridder ('native') or FUSION's GridSurfaceCreate64.exe ('fusion')
+GRIDDER = 'native'
+
+# How the native gridder reduces the points that land in each cell ('min', 'mean' or 'max')
+GRID_METHOD = 'mean'
+
+# Only grid points classified as ground with the native gridder
+GROUND_ONLY = False
+
+# Export every DEM as an ASCII grid alongside its .dtm, for use in other tools like QGIS
+EXPORT_ASC = True
+
+# Print how many artifacts the build cache let each stage skip
+CACHE_STATS = False
+
 # Delete LAS Directory when finished
 DELETE_LAS = False
 
@@ -42,7 +105,6 @@ elif __file__:
     APPLICATION_PATH = os.path.dirname(__file__)
 
 GRID_EXE = os.path.join(APPLICATION_PATH, "GridSurfaceCreate64.exe")
-D2A_EXE = os.path.join(APPLICATION_PATH, "DTM2ASCII.exe")
 LASZIP_EXE = os.path.join(APPLICATION_PATH, "laszip-cli.exe")
 LASTOOLS_URL = "http://lastools.github.io/download/LAStools.zip"
 BLAST2DEM_EXE = os.path.join(APPLICATION_PATH, "LAStools\\bin\\blast2dem.exe")
@@ -61,173 +123,527 @@ def install_lastools():
         os.remove(file_name)
 
 
-def get_file_from_url(url, file_name):
-    # This is a pattern you'll see several times.  I don't want to have to
-    # redo the whole process if it fails along the way.
-    if os.path.exists(file_name):
-        print(f"{file_name} already downloaded, skipping...")
-        return
-    with closing(request.urlopen(url)) as r:
-        with open(file_name, 'wb') as f:
-            shutil.copyfileobj(r, f)
-    print(f"Downloaded {url}")
+
+
+def get_file_from_url(url, file_name, downloader: downloader.Downloader):
+    # Downloads land in a .part file that's only renamed once it's complete and
+    # verified, so an existing file is never a truncated one, and a .part file
+    # gets resumed.  Whether anything later needs redoing is up to the build cache.
+    downloader.download(url, file_name)
 
 
 def unzip_to_las(file_name, las_name):
     print(f'Unzipping {file_name}')
-    if os.path.exists(las_name):
-        print(f'{las_name} already exists, skipping...')
-        return
     with zipfile.ZipFile(file_name, "r") as zip_ref:
-        zip_ref.extractall("LAS")
+        zip_ref.extractall(os.path.dirname(las_name))
 
 
 def generate_dem_from_las(las_name, dem_name, filter: float = None, reduce_by: float = 1.0):
-    global GRID_EXE
-    if filter:
-        GRID_EXE += f' /spike:{filter}'
-    if os.path.exists(dem_name):
-        print(f'{dem_name} already exists, skipping...')
-        return
+    # las_name can be a wildcard, to grid every point cloud into one DEM
+    spike = f' /spike:{filter}' if filter else ''
     print(f'Generating {dem_name}')
-    os.system(f'{GRID_EXE} {dem_name} {reduce_by} M M 0 0 0 0 {las_name}')
+    instrument.run_tool(f'{GRID_EXE}{spike} {dem_name} {reduce_by} M M 0 0 0 0 {las_name}')
+
+
+def generate_dem_natively(las_names, dtm_name, filter: float = None, reduce_by: float = 1.0, method: str = 'mean', ground_only: bool = False):
+    # Written as a binary .dtm like FUSION's, so it never has to be parsed back out of text
+    print(f'Generating {dtm_name}')
+    header, grid = las_grid.grid_las(las_names, cell_size=reduce_by, method=method, ground_only=ground_only, spike=filter)
+    asc_parse.write_dtm(dtm_name, header, grid)
+    return header, grid
+
+
+def generate_mosaic_natively(las_names, dtm_name, filter: float = None, reduce_by: float = 1.0, method: str = 'mean', ground_only: bool = False):
+    # The mosaic is built out of core and copied into the .dtm a band at a
+    # time, so it never has to be held in memory.
+    print(f'Generating {dtm_name}')
+    mosaic_name = dtm_name + '.mosaic.npy'
+    header, grid = las_grid.mosaic_las(las_names, mosaic_name, cell_size=reduce_by, method=method, ground_only=ground_only, spike=filter)
+    asc_parse.write_dtm(dtm_name, header, grid)
+    del grid
+    os.remove(mosaic_name)
+    return header
 
 
 def unzip_laz_file(laz_name, las_name):
-    if os.path.exists(las_name):
-        print(f'{las_name} already exists, skipping...')
-        return
     print(f'Unzipping {laz_name} to {las_name}')
-    os.system(f'{LASZIP_EXE} -i {laz_name} -o {las_name}')
+    instrument.run_tool(f'{LASZIP_EXE} -i {laz_name} -o {las_name}')
 
 
-def main():
-    global VERTICAL_SCALE
-    global BASE_HEIGHT
-    global REDUCE_BY
-    global MERGE_LAS
-    global GENERATE_STLS
-    global DELETE_LAS
-    global QGIS_COMPATIBLE_DEM
-    global GRID_EXE
-
-    parser = argparse.ArgumentParser(description='A utility for automatically generating 3D printable STLs from USGS lidar scans.')
-    # Just in case the user doesn't pass in the file name, assume it's what the USGS names it.
-    parser.add_argument('--input', '-i', type=str, default='downloadlist.txt', help='The name of the file containing the URLs of all of the lidar scan data.')
-    parser.add_argument('--reduce', '-r', type=float, default=REDUCE_BY, help='A decimal value that will decrease the output file size as it increases.  The default value is 1.0')
-    parser.add_argument('--vscale', '-v', type=float, default=VERTICAL_SCALE, help='A decimal value that will make artificially make things taller as it increases.  The default value is 1.0')
-    parser.add_argument('--base', '-b', type=float, default=BASE_HEIGHT, help='A decimal value that sets the base height of the model.  The default value is 0.0')
-    parser.add_argument('--merge', '-m', action='store_true', help='Using this flag will merge all of the point clouds into one file before converting into a DEM.')
-    parser.add_argument('--no_stl', '-s', action='store_false', help='Using this flag will disable STL generation.')
-    parser.add_argument('--cleanup', '-c', action='store_true', help='Using this flag will cause the program to automatically delete the unzipped point cloud files after running.')
-    parser.add_argument('--filter', '-f', type=float, default=False, help='A percent value (0-100, for the slope of the points being smoothed) that will enable the spike smoothing option.  This is good if you have points that are floating way up above the model and causing spikes in your final model.')
-    parser.add_argument('--prj', '-p', action='store_true', help='Using this flag will cause the program to automatically download and use lastools to generate projection files for the elevation models.  This is important if you want to generate the STLs yourself in QGIS, but it means you\'ll have to be mindful of lastool\'s license limitations.  More info on lastool\'s website.')
-    parser.add_argument('--external_files', '-e', action='store_true', default=False, help='Using this flag will grab las/laz files from the LAS directory instead of downloading them from an input list.')
-    #parser.add_argument('--help', '-h', action='help')
+@dataclass
+class Tile:
+    # One tile of the dataset, as it moves through the stages of the pipeline
+    name: str
+    url: str = None
+    # The run's work directory, every file name is relative to it
+    root: str = ''
 
-    args = parser.parse_args()
+    @property
+    def zip_name(self):
+        return os.path.join(self.root, f'{self.name}.zip')
 
-    VERTICAL_SCALE = args.vscale
-    BASE_HEIGHT = args.base
-    REDUCE_BY = args.reduce
-    MERGE_LAS = args.merge
-    GENERATE_STLS = args.no_stl
-    DELETE_LAS = args.cleanup
-    QGIS_COMPATIBLE_DEM=args.prj
+    @property
+    def las_name(self):
+        return os.path.join(self.root, 'LAS', f'{self.name}.las')
 
-    if args.filter:
-        GRID_EXE += f' /spike:{args.filter}'
+    @property
+    def laz_name(self):
+        return os.path.join(self.root, 'LAS', f'{self.name}.laz')
 
-    if not args.external_files:
-        # For each tile in the USGS dataset, download the zip
-        f = open(args.input)
-        list_of_urls = []
-        list_of_zip = []
+    @property
+    def dtm_name(self):
+        return os.path.join(self.root, 'DTM', f'{self.name}.dtm')
 
-        for line in f:
-            if not line.rstrip('\n').endswith('.zip'):
-                continue
-            print(line := line.rstrip('\n'))
-            file_name = wget.filename_from_url(line)
-            list_of_zip.append(file_name)
-            list_of_urls.append(line)
+    @property
+    def asc_name(self):
+        return os.path.join(self.root, 'ASC', f'{self.name}.asc')
 
-        # This is the definitive list of all file names for each phase of the pipeline from here out.
-        list_of_files = [x.removesuffix('.zip') for x in list_of_zip]
 
-        list_of_las = [f'LAS\\{x}.las' for x in list_of_files]
+def download_tile(tile: Tile, downloader: downloader.Downloader):
+    if tile.url:
+        get_file_from_url(tile.url, tile.zip_name, downloader)
+    return tile
 
-        if not os.path.exists('LAS'):
-            os.mkdir('LAS')
 
-        with multiprocessing.Pool(16) as p:
-            p.starmap(get_file_from_url, zip(list_of_urls, list_of_zip))
-            # Unzip each zip file that was downloaded
-            p.starmap(unzip_to_las, zip(list_of_zip, list_of_las))
+def unzip_tile(tile: Tile, stream_zips: bool = False):
+    # When streaming, the gridder reads the points out of the zip itself
+    if tile.url and not stream_zips:
+        unzip_to_las(tile.zip_name, tile.las_name)
+    return tile
 
-    list_of_laz = list(glob.glob('LAS\\*.laz'))
 
-    if list_of_laz:
-        print("LAZ files detected, unzipping...")
-        with multiprocessing.Pool() as p:
-            p.starmap(unzip_laz_file, zip(list_of_laz, [x.removesuffix('.laz') + '.las' for x in list_of_laz]))
+def decode_tile(tile: Tile):
+    if os.path.exists(tile.laz_name):
+        unzip_laz_file(tile.laz_name, tile.las_name)
+    return tile
 
-    list_of_las = list(glob.glob('LAS\\*.las'))
-    list_of_files = [os.path.basename(x).removesuffix('.las') for x in list_of_las]
 
-    if MERGE_LAS:
-        list_of_files = [list_of_files[0]]
+def grid_tile(tile: Tile, gridder: str, filter: float, reduce_by: float, method: str, ground_only: bool, stream_zips: bool = False):
+    if gridder == 'native':
+        source = tile.zip_name if stream_zips and tile.url else tile.las_name
+        generate_dem_natively([source], tile.dtm_name, filter, reduce_by, method, ground_only)
+    else:
+        generate_dem_from_las(tile.las_name, tile.dtm_name, filter, reduce_by)
+    return tile
 
-    # Prep the list of DTM files
-    list_of_dtm = [f'DTM\\{x}.dtm' for x in list_of_files]
 
-    if not os.path.exists('DTM'):
-        os.mkdir('DTM')
+def raster_tile(tile: Tile, export_asc: bool):
+    # STLs are made straight from the .dtm, the ASC is only a side output for other tools
+    if export_asc:
+        print(f'Generating {tile.asc_name}')
+        asc_parse.export_asc(tile.dtm_name, tile.asc_name)
+    return tile
 
-    print("\nGenerating .dtm files...\n")
 
-    # If necessary, make sure all las files get combined into one DTM
-    if MERGE_LAS:
-        os.system(f'{GRID_EXE} {list_of_dtm[0]} {REDUCE_BY} M M 0 0 0 0 LAS\\*.las')
-    else:
-        with multiprocessing.Pool() as p:
-            p.starmap(generate_dem_from_las, zip(list_of_las, list_of_dtm, [args.filter] * len(list_of_las), [REDUCE_BY] * len(list_of_las)))
-
-    if not os.path.exists('ASC'):
-        os.mkdir('ASC')
-
-    list_of_asc = [f'ASC\\{x}.asc' for x in list_of_files]
-
-    # Convert all the dtm files into asc files
-    print("\nGenerating .asc files...\n")
-    for d, a in zip(list_of_dtm, list_of_asc):
-        print(a)
-        if os.path.exists(a):
-            pass
-        os.system(f'{D2A_EXE} /raster {d} {a}')
-
-    if QGIS_COMPATIBLE_DEM:
-        install_lastools()
-        list_of_prj = [f'LAS\\{x}.prj' for x in list_of_files]
-        # Use lastools to generate the prj file that QGIS will need
-        for l, p in zip(list_of_las, list_of_prj):
-            os.system(f'{BLAST2DEM_EXE} -i {l} -oasc')
-            shutil.copy(p, 'ASC')
-
-    if GENERATE_STLS:
-        asc_parse.gen_stls_from_ascs(
-            list_of_asc=list_of_asc,
-            list_of_files=list_of_files,
-            scale_adjustment=REDUCE_BY,
-            vscale=VERTICAL_SCALE,
-            base=BASE_HEIGHT,
+def stl_tile(tile: Tile, pool: stlgenerator.StlWorkerPool = None, **stl_options):
+    asc_parse.gen_stl_from_asc(tile.dtm_name, tile.name, pool=pool, directory=os.path.join(tile.root, 'STL'), **stl_options)
+    return tile
+
+
+# What each stage builds for a tile, as (outputs, inputs, parameters) for the
+# build cache, or None when the stage has nothing to do for it.  A different
+# URL always means a different zip name, so downloads are keyed by name alone.
+def download_artifact(tile: Tile):
+    return ([tile.zip_name], [], {'url': tile.url}) if tile.url else None
+
+
+def unzip_artifact(tile: Tile, stream_zips: bool = False):
+    return ([tile.las_name], [tile.zip_name], {}) if tile.url and not stream_zips else None
+
+
+def decode_artifact(tile: Tile):
+    return ([tile.las_name], [tile.laz_name], {}) if os.path.exists(tile.laz_name) else None
+
+
+def grid_artifact(tile: Tile, gridder: str, filter: float, reduce_by: float, method: str, ground_only: bool, stream_zips: bool = False):
+    if gridder == 'native':
+        source = tile.zip_name if stream_zips and tile.url else tile.las_name
+        return [tile.dtm_name], [source], {'gridder': gridder, 'filter': filter, 'reduce': reduce_by, 'method': method, 'ground_only': ground_only}
+    return [tile.dtm_name], [tile.las_name], {'gridder': gridder, 'filter': filter, 'reduce': reduce_by}
+
+
+def raster_artifact(tile: Tile, export_asc: bool):
+    return ([tile.asc_name], [tile.dtm_name], {}) if export_asc else None
+
+
+def stl_artifact(tile: Tile, lowest_value, scale_adjustment, vscale, base, max_error, lods, format):
+    params = {
+        'format': format,
+        'lowest_value': float(lowest_value),
+        'reduce': scale_adjustment,
+        'vscale': vscale,
+        'base': base,
+        'max_error': max_error,
+        'lods': list(lods),
+    }
+    return asc_parse.stl_names(tile.name, lods, format, os.path.join(tile.root, 'STL')), [tile.dtm_name], params
+
+
+def read_download_list(file_name: str, root: str = ''):
+    # For each tile in the USGS dataset, download the zip
+    tiles = []
+    with open(file_name) as f:
+        for line in f:
+            if not line.rstrip('\n').endswith('.zip'):
+                continue
+            print(line := line.rstrip('\n'))
+            name = wget.filename_from_url(line)
+            # This is the definitive list of all file names for each phase of the pipeline from here out.
+            tiles.append(Tile(name.removesuffix('.zip'), line, root))
+    return tiles
+
+
+@dataclass
+class Config:
+    # Everything that decides what one run does, the command line flags map onto these
+    input: str = 'downloadlist.txt'
+    # Where the run keeps its files, '' for the current directory
+    work_dir: str = ''
+    external_files: bool = False
+    reduce_by: float = REDUCE_BY
+    vertical_scale: float = VERTICAL_SCALE
+    base_height: float = BASE_HEIGHT
+    merge_las: bool = MERGE_LAS
+    generate_stls: bool = GENERATE_STLS
+    preview: bool = PREVIEW
+    export_asc: bool = EXPORT_ASC
+    delete_las: bool = DELETE_LAS
+    qgis_compatible_dem: bool = QGIS_COMPATIBLE_DEM
+    # Spike smoothing slope in percent for the gridders, None to disable
+    filter: float = None
+    gridder: str = GRIDDER
+    grid_method: str = GRID_METHOD
+    ground_only: bool = GROUND_ONLY
+    max_error: float = MAX_ERROR
+    max_memory: float = MAX_MEMORY
+    mesh_format: str = MESH_FORMAT
+    lods: list = field(default_factory=lambda: list(LODS))
+    base_elevation: float = BASE_ELEVATION
+    bbox: tuple = BBOX
+    # Overrides for STAGE_WORKERS, like {'download': 4}
+    stage_workers: dict = field(default_factory=dict)
+    stream_zips: bool = STREAM_ZIPS
+    cache_stats: bool = CACHE_STATS
+    trace: str = instrument.TRACE_FILE
+    profile: str = None
+
+    def resolved(self):
+        # The settings that actually apply, once the ones that rule each other out are sorted out
+        stream_zips = self.stream_zips and not self.external_files
+        if stream_zips and (self.gridder != 'native' or self.qgis_compatible_dem):
+            print('--stream_zips needs the native gridder and can\'t be used with --prj, extracting LAS files instead.')
+            stream_zips = False
+        return replace(
+            self,
+            generate_stls=self.generate_stls and not self.preview,
+            export_asc=self.export_asc or self.qgis_compatible_dem,
+            stream_zips=stream_zips,
         )
 
-    # Delete the directories used for the intermediate steps
-    print("Cleaning up...")
-    if DELETE_LAS:
-        shutil.rmtree('LAS')
-    shutil.rmtree('DTM')
+
+class Pipeline:
+    """
+    One run of the whole pipeline, from download list to models.  Each run
+    has its own settings, build cache, tracer and downloader and nothing is
+    kept in module globals, so runs can be embedded in other programs, or
+    run side by side with different settings as long as their work
+    directories differ.  Pass in pools to keep them warm between runs,
+    otherwise a run starts and stops its own.
+    """
+    def __init__(self, config: Config = None, stl_pool: stlgenerator.StlWorkerPool = None, executor=None):
+        self.config = (config or Config()).resolved()
+        self.stage_workers = {**STAGE_WORKERS, **scheduler.check_stage_workers(self.config.stage_workers, list(STAGE_WORKERS))}
+        self.downloader = downloader.Downloader(concurrency=self.stage_workers['download'])
+        self.cache = build_cache.BuildCache(self.path(build_cache.MANIFEST))
+        self.tracer = instrument.Tracer(self.path(self.config.trace), self.config.profile and self.path(self.config.profile))
+        self.stl_pool = stl_pool
+        self.executor = executor
+        # Filled in by run()
+        self.tiles = []
+        self.outputs = []
+
+    def path(self, *parts):
+        return os.path.join(self.config.work_dir, *parts)
+
+    @property
+    def stl_options(self):
+        c = self.config
+        return dict(
+            scale_adjustment=c.reduce_by,
+            vscale=c.vertical_scale,
+            base=c.base_height,
+            max_error=c.max_error,
+            lods=c.lods,
+            format=c.mesh_format,
+        )
+
+    @property
+    def grid_options(self):
+        c = self.config
+        return dict(gridder=c.gridder, filter=c.filter, reduce_by=c.reduce_by, method=c.grid_method, ground_only=c.ground_only, stream_zips=c.stream_zips)
+
+    def read_tiles(self):
+        if not self.config.external_files:
+            return read_download_list(self.path(self.config.input), self.config.work_dir)
+        point_clouds = glob.glob(self.path('LAS', '*.las')) + glob.glob(self.path('LAS', '*.laz'))
+        names = sorted({os.path.splitext(os.path.basename(x))[0] for x in point_clouds})
+        return [Tile(x, root=self.config.work_dir) for x in names]
+
+    def stage(self, name: str, func, artifact, in_process: bool = False):
+        # A stage that's traced, and skipped for any tile the build cache says is up to date
+        hooks = self.cache.stage_hooks(name, artifact)
+
+        def skip(tile: Tile):
+            if hooks['skip'](tile):
+                self.tracer.cached(name, tile.name)
+                return True
+            return False
+
+        return scheduler.Stage(name, instrument.Traced(self.tracer, name, func, artifact), self.stage_workers[name], in_process, skip=skip, done=hooks['done'])
+
+    def mesh_tiles(self, tiles: list, pool: stlgenerator.StlWorkerPool, **stl_options):
+        # Lots of small tiles are meshed side by side, as many at once as fit in
+        # max_memory, and big ones one at a time with their rows split across the pool.
+        # Returns a list of ('stl', tile, exception) for the tiles that couldn't be meshed.
+        artifact = functools.partial(stl_artifact, **stl_options)
+        hooks = self.cache.stage_hooks('stl', artifact)
+        stale = []
+        failures = []
+        for tile in tiles:
+            if hooks['skip'](tile):
+                self.tracer.cached('stl', tile.name)
+            else:
+                stale.append(tile)
+
+        budget = self.config.max_memory * 1024 * 1024
+        tile_level, row_level = asc_parse.plan_meshing([t.dtm_name for t in stale], budget, pool.processes, stl_options['max_error'], stl_options['format'])
+        if tile_level:
+            print(f'Meshing {len(tile_level)} tiles side by side')
+            mesh = instrument.Traced(self.tracer, 'stl', functools.partial(stl_tile, multiprocessing=False, max_memory=asc_parse.TILE_BAND_MEMORY, **stl_options), artifact)
+            meshed, failed = scheduler.run_within_budget([(e, mesh, stale[i]) for e, i in tile_level], budget, pool.processes, self.executor)
+            for tile in meshed:
+                hooks['done'](tile)
+            failures.extend(('stl', tile, error) for _, tile, error in failed)
+        if row_level:
+            stage = self.stage('stl', functools.partial(stl_tile, pool=pool, max_memory=budget // 2, **stl_options), artifact)
+            _, failed = scheduler.run_pipeline([stale[i] for _, i in row_level], [stage])
+            failures.extend(failed)
+        return failures
+
+    def merge(self, tile: Tile, list_of_las: list):
+        # Every point cloud is gridded into the first tile's DEM
+        c = self.config
+        print("\nGenerating merged DEM...\n")
+        merge_params = {'gridder': c.gridder, 'filter': c.filter, 'reduce': c.reduce_by, 'method': c.grid_method, 'ground_only': c.ground_only}
+        if self.cache.is_fresh('merge', [tile.dtm_name], list_of_las, merge_params):
+            print(f'{tile.dtm_name} is up to date, skipping...')
+            self.tracer.cached('merge', tile.name)
+        else:
+            with self.tracer.span('merge', tile.name, list_of_las, [tile.dtm_name]):
+                if c.gridder == 'native':
+                    generate_mosaic_natively(list_of_las, tile.dtm_name, c.filter, c.reduce_by, c.grid_method, c.ground_only)
+                else:
+                    generate_dem_from_las(self.path('LAS', '*.las'), tile.dtm_name, c.filter, c.reduce_by)
+            self.cache.record('merge', [tile.dtm_name], list_of_las, merge_params)
+        stage = self.stage('raster', functools.partial(raster_tile, export_asc=c.export_asc), functools.partial(raster_artifact, export_asc=c.export_asc))
+        scheduler.run_pipeline([tile], [stage])
+
+    def crop(self, tiles: list, bbox):
+        # A tile for the part of the DEMs inside bbox, read out of only the tiles it overlaps
+        c = self.config
+        index = tile_index.TileIndex.build([t.dtm_name for t in tiles], self.path('DTM', tile_index.INDEX_FILE))
+        sources = index.query(bbox)
+        if not sources:
+            print(f'No tiles overlap {bbox}, nothing to crop.')
+            return []
+        tile = Tile(tile_index.bbox_name(bbox), root=c.work_dir)
+        print(f'\nCropping {tile.name} out of {len(sources)} of {len(tiles)} tiles...\n')
+        params = {'bbox': list(bbox)}
+        if self.cache.is_fresh('crop', [tile.dtm_name], sources, params):
+            print(f'{tile.dtm_name} is up to date, skipping...')
+            self.tracer.cached('crop', tile.name)
+        else:
+            with self.tracer.span('crop', tile.name, sources, [tile.dtm_name]):
+                header, grid = tile_index.crop(sources, bbox)
+                asc_parse.write_dtm(tile.dtm_name, header, grid)
+            self.cache.record('crop', [tile.dtm_name], sources, params)
+        stage = self.stage('raster', functools.partial(raster_tile, export_asc=c.export_asc), functools.partial(raster_artifact, export_asc=c.export_asc))
+        scheduler.run_pipeline([tile], [stage])
+        return [tile]
+
+    def run(self, tiles: list = None):
+        """
+        Run every stage for every tile, the ones in the input list unless tiles
+        are given.  Returns the tiles that made it through and a list of
+        (stage name, tile, exception) for the ones that didn't.  The models and
+        previews that were made are left in self.outputs.
+        """
+        # One pool of STL workers is shared by every tile, started before any big
+        # rasters are loaded so the forked workers stay small.  It's closed however
+        # the run ends, unless it was passed in to be kept warm.
+        own_pool = stlgenerator.StlWorkerPool() if self.config.generate_stls and self.stl_pool is None else None
+        try:
+            return self._run(tiles, own_pool or self.stl_pool)
+        finally:
+            if own_pool is not None:
+                own_pool.close()
+            # Whatever was built before a failure is still skipped next time
+            self.cache.flush()
+
+    def _run(self, tiles: list, stl_pool: stlgenerator.StlWorkerPool):
+        c = self.config
+        tiles = self.tiles = self.read_tiles() if tiles is None else list(tiles)
+        for d in ('LAS', 'DTM', 'ASC') if c.export_asc else ('LAS', 'DTM'):
+            os.makedirs(self.path(d), exist_ok=True)
+
+        # Each tile moves through the stages on its own, so one slow download or one
+        # big tile doesn't hold up every other tile the way a barrier between phases would.
+        # Stages skip any tile whose outputs were already built from the same inputs and settings.
+        stages = [
+            self.stage('download', functools.partial(download_tile, downloader=self.downloader), download_artifact),
+            self.stage('unzip', functools.partial(unzip_tile, stream_zips=c.stream_zips), functools.partial(unzip_artifact, stream_zips=c.stream_zips)),
+            self.stage('decode', decode_tile, decode_artifact),
+        ]
+        stl_options = self.stl_options
+        grid_options = self.grid_options
+        if not c.merge_las:
+            stages.append(self.stage('grid', functools.partial(grid_tile, **grid_options), functools.partial(grid_artifact, **grid_options), in_process=c.gridder == 'native'))
+            stages.append(self.stage('raster', functools.partial(raster_tile, export_asc=c.export_asc), functools.partial(raster_artifact, export_asc=c.export_asc)))
+            if c.generate_stls and c.base_elevation is not None and c.bbox is None:
+                stages.append(self.stage('stl', functools.partial(stl_tile, pool=stl_pool, lowest_value=c.base_elevation, **stl_options), functools.partial(stl_artifact, lowest_value=c.base_elevation, **stl_options)))
+
+        print("\nProcessing tiles...\n")
+        finished, failures = scheduler.run_pipeline(tiles, stages, executor=self.executor)
+        self.cache.flush()
+        order = {t.name: i for i, t in enumerate(tiles)}
+        finished.sort(key=lambda t: order[t.name])
+        for stage, tile, error in failures:
+            print(f'{tile.name} failed during {stage}: {error!r}')
+        if not c.external_files:
+            print(self.downloader.report())
+
+        list_of_las = [t.zip_name if c.stream_zips else t.las_name for t in finished]
+        models = finished
+        if c.merge_las and finished:
+            models = finished[:1]
+            self.merge(finished[0], list_of_las)
+        if c.bbox is not None:
+            models = self.crop(models, c.bbox)
+        list_of_dtm = [t.dtm_name for t in models]
+
+        if c.qgis_compatible_dem:
+            install_lastools()
+            # Use lastools to generate the prj file that QGIS will need.  A
+            # merged or cropped DEM gets the first point cloud's.
+            for l, t in zip(list_of_las, models):
+                instrument.run_tool(f'{BLAST2DEM_EXE} -i {l} -oasc')
+                shutil.copy(os.path.splitext(l)[0] + '.prj', self.path('ASC', f'{t.name}.prj'))
+
+        # Unless the STLs were already made in the pipeline, they have to wait for
+        # every tile so they can all share the lowest elevation as their base.
+        if c.generate_stls and list_of_dtm and (c.merge_las or c.bbox is not None or c.base_elevation is None):
+            lowest_value = asc_parse.base_for_stls(list_of_dtm, lowest_value=c.base_elevation)
+            stl_failures = self.mesh_tiles(models, stl_pool, lowest_value=lowest_value, **stl_options)
+            for stage, tile, error in stl_failures:
+                print(f'{tile.name} failed during {stage}: {error!r}')
+            failures.extend(stl_failures)
+            self.cache.flush()
+        if c.generate_stls:
+            # Only the models that were actually built, not ones left over from a run before a failure
+            failed = {t.name for _, t, _ in failures}
+            names = [s for t in models if t.name not in failed for s in asc_parse.stl_names(t.name, c.lods, c.mesh_format, self.path('STL'))]
+            self.outputs = [s for s in names if os.path.exists(s)]
+
+        if c.preview and list_of_dtm:
+            lowest_value = asc_parse.base_for_stls(list_of_dtm, lowest_value=c.base_elevation)
+            directory = self.path(preview.PREVIEW_DIR)
+            for tile in models:
+                names = preview.preview_names(tile.name, c.mesh_format, directory)
+                with self.tracer.span('preview', tile.name, [tile.dtm_name], names):
+                    preview.gen_preview(tile.dtm_name, tile.name, lowest_value, c.reduce_by, c.vertical_scale, c.base_height, c.mesh_format, directory=directory)
+                self.outputs.extend(names)
+            print(f'\nPreviews saved in {directory or "."}, run again without --preview to make the full resolution models.')
+
+        if c.cache_stats:
+            print(self.cache.report())
+        print(f'\nTime spent in each stage (every span is logged to {self.tracer.trace_file}):')
+        print(self.tracer.summary())
+
+        # Delete the directory used for the intermediate steps.  The .dtm files
+        # are the DEMs themselves now, so they're always kept.
+        print("Cleaning up...")
+        if c.delete_las:
+            shutil.rmtree(self.path('LAS'))
+        return finished, failures
+
+
+def build_parser(description: str = 'A utility for automatically generating 3D printable STLs from USGS lidar scans.'):
+    parser = argparse.ArgumentParser(description=description)
+    # Just in case the user doesn't pass in the file name, assume it's what the USGS names it.
+    parser.add_argument('--input', '-i', type=str, default='downloadlist.txt', help='The name of the file containing the URLs of all of the lidar scan data.')
+    parser.add_argument('--reduce', '-r', type=float, default=REDUCE_BY, help='A decimal value that will decrease the output file size as it increases.  The default value is 1.0')
+    parser.add_argument('--vscale', '-v', type=float, default=VERTICAL_SCALE, help='A decimal value that will make artificially make things taller as it increases.  The default value is 1.0')
+    parser.add_argument('--base', '-b', type=float, default=BASE_HEIGHT, help='A decimal value that sets the base height of the model.  The default value is 0.0')
+    parser.add_argument('--merge', '-m', action='store_true', help='Using this flag will merge all of the point clouds into one file before converting into a DEM.')
+    parser.add_argument('--no_stl', '-s', action='store_false', help='Using this flag will disable STL generation.')
+    parser.add_argument('--no_asc', action='store_false', help='Using this flag will skip exporting the DEMs as ASCII grids.  STLs are made straight from the binary .dtm files in the DTM directory either way, so the ASCs are only needed for other tools.  --prj always exports them.')
+    parser.add_argument('--preview', action='store_true', help='Using this flag will only make a quick preview of each model in the PREVIEW directory: a shaded relief PNG and a small STL from a low resolution view of the DEM, with the same base and vertical scale the full models get.  Run again without it once you\'re happy with the settings, and only the models are made.')
+    parser.add_argument('--cleanup', '-c', action='store_true', help='Using this flag will cause the program to automatically delete the unzipped point cloud files after running.')
+    parser.add_argument('--filter', '-f', type=float, default=False, help='A percent value (0-100, for the slope of the points being smoothed) that will enable the spike smoothing option.  This is good if you have points that are floating way up above the model and causing spikes in your final model.')
+    parser.add_argument('--prj', '-p', action='store_true', help='Using this flag will cause the program to automatically download and use lastools to generate projection files for the elevation models.  This is important if you want to generate the STLs yourself in QGIS, but it means you\'ll have to be mindful of lastool\'s license limitations.  More info on lastool\'s website.')
+    parser.add_argument('--external_files', '-e', action='store_true', default=False, help='Using this flag will grab las/laz files from the LAS directory instead of downloading them from an input list.')
+    parser.add_argument('--gridder', '-g', choices=['native', 'fusion'], default=GRIDDER, help='Which gridder turns the point clouds into DEMs.  "native" is built in and runs anywhere, "fusion" uses GridSurfaceCreate64.exe (Windows only).  The default is native.')
+    parser.add_argument('--grid_method', choices=las_grid.GRID_METHODS, default=GRID_METHOD, help='How the native gridder combines the points that land in each cell.  The default is mean.')
+    parser.add_argument('--ground_only', action='store_true', help='Using this flag will make the native gridder only use points classified as ground.')
+    parser.add_argument('--max_error', type=float, default=MAX_ERROR, help='A decimal value (in mm) that enables mesh simplification.  Flat areas of the model are drawn with fewer, larger triangles, but the surface never strays further than this from the full resolution model.')
+    parser.add_argument('--format', choices=stlgenerator.FORMATS, default=MESH_FORMAT, help='The file format for the 3D models.  ply and 3mf share vertices between triangles, so they\'re several times smaller than stl and faster to write and load.  The default is stl.')
+    parser.add_argument('--max_memory', '--max-memory', type=float, default=MAX_MEMORY, help='A memory budget in MB for making the 3D models.  Lots of small tiles are meshed side by side, as many at once as fit in the budget, while big ones are meshed one at a time with their rows split across every core.  The default is 4096.')
+    parser.add_argument('--lods', type=pyramid.parse_lods, default=LODS, help='A comma separated list of levels of detail to generate STLs for, like 1,2,4.  Each level averages that many cells together in each direction, so the DEM only has to be gridded once at full resolution.  The default is 1.')
+    parser.add_argument('--base_elevation', type=float, default=BASE_ELEVATION, help='The elevation to use as the bottom of every STL.  By default the lowest point in all of the data is used, which means STLs can only be made once every tile is gridded.  Setting this lets STLs be made while other tiles are still downloading.')
+    parser.add_argument('--bbox', type=tile_index.parse_bbox, default=BBOX, help='A bounding box to make one model of, as min_x,min_y,max_x,max_y in the same coordinates as the point clouds.  Only the tiles that overlap it are read, and only the parts of them inside it, so it\'s quick to model a small area out of a big download.')
+    parser.add_argument('--stage_workers', type=functools.partial(scheduler.parse_stage_workers, names=list(STAGE_WORKERS)), default={}, help='How many tiles each stage of the pipeline may work on at once, like download=16,grid=4.  The stages are download, unzip, decode, grid, raster and stl.')
+    parser.add_argument('--stream_zips', action='store_true', help='Using this flag will make the native gridder read the point clouds straight out of the downloaded zip files, without extracting LAS files to disk first.  The zips have to contain LAS files (not LAZ), and it can\'t be combined with --prj.')
+    parser.add_argument('--cache_stats', '--cache-stats', action='store_true', help='Using this flag will print how many steps of each stage were skipped because their outputs were already built from the same inputs and settings.')
+    parser.add_argument('--trace', type=str, default=instrument.TRACE_FILE, help='The JSON lines file every stage of every tile is logged to, with its time, CPU time, peak memory, input and output file sizes and the exit status of any tools it ran.  The default is trace.jsonl.')
+    parser.add_argument('--profile', type=str, default=None, help='A directory to save cProfile data for every stage of every tile to, as <stage>-<tile>.prof.')
+    #parser.add_argument('--help', '-h', action='help')
+    return parser
+
+
+def config_from_args(args):
+    return Config(
+        input=args.input,
+        external_files=args.external_files,
+        reduce_by=args.reduce,
+        vertical_scale=args.vscale,
+        base_height=args.base,
+        merge_las=args.merge,
+        generate_stls=args.no_stl,
+        preview=args.preview,
+        export_asc=args.no_asc,
+        delete_las=args.cleanup,
+        qgis_compatible_dem=args.prj,
+        filter=args.filter,
+        gridder=args.gridder,
+        grid_method=args.grid_method,
+        ground_only=args.ground_only,
+        max_error=args.max_error,
+        max_memory=args.max_memory,
+        mesh_format=args.format,
+        lods=args.lods,
+        base_elevation=args.base_elevation,
+        bbox=args.bbox,
+        stage_workers=args.stage_workers,
+        stream_zips=args.stream_zips,
+        cache_stats=args.cache_stats,
+        trace=args.trace,
+        profile=args.profile,
+    )
+
+
+def main():
+    args = build_parser().parse_args()
+    Pipeline(config_from_args(args)).run()
 
 if __name__ == "__main__":
     if sys.platform.startswith('win'):
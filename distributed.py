@@ -0,0 +1,444 @@
+"""
+Runs one download list across any number of machines.  A coordinator holds
+the queue of tiles and leases them out over TCP to workers, which run the
+pipeline on each tile in a work directory of their own and report back.
+
+    python distributed.py --listen 0.0.0.0:7654 -i downloadlist.txt --vscale 2
+    python distributed.py --worker coordinator-host:7654 --work_dir work
+
+Every pipeline flag is given to the coordinator, workers are sent the
+settings when they connect.  Tiles go through two rounds: first workers
+download and grid them and report each tile's elevation stats, which the
+coordinator reduces to the one base every model shares, then the tiles are
+leased out again to be meshed.  A tile goes back to the worker that gridded
+it, since anywhere else it has to be downloaded and gridded again.  With
+--base_elevation there's nothing to wait for, and tiles go through in one
+round.
+
+Workers heartbeat while they're connected.  When one goes quiet for longer
+than a lease its tiles are queued again for the others, and a tile that
+fails MAX_ATTEMPTS times is given up on.  Messages are JSON, one per line.
+There's no authentication, so only listen on a network you trust.
+"""
+
+import dataclasses
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import asc_parse
+import convert
+from stltools import stlgenerator
+
+PORT = 7654
+
+# A worker that hasn't been heard from in this long has its tiles leased to someone else
+LEASE_SECONDS = 60.0
+HEARTBEAT_SECONDS = 10.0
+
+MAX_ATTEMPTS = 3
+
+# How long a worker waits to ask again when there's nothing to lease yet
+WAIT_SECONDS = 2.0
+
+RESULTS_FILE = 'distributed_results.json'
+
+# These need every tile in one place, so they can't be split up between workers
+UNSUPPORTED = {'merge_las': '--merge', 'bbox': '--bbox', 'external_files': '--external_files'}
+
+
+def parse_address(text: str):
+    # "host:port" -> (host, port)
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port) if port else PORT
+
+
+def send(f, message: dict):
+    f.write(json.dumps(message).encode() + b'\n')
+    f.flush()
+
+
+def receive(f):
+    line = f.readline()
+    if not line:
+        raise ConnectionError('The connection was closed')
+    return json.loads(line)
+
+
+def request(address, message: dict, timeout: float = 30.0):
+    # One message and its reply, on a connection of its own
+    with socket.create_connection(address, timeout=timeout) as s, s.makefile('rwb') as f:
+        send(f, message)
+        return receive(f)
+
+
+@dataclass
+class Task:
+    # One round of one tile
+    round: str
+    name: str
+    url: str
+    status: str = 'queued'
+    worker: str = None
+    lease: str = None
+    expires: float = 0.0
+    attempts: int = 0
+    # The worker that gridded the tile, it already has the DEM
+    affinity: str = None
+    result: dict = None
+    error: str = None
+
+    @property
+    def id(self):
+        return f'{self.round}:{self.name}'
+
+
+class Coordinator:
+    """
+    The tile queue, the leases on it, and the reduce that finds the base.
+    handle() takes each message from a worker and returns the reply, under a
+    lock, so it can be called from every connection's thread.
+    """
+    def __init__(self, config: convert.Config, tiles: list, lease_seconds: float = LEASE_SECONDS, heartbeat_seconds: float = HEARTBEAT_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        for key, flag in UNSUPPORTED.items():
+            if getattr(config, key):
+                raise ValueError(f'{flag} can\'t be used with distributed runs')
+        self.config = config
+        resolved = config.resolved()
+        self.make_models = resolved.generate_stls or resolved.preview
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.base_elevation = config.base_elevation
+        # With a base there's no reduce to wait for, so each tile is made start to finish in one go
+        first_round = 'model' if self.make_models and self.base_elevation is not None else 'grid'
+        self.tasks = [Task(first_round, t.name, t.url) for t in tiles]
+        self.workers = {}
+        self.dismissed = set()
+        self.leases = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.started = time.time()
+        self.check_finished()
+
+    @property
+    def settings(self):
+        # What workers run the pipeline with, each in its own work directory
+        settings = dataclasses.asdict(self.config)
+        for key in ('input', 'work_dir'):
+            del settings[key]
+        return settings
+
+    def handle(self, message: dict):
+        op = message.get('op')
+        with self.lock:
+            worker = message.get('worker')
+            if worker is not None:
+                self.workers[worker] = time.time()
+            self.expire()
+            if op == 'hello':
+                return self.hello(message)
+            if op == 'lease':
+                return self.lease(worker)
+            if op == 'heartbeat':
+                return self.heartbeat(worker)
+            if op == 'report':
+                return self.report(worker, message)
+            if op == 'status':
+                return self.status()
+        return {'error': f'Unknown op {op!r}'}
+
+    def hello(self, message: dict):
+        worker = f'{message.get("host", "?")}-{message.get("pid", 0)}-{len(self.workers)}'
+        self.workers[worker] = time.time()
+        print(f'Worker {worker} joined')
+        return {'worker': worker, 'settings': self.settings, 'heartbeat': self.heartbeat_seconds}
+
+    def alive(self, worker: str):
+        return worker in self.workers and time.time() - self.workers[worker] <= self.lease_seconds
+
+    def lease(self, worker: str):
+        if self.finished.is_set():
+            self.dismissed.add(worker)
+            return {'done': True}
+        queued = [t for t in self.tasks if t.status == 'queued']
+        # A tile someone else gridded is only taken off them if they're gone
+        task = next((t for t in queued if t.affinity in (None, worker) or not self.alive(t.affinity)), None)
+        if task is None:
+            return {'wait': WAIT_SECONDS}
+        self.leases += 1
+        task.status, task.worker, task.lease = 'leased', worker, f'{task.id}:{self.leases}'
+        task.expires = time.time() + self.lease_seconds
+        task.attempts += 1
+        print(f'Leased {task.id} to {worker} (attempt {task.attempts})')
+        return {'task': {'round': task.round, 'name': task.name, 'url': task.url, 'lease': task.lease, 'base_elevation': self.base_elevation}}
+
+    def heartbeat(self, worker: str):
+        now = time.time()
+        held = []
+        for t in self.tasks:
+            if t.status == 'leased' and t.worker == worker:
+                t.expires = now + self.lease_seconds
+                held.append(t.lease)
+        return {'ok': True, 'leases': held}
+
+    def report(self, worker: str, message: dict):
+        task = next((t for t in self.tasks if t.lease is not None and t.lease == message.get('lease')), None)
+        if task is None or task.status != 'leased':
+            # The lease ran out and the tile went to someone else
+            return {'ok': False}
+        task.lease = None
+        if message.get('ok'):
+            task.status, task.result, task.error = 'done', message.get('result'), None
+            print(f'{task.id} done by {worker}')
+        else:
+            task.error = message.get('error')
+            task.status = 'failed' if task.attempts >= self.max_attempts else 'queued'
+            print(f'{task.id} failed on {worker}: {task.error}' + (', giving up' if task.status == 'failed' else ', trying again'))
+        self.check_finished()
+        return {'ok': True}
+
+    def expire(self):
+        now = time.time()
+        for t in self.tasks:
+            if t.status == 'leased' and t.expires < now:
+                print(f'Lease on {t.id} held by {t.worker} ran out')
+                t.lease, t.error = None, f'Lease held by {t.worker} ran out'
+                t.status = 'failed' if t.attempts >= self.max_attempts else 'queued'
+        self.check_finished()
+
+    def check_finished(self):
+        if self.finished.is_set() or any(t.status in ('queued', 'leased') for t in self.tasks):
+            return
+        gridded = [t for t in self.tasks if t.round == 'grid' and t.status == 'done']
+        if self.make_models and gridded and not any(t.round == 'model' for t in self.tasks):
+            self.reduce(gridded)
+            self.tasks.extend(Task('model', t.name, t.url, affinity=t.worker) for t in gridded)
+            return
+        self.finished.set()
+
+    def reduce(self, gridded: list):
+        # The base every model shares is the lowest of the lowest points workers found in their tiles
+        lowest_value = asc_parse.lowest_elevation({t.name: t.result['stats'] for t in gridded})
+        if lowest_value is not None:
+            print(f'Lowest elevation found: {lowest_value}, using for base for all STLs')
+        else:
+            lowest_value = 0.0
+            print(f'DEM Missing data!  Needs further adjustment.  Setting lowest value to 0.')
+        self.base_elevation = float(lowest_value)
+
+    def status(self):
+        rounds = {}
+        for t in self.tasks:
+            counts = rounds.setdefault(t.round, {})
+            counts[t.status] = counts.get(t.status, 0) + 1
+        return {'rounds': rounds, 'workers': sorted(w for w in self.workers if self.alive(w)), 'base_elevation': self.base_elevation, 'finished': self.finished.is_set()}
+
+    def results(self):
+        tiles = {}
+        for t in self.tasks:
+            entry = tiles.setdefault(t.name, {'name': t.name, 'url': t.url})
+            entry[t.round] = {'status': t.status, 'worker': t.worker, 'attempts': t.attempts, 'result': t.result, 'error': t.error}
+        return {'base_elevation': self.base_elevation, 'seconds': time.time() - self.started, 'tiles': list(tiles.values())}
+
+    def failures(self):
+        return [t for t in self.tasks if t.status == 'failed']
+
+    def waiting_on(self):
+        # Workers still around that haven't been told the run is over
+        return [w for w in self.workers if self.alive(w) and w not in self.dismissed]
+
+
+class Handler(socketserver.StreamRequestHandler):
+    # self.server.coordinator is the Coordinator
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.coordinator.handle(json.loads(line))
+            except (ValueError, TypeError, AttributeError) as e:
+                reply = {'error': repr(e)}
+            send(self.wfile, reply)
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(coordinator: Coordinator, host: str = '127.0.0.1', port: int = PORT):
+    # A TCP server for workers, call serve_forever() on it, or run it in a thread
+    server = CoordinatorServer((host, port), Handler)
+    server.coordinator = coordinator
+    return server
+
+
+def run_task(task: dict, settings: dict, work_dir: str, stl_pool, executor):
+    """
+    Run one round of one tile through the pipeline.  A grid round stops at
+    the DEM and reports its elevation stats, a model round is given the base.
+    """
+    tile = convert.Tile(task['name'], task['url'], work_dir)
+    # --cleanup would delete the whole LAS directory, out from under other tiles this
+    # worker has gridded but not meshed yet, so only this tile's LAS file is deleted, once it's done
+    if task['round'] == 'grid':
+        config = convert.Config(**{**settings, 'generate_stls': False, 'preview': False, 'delete_las': False}, work_dir=work_dir)
+    else:
+        config = convert.Config(**{**settings, 'base_elevation': task['base_elevation'], 'delete_las': False}, work_dir=work_dir)
+    pipeline = convert.Pipeline(config, stl_pool=stl_pool, executor=executor)
+    _, failures = pipeline.run([tile])
+    if failures:
+        stage, _, error = failures[0]
+        raise RuntimeError(f'{stage}: {error!r}')
+    if task['round'] == 'model' and settings.get('delete_las') and os.path.exists(tile.las_name):
+        os.remove(tile.las_name)
+
+    result = {'host': socket.gethostname()}
+    if task['round'] == 'grid':
+        stats = asc_parse.tile_stats(tile.dtm_name)
+        result['stats'] = {k: stats[k] for k in ('nrows', 'ncols', 'min', 'max', 'nodata')}
+        outputs = [tile.dtm_name] + ([tile.asc_name] if pipeline.config.export_asc else [])
+    else:
+        outputs = pipeline.outputs
+    result['outputs'] = [{'file': os.path.abspath(o), 'bytes': os.path.getsize(o)} for o in outputs if os.path.exists(o)]
+    return result
+
+
+def run_worker(address, work_dir: str = '', processes: int = None):
+    """
+    Lease tiles from the coordinator at address and run them until it says
+    the run is over, or can't be reached for longer than a lease.
+    """
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    # The pools fork, so they're started before the heartbeat thread, and kept warm for every tile
+    stl_pool = stlgenerator.StlWorkerPool(processes)
+    executor = ProcessPoolExecutor(stl_pool.processes)
+    stopped = threading.Event()
+    try:
+        hello = request(address, {'op': 'hello', 'host': socket.gethostname(), 'pid': os.getpid()})
+        worker, settings = hello['worker'], hello['settings']
+        print(f'Joined {address[0]}:{address[1]} as {worker}')
+
+        def beat():
+            while not stopped.wait(hello['heartbeat']):
+                try:
+                    request(address, {'op': 'heartbeat', 'worker': worker})
+                except OSError as e:
+                    print(f'Heartbeat failed: {e!r}')
+
+        threading.Thread(target=beat, daemon=True).start()
+        last_contact = time.monotonic()
+        while True:
+            try:
+                reply = request(address, {'op': 'lease', 'worker': worker})
+            except OSError as e:
+                if time.monotonic() - last_contact > LEASE_SECONDS:
+                    print(f'Lost the coordinator: {e!r}')
+                    return
+                time.sleep(WAIT_SECONDS)
+                continue
+            last_contact = time.monotonic()
+            if reply.get('done'):
+                print('The coordinator has no more tiles, stopping.')
+                return
+            if 'task' not in reply:
+                time.sleep(reply.get('wait', WAIT_SECONDS))
+                continue
+
+            task = reply['task']
+            print(f'\nWorking on {task["round"]} of {task["name"]}\n')
+            report = {'op': 'report', 'worker': worker, 'lease': task['lease']}
+            try:
+                report.update(ok=True, result=run_task(task, settings, work_dir, stl_pool, executor))
+            except Exception as e:
+                print(f'{task["name"]} failed: {e!r}')
+                report.update(ok=False, error=repr(e))
+            try:
+                if not request(address, report).get('ok'):
+                    print(f'The lease on {task["name"]} ran out before it was done, the coordinator gave it to someone else.')
+            except OSError as e:
+                print(f'Couldn\'t report {task["name"]}: {e!r}')
+    finally:
+        stopped.set()
+        executor.shutdown()
+        stl_pool.close()
+
+
+def start_local_workers(count: int, address, work_dir: str = 'workers', processes: int = None):
+    # Worker processes on this machine, each in a directory of its own
+    host = '127.0.0.1' if address[0] in ('', '0.0.0.0') else address[0]
+    extra = ['--processes', str(processes)] if processes else []
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', f'{host}:{address[1]}', '--work_dir', os.path.join(work_dir, f'worker{i}')] + extra)
+            for i in range(count)]
+
+
+def run_coordinator(coordinator: Coordinator, address, local_workers: int = 0, results_file: str = RESULTS_FILE, processes: int = None):
+    server = serve(coordinator, *address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The port the server really got, if it was asked for any free one with port 0
+    address = (address[0], server.server_address[1])
+    print(f'Coordinating {len(coordinator.tasks)} tiles on {address[0]}:{address[1]}')
+    workers = start_local_workers(local_workers, address, processes=processes)
+    try:
+        # Leases run out even when no worker is around to ask for one
+        while not coordinator.finished.wait(1.0):
+            with coordinator.lock:
+                coordinator.expire()
+        # Stay up long enough to tell the workers still around that it's over
+        deadline = time.monotonic() + coordinator.lease_seconds
+        while time.monotonic() < deadline:
+            with coordinator.lock:
+                if not coordinator.waiting_on():
+                    break
+            time.sleep(0.5)
+        for w in workers:
+            w.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(results_file, 'w') as f:
+        json.dump(coordinator.results(), f, indent=1)
+    failures = coordinator.failures()
+    done = len({t.name for t in coordinator.tasks} - {t.name for t in failures})
+    print(f'\n{done} of {len({t.name for t in coordinator.tasks})} tiles done in {time.time() - coordinator.started:.1f}s, results saved to {results_file}')
+    for t in failures:
+        print(f'{t.name} failed during {t.round}: {t.error}')
+    return failures
+
+
+def main():
+    parser = convert.build_parser('Runs mini-map-maker across several machines.  Start a coordinator with the usual flags, then workers pointed at it.')
+    parser.add_argument('--listen', type=parse_address, default=('127.0.0.1', PORT), help=f'The address the coordinator listens for workers on, as host:port.  The default is 127.0.0.1:{PORT}, so only workers on this machine can connect, use 0.0.0.0:{PORT} to let other machines in.')
+    parser.add_argument('--worker', type=parse_address, default=None, help='Using this flag will run a worker for the coordinator at host:port instead of a coordinator.  Workers are sent their settings by the coordinator, so any pipeline flags given to them are ignored.')
+    parser.add_argument('--work_dir', type=str, default='', help='The directory a worker keeps its files in.  The default is the current directory.')
+    parser.add_argument('--local_workers', type=int, default=0, help='How many workers the coordinator starts on this machine, in workers/worker<n>.  The default is 0, workers are started separately.')
+    parser.add_argument('--processes', type=int, default=None, help='How many processes each worker meshes and grids with.  The default is one per core.')
+    parser.add_argument('--lease', type=float, default=LEASE_SECONDS, help=f'How long in seconds a worker can go without a heartbeat before its tiles are given to other workers.  The default is {LEASE_SECONDS:g}.')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_SECONDS, help=f'How often in seconds workers check in with the coordinator.  The default is {HEARTBEAT_SECONDS:g}.')
+    parser.add_argument('--results', type=str, default=RESULTS_FILE, help=f'The JSON file the coordinator saves what happened to every tile to: who made it, its elevation stats and its output files.  The default is {RESULTS_FILE}.')
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args.worker, args.work_dir, args.processes)
+        return
+    config = convert.config_from_args(args)
+    try:
+        coordinator = Coordinator(config, convert.read_download_list(config.input), args.lease, args.heartbeat)
+    except ValueError as e:
+        parser.error(str(e))
+    if run_coordinator(coordinator, args.listen, args.local_workers, args.results, args.processes):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if sys.platform.startswith('win'):
+        multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,234 @@
+"""
+A resumable, concurrent download engine.
+
+Files are downloaded to a .part file next to their destination and only
+renamed into place once their size (and ETag, when it's a plain MD5) checks
+out, so a file that exists is always complete.  Interrupted transfers pick
+up where they left off with HTTP Range requests, failures are retried with
+exponential backoff, and each thread keeps one open connection per host.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+CHUNK_SIZE = 1024 * 1024
+
+# Statuses worth trying again, anything else in the 4xx range is final
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+class DownloadError(Exception):
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+@dataclass
+class DownloadResult:
+    url: str
+    file_name: str
+    bytes: int = 0
+    seconds: float = 0.0
+    resumed_from: int = 0
+    skipped: bool = False
+    attempts: int = 0
+
+
+def _parse_content_range(value):
+    # "bytes 100-199/1000" -> (100, 1000), the total may be "*"
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', value or '')
+    if not match:
+        return None, None
+    return int(match.group(1)), None if match.group(2) == '*' else int(match.group(2))
+
+
+def _etag_md5(etag):
+    # Single part S3 uploads use the MD5 of the content as their ETag
+    etag = (etag or '').strip('"')
+    return etag.lower() if re.fullmatch(r'[0-9a-fA-F]{32}', etag) else None
+
+
+class Downloader:
+    def __init__(self, concurrency: int = 8, retries: int = 5, backoff: float = 1.0, timeout: float = 60, progress_interval: float = 5.0):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.results = []
+        self._slots = threading.Semaphore(concurrency)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started = None
+
+    def _connection(self, scheme, netloc):
+        # One connection per host per thread, kept open between files
+        connections = self._local.__dict__.setdefault('connections', {})
+        key = (scheme, netloc)
+        if key not in connections:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connections[key] = cls(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def _drop_connection(self, url):
+        parts = urllib.parse.urlsplit(url)
+        connections = self._local.__dict__.get('connections', {})
+        connection = connections.pop((parts.scheme, parts.netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _request(self, url, headers):
+        for _ in range(10):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                # A kept-alive connection the server already closed, drop it and let the retry reconnect
+                self._drop_connection(url)
+                raise
+            if response.status not in REDIRECT_STATUSES:
+                return url, response
+            response.read()
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+        raise DownloadError(f'Too many redirects for {url}', retry=False)
+
+    def download(self, url: str, file_name: str):
+        """Download url to file_name, resuming any earlier partial download.  Thread safe."""
+        with self._lock:
+            self._started = self._started or time.perf_counter()
+        if os.path.exists(file_name):
+            print(f"{file_name} already downloaded, skipping...")
+            result = DownloadResult(url, file_name, skipped=True)
+            with self._lock:
+                self.results.append(result)
+            return result
+
+        with self._slots:
+            result = DownloadResult(url, file_name)
+            start = time.perf_counter()
+            for attempt in range(self.retries + 1):
+                result.attempts = attempt + 1
+                try:
+                    self._attempt(url, file_name, result)
+                    break
+                except (OSError, http.client.HTTPException, DownloadError) as e:
+                    self._drop_connection(url)
+                    if attempt == self.retries or (isinstance(e, DownloadError) and not e.retry):
+                        raise
+                    delay = self.backoff * 2 ** attempt
+                    print(f'Download of {url} failed ({e!r}), retrying in {delay:.1f}s')
+                    time.sleep(delay)
+            result.seconds = time.perf_counter() - start
+
+        rate = result.bytes / max(result.seconds, 1e-9) / 1e6
+        resumed = f', resumed at {result.resumed_from / 1e6:.1f} MB' if result.resumed_from else ''
+        print(f"Downloaded {url} ({result.bytes / 1e6:.1f} MB in {result.seconds:.1f}s, {rate:.1f} MB/s{resumed})")
+        with self._lock:
+            self.results.append(result)
+        return result
+
+    def _attempt(self, url, file_name, result):
+        part_name = file_name + '.part'
+        meta_name = part_name + '.json'
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        meta = {}
+        if offset and os.path.exists(meta_name):
+            with open(meta_name) as f:
+                meta = json.load(f)
+
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            # If the file changed on the server, If-Range makes it send the whole new file
+            if meta.get('etag'):
+                headers['If-Range'] = meta['etag']
+        url, response = self._request(url, headers)
+
+        if response.status == 416:
+            # The part is already as long as (or longer than) the file, start over
+            response.read()
+            os.remove(part_name)
+            raise DownloadError(f'Range not satisfiable for {url}')
+        if response.status == 206:
+            start, total = _parse_content_range(response.getheader('Content-Range'))
+            if start != offset:
+                response.read()
+                os.remove(part_name)
+                raise DownloadError(f'Server resumed {url} at the wrong offset')
+        elif response.status == 200:
+            # Either a fresh download, or the server ignored the range request
+            offset = 0
+            length = response.getheader('Content-Length')
+            total = int(length) if length is not None else None
+        else:
+            response.read()
+            raise DownloadError(f'HTTP {response.status} for {url}', retry=response.status in RETRY_STATUSES or response.status >= 500)
+
+        etag = response.getheader('ETag')
+        with open(meta_name, 'w') as f:
+            json.dump({'url': url, 'etag': etag, 'total': total}, f)
+
+        result.resumed_from = offset
+        received = offset
+        last_report = time.perf_counter()
+        with open(part_name, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while chunk := response.read1(CHUNK_SIZE):
+                f.write(chunk)
+                received += len(chunk)
+                result.bytes += len(chunk)
+                if total and time.perf_counter() - last_report > self.progress_interval:
+                    last_report = time.perf_counter()
+                    print(f'Downloading {file_name}... {int(received / total * 100)}% Complete')
+            # Finish the response off so the connection can be reused
+            response.read()
+
+        if total is not None and received != total:
+            raise DownloadError(f'{url} ended after {received} of {total} bytes')
+        md5 = _etag_md5(etag)
+        if md5 is not None and self._md5(part_name) != md5:
+            os.remove(part_name)
+            raise DownloadError(f'{url} does not match its ETag')
+
+        os.replace(part_name, file_name)
+        os.remove(meta_name)
+
+    @staticmethod
+    def _md5(file_name):
+        digest = hashlib.md5()
+        with open(file_name, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def download_all(self, urls, file_names):
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return list(executor.map(self.download, urls, file_names))
+
+    def report(self):
+        # Totals for everything this downloader has fetched so far
+        with self._lock:
+            results = list(self.results)
+            elapsed = time.perf_counter() - self._started if self._started else 0
+        fetched = [r for r in results if not r.skipped]
+        total = sum(r.bytes for r in fetched)
+        retried = sum(1 for r in fetched if r.attempts > 1)
+        return (f'Downloaded {len(fetched)} files ({total / 1e6:.1f} MB) in {elapsed:.1f}s, '
+                f'{total / max(elapsed, 1e-9) / 1e6:.1f} MB/s overall, '
+                f'{len(results) - len(fetched)} already present, {retried} needed retries')
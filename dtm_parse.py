@@ -0,0 +1,143 @@
+"""
+Reads and writes the PLANS binary .dtm grids that FUSION's GridSurfaceCreate
+makes, so DEMs never have to go through a text ASC to be used.
+
+A .dtm is a 200 byte little endian header followed by the elevations, one
+column at a time from west to east, each column from south to north.  Cells
+with no data hold -1.
+"""
+
+import struct
+import numpy as np
+from dataclasses import dataclass, replace
+
+SIGNATURE = b'PLANS-PC BINARY .DTM'
+
+HEADER_SIZE = 200
+
+# Elevations are 2 or 4 byte integers, or 4 or 8 byte floats, depending on the header's z bytes code
+Z_TYPES = {
+    0: np.dtype('<i2'),
+    1: np.dtype('<i4'),
+    2: np.dtype('<f4'),
+    3: np.dtype('<f8'),
+}
+
+# Units codes for the horizontal and vertical units
+UNITS = {0: 'feet', 1: 'meters', 2: 'other'}
+
+DTM_NODATA = -1
+
+# Everything up to the vertical datum is in every version, the bias was added in 3.1
+_FIELDS = struct.Struct('<21s61sf7d2i7h')
+_BIAS = struct.Struct('<d')
+
+
+@dataclass
+class DtmHeader:
+    ncols: int
+    nrows: int
+    # The lower left grid point, not the corner of its cell
+    origin_x: float
+    origin_y: float
+    column_spacing: float
+    row_spacing: float
+    min_z: float = 0.0
+    max_z: float = 0.0
+    z_bytes: int = 2
+    horizontal_units: int = 1
+    vertical_units: int = 1
+    name: str = ''
+    version: float = 3.0
+    bias: float = 0.0
+    coordinate_system: int = 0
+    coordinate_zone: int = 0
+    horizontal_datum: int = 0
+    vertical_datum: int = 0
+
+
+def read_dtm_header(f):
+    raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE or not raw.startswith(SIGNATURE):
+        raise ValueError(f'{getattr(f, "name", "input")} is not a PLANS .dtm file')
+    (_, name, version, origin_x, origin_y, min_z, max_z, _rotation, column_spacing, row_spacing,
+     ncols, nrows, horizontal_units, vertical_units, z_bytes, coordinate_system, coordinate_zone,
+     horizontal_datum, vertical_datum) = _FIELDS.unpack_from(raw)
+    if z_bytes not in Z_TYPES:
+        raise ValueError(f'Unsupported .dtm elevation type {z_bytes}')
+    bias = _BIAS.unpack_from(raw, _FIELDS.size)[0] if round(version, 1) >= 3.1 else 0.0
+    return DtmHeader(
+        ncols=ncols,
+        nrows=nrows,
+        origin_x=origin_x,
+        origin_y=origin_y,
+        column_spacing=column_spacing,
+        row_spacing=row_spacing,
+        min_z=min_z,
+        max_z=max_z,
+        z_bytes=z_bytes,
+        horizontal_units=horizontal_units,
+        vertical_units=vertical_units,
+        name=name.split(b'\0')[0].decode(errors='replace').strip(),
+        version=round(version, 2),
+        bias=bias,
+        coordinate_system=coordinate_system,
+        coordinate_zone=coordinate_zone,
+        horizontal_datum=horizontal_datum,
+        vertical_datum=vertical_datum,
+    )
+
+
+def open_dtm(file_name: str):
+    """
+    (header, raw elevations) of a .dtm, with the elevations memory mapped in
+    the file's own layout and type: shape (ncols, nrows), south first.
+    """
+    with open(file_name, 'rb') as f:
+        header = read_dtm_header(f)
+    raw = np.memmap(file_name, dtype=Z_TYPES[header.z_bytes], mode='r', offset=HEADER_SIZE, shape=(header.ncols, header.nrows))
+    return header, raw
+
+
+def to_rows(header: DtmHeader, columns, nodata: float):
+    # Raw columns (west to east, south first) to float32 rows, north first, with voids set to nodata
+    rows = np.asarray(columns).T[::-1]
+    data = rows.astype(np.float32)
+    if header.bias:
+        data += np.float32(header.bias)
+    data[rows == DTM_NODATA] = nodata
+    return data
+
+
+def read_dtm(file_name: str, nodata: float = DTM_NODATA):
+    """Read a .dtm as (header, float32 grid) laid out like an ASC: rows north first, voids set to nodata."""
+    header, raw = open_dtm(file_name)
+    return header, to_rows(header, raw, nodata)
+
+
+def write_dtm(file_name: str, header: DtmHeader, data, nodata: float, band_cols: int = 1024):
+    """
+    Write a grid laid out like an ASC (rows north first, voids set to nodata)
+    as a float .dtm.  It's written a band of columns at a time, so data can be
+    a memory mapped grid bigger than memory.
+    """
+    with open(file_name, 'wb') as f:
+        f.write(b'\0' * HEADER_SIZE)
+        min_z, max_z = np.inf, -np.inf
+        for start in range(0, header.ncols, band_cols):
+            columns = np.asarray(data[::-1, start:start + band_cols], dtype=np.float32).T
+            valid = columns != nodata
+            if valid.any():
+                min_z = min(min_z, float(columns.min(where=valid, initial=np.inf)))
+                max_z = max(max_z, float(columns.max(where=valid, initial=-np.inf)))
+            f.write(np.where(valid, columns, np.float32(DTM_NODATA)).astype('<f4').tobytes())
+
+        min_z, max_z = (min_z, max_z) if min_z <= max_z else (0.0, 0.0)
+        header = replace(header, min_z=min_z, max_z=max_z, z_bytes=2, version=3.0, bias=0.0)
+        f.seek(0)
+        f.write(_FIELDS.pack(
+            SIGNATURE, header.name.encode()[:60], header.version, header.origin_x, header.origin_y,
+            header.min_z, header.max_z, 0.0, header.column_spacing, header.row_spacing,
+            header.ncols, header.nrows, header.horizontal_units, header.vertical_units, header.z_bytes,
+            header.coordinate_system, header.coordinate_zone, header.horizontal_datum, header.vertical_datum,
+        ))
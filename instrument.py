@@ -0,0 +1,187 @@
+"""
+Instrumentation for pipeline runs.  Every stage of every tile runs inside a
+span that records its wall and CPU time, peak RSS, the sizes of its input
+and output files, and the exit status of any external tool it ran.  Spans are appended
+to a JSON-lines trace as they finish (from whichever process ran them), and
+the run's spans are summed up into a table at the end.
+"""
+
+import cProfile
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS just isn't reported there
+    resource = None
+
+TRACE_FILE = 'trace.jsonl'
+
+# The span the current thread is in, so run_tool can report into it
+_current = threading.local()
+
+
+class ToolError(RuntimeError):
+    def __init__(self, command, exit_status):
+        super().__init__(f'{command} exited with status {exit_status}')
+        self.command = command
+        self.exit_status = exit_status
+
+
+def _rss_bytes(maxrss):
+    # ru_maxrss is in kilobytes, except on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _process_peak_rss():
+    return _rss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) if resource else None
+
+
+def _total_size(file_names):
+    return sum(os.path.getsize(f) for f in file_names if os.path.exists(f))
+
+
+def run_tool(command: str):
+    """
+    Run an external tool through the shell, the way os.system did, but record
+    its exit status, time and resources in the current span.  Raises ToolError
+    if it fails, instead of carrying on with whatever it left behind.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, shell=True)
+    cpu = peak_rss = None
+    if hasattr(os, 'wait4'):
+        # Reaping the tool ourselves gets its own resource usage, not the whole process's
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = exit_status = os.waitstatus_to_exitcode(status)
+        cpu = usage.ru_utime + usage.ru_stime
+        peak_rss = _rss_bytes(usage.ru_maxrss)
+    else:
+        exit_status = process.wait()
+
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record['tools'].append({
+            'command': command,
+            'exit_status': exit_status,
+            'wall': time.perf_counter() - start,
+            'cpu': cpu,
+            'peak_rss': peak_rss,
+        })
+    if exit_status != 0:
+        raise ToolError(command, exit_status)
+
+
+class Tracer:
+    """
+    Writes spans for one run to the trace file.  It only holds plain settings,
+    so it can be pickled over to process pool workers along with a stage.
+    """
+    def __init__(self, trace_file: str = TRACE_FILE, profile_dir: str = None):
+        self.trace_file = trace_file
+        self.profile_dir = profile_dir
+        self.run_id = uuid.uuid4().hex
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def write(self, record: dict):
+        # One short append per span, so lines from different processes don't interleave
+        with open(self.trace_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @contextlib.contextmanager
+    def span(self, stage: str, tile: str, inputs=(), outputs=()):
+        record = {'run': self.run_id, 'stage': stage, 'tile': tile, 'start': time.time(), 'tools': []}
+        previous, _current.record = getattr(_current, 'record', None), record
+        profile = cProfile.Profile() if self.profile_dir else None
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Newer pythons only allow one active profiler at a time
+                print(f'Not profiling {stage} for {tile}, another profiler is already running ({e})')
+                profile = None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'failed'
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.thread_time() - cpu + sum(t['cpu'] or 0 for t in record['tools'])
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(os.path.join(self.profile_dir, f'{stage}-{tile}.prof'))
+            _current.record = previous
+
+            peaks = [p for p in [_process_peak_rss()] + [t['peak_rss'] for t in record['tools']] if p is not None]
+            record['peak_rss'] = max(peaks) if peaks else None
+            # The sizes of the files the stage was given and made, not a count of its actual I/O
+            record['input_bytes'] = _total_size(inputs)
+            record['output_bytes'] = _total_size(outputs) if record['status'] == 'ok' else 0
+            statuses = [t['exit_status'] for t in record['tools']]
+            record['exit_status'] = next((s for s in statuses if s != 0), 0) if statuses else None
+            self.write(record)
+
+    def cached(self, stage: str, tile: str):
+        # A stage the build cache skipped still shows up in the trace
+        self.write({'run': self.run_id, 'stage': stage, 'tile': tile, 'start': time.time(), 'status': 'cached',
+                    'wall': 0.0, 'cpu': 0.0, 'peak_rss': None, 'input_bytes': 0, 'output_bytes': 0, 'exit_status': None, 'tools': []})
+
+    def records(self):
+        if not os.path.exists(self.trace_file):
+            return []
+        with open(self.trace_file) as f:
+            return [r for r in map(json.loads, f) if r['run'] == self.run_id]
+
+    def summary(self):
+        stages = {}
+        for r in self.records():
+            s = stages.setdefault(r['stage'], {'ok': 0, 'failed': 0, 'cached': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'input': 0, 'output': 0})
+            s[r['status']] += 1
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu']
+            s['peak_rss'] = max(s['peak_rss'], r['peak_rss'] or 0)
+            s['input'] += r['input_bytes']
+            s['output'] += r['output_bytes']
+
+        lines = [f'{"stage":<10}{"ok":>5}{"failed":>8}{"cached":>8}{"wall s":>10}{"cpu s":>10}{"peak MB":>10}{"input MB":>10}{"output MB":>11}']
+        for name, s in stages.items():
+            lines.append(f'{name:<10}{s["ok"]:>5}{s["failed"]:>8}{s["cached"]:>8}{s["wall"]:>10.1f}{s["cpu"]:>10.1f}'
+                         f'{s["peak_rss"] / 1e6:>10.1f}{s["input"] / 1e6:>10.1f}{s["output"] / 1e6:>11.1f}')
+        return '\n'.join(lines)
+
+
+class Traced:
+    """
+    A pipeline stage function that runs inside a span.  artifact(item) gives
+    the (outputs, inputs, params) of the stage, like the build cache uses, so
+    the sizes of its files can be recorded, or None if there's nothing to do.
+    """
+    def __init__(self, tracer: Tracer, stage: str, func, artifact=None):
+        self.tracer = tracer
+        self.stage = stage
+        self.func = func
+        self.artifact = artifact
+
+    def __call__(self, item):
+        if self.artifact is None:
+            outputs, inputs = (), ()
+        else:
+            files = self.artifact(item)
+            if files is None:
+                # Nothing for this stage to do for the item, so nothing worth a span
+                return self.func(item)
+            outputs, inputs = files[0], files[1]
+        with self.tracer.span(self.stage, getattr(item, 'name', str(item)), inputs, outputs):
+            return self.func(item)
@@ -0,0 +1,423 @@
+"""
+A native replacement for FUSION's GridSurfaceCreate.  Point records are
+memory mapped straight out of LAS 1.2-1.4 files and binned into a DEM
+with vectorized numpy reductions, so no external process is needed.
+"""
+
+import os
+import zipfile
+import numpy as np
+from dataclasses import dataclass
+from multiprocessing import Pool
+from struct import unpack_from
+from asc_parse import AscHeader, NO_DATA
+
+# Point records are binned this many at a time to keep memory bounded on huge files
+CHUNK_SIZE = 4_000_000
+
+# ASPRS classification code for ground points
+GROUND_CLASS = 2
+
+GRID_METHODS = ('min', 'mean', 'max')
+
+
+@dataclass
+class LasHeader:
+    version: tuple
+    point_format: int
+    record_length: int
+    offset_to_points: int
+    point_count: int
+    scale: tuple
+    offset: tuple
+    min_xyz: tuple
+    max_xyz: tuple
+
+
+def is_zip(file_name: str):
+    return file_name.lower().endswith('.zip')
+
+
+def open_las_member(zip_ref: zipfile.ZipFile, zip_name: str = 'zip'):
+    # USGS zips hold a single point cloud, which has to be uncompressed LAS to stream
+    members = [m for m in zip_ref.namelist() if m.lower().endswith('.las')]
+    if not members:
+        raise ValueError(f'{zip_name} has no .las file to stream')
+    return zip_ref.open(members[0])
+
+
+def read_las_header(file_name: str):
+    # LAS files and zips holding one are both accepted, only the header is read either way
+    if is_zip(file_name):
+        with zipfile.ZipFile(file_name) as zip_ref, open_las_member(zip_ref, file_name) as f:
+            return read_las_header_from_stream(f, file_name)
+    with open(file_name, 'rb') as f:
+        raw = f.read(375)
+    return parse_las_header(raw, file_name)
+
+
+def _read_exactly(stream, size: int):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def read_las_header_from_stream(stream, file_name: str = 'LAS data'):
+    """Read the header off a forward-only stream, leaving it at the first point record."""
+    raw = _read_exactly(stream, 227)
+    header_size, = unpack_from('<H', raw, 94)
+    raw += _read_exactly(stream, header_size - len(raw))
+    header = parse_las_header(raw, file_name)
+    # Skip the variable length records between the header and the points
+    _read_exactly(stream, header.offset_to_points - header_size)
+    return header
+
+
+def iter_point_chunks(file_name: str):
+    """
+    Yield (header, records) chunks of at most CHUNK_SIZE points.  LAS files are
+    memory mapped, zips are decompressed on the fly straight out of the member
+    stream (stored or deflated), so the LAS never has to be extracted to disk.
+    """
+    if not is_zip(file_name):
+        header = read_las_header(file_name)
+        points = memmap_points(file_name, header)
+        for start in range(0, len(points), CHUNK_SIZE):
+            yield header, points[start:start + CHUNK_SIZE]
+        del points
+        return
+
+    with zipfile.ZipFile(file_name) as zip_ref, open_las_member(zip_ref, file_name) as f:
+        header = read_las_header_from_stream(f, file_name)
+        dtype  = point_dtype(header)
+        remaining = header.point_count
+        while remaining:
+            count = min(CHUNK_SIZE, remaining)
+            raw = _read_exactly(f, count * header.record_length)
+            if len(raw) < count * header.record_length:
+                raise ValueError(f'{file_name} ended {remaining} points early')
+            remaining -= count
+            yield header, np.frombuffer(raw, dtype=dtype)
+
+
+def parse_las_header(raw: bytes, file_name: str = 'LAS data'):
+    if raw[:4] != b'LASF':
+        raise ValueError(f'{file_name} is not a LAS file')
+    version = unpack_from('<BB', raw, 24)
+    offset_to_points, = unpack_from('<I', raw, 96)
+    point_format, record_length, point_count = unpack_from('<BHI', raw, 104)
+    # The top two bits of the format id flag LAZ compression
+    if point_format & 0x80:
+        raise ValueError(f'{file_name} is compressed, decompress it to LAS first')
+    point_format &= 0x3F
+    scale  = unpack_from('<3d', raw, 131)
+    offset = unpack_from('<3d', raw, 155)
+    max_x, min_x, max_y, min_y, max_z, min_z = unpack_from('<6d', raw, 179)
+    # LAS 1.4 moved the point count to a 64-bit field, the legacy one may be 0
+    if version >= (1, 4) and len(raw) >= 255:
+        point_count = unpack_from('<Q', raw, 247)[0] or point_count
+    return LasHeader(
+        version=version,
+        point_format=point_format,
+        record_length=record_length,
+        offset_to_points=offset_to_points,
+        point_count=point_count,
+        scale=scale,
+        offset=offset,
+        min_xyz=(min_x, min_y, min_z),
+        max_xyz=(max_x, max_y, max_z),
+    )
+
+
+def point_dtype(header: LasHeader):
+    # Only the fields the gridder needs, everything else in the record is skipped.
+    # Formats 0-5 pack the class into the low 5 bits of byte 15, 6-10 give it byte 16.
+    class_offset = 16 if header.point_format >= 6 else 15
+    return np.dtype({
+        'names':   ['X', 'Y', 'Z', 'classification'],
+        'formats': ['<i4', '<i4', '<i4', 'u1'],
+        'offsets': [0, 4, 8, class_offset],
+        'itemsize': header.record_length,
+    })
+
+
+def memmap_points(file_name: str, header: LasHeader = None):
+    header = header or read_las_header(file_name)
+    return np.memmap(file_name, dtype=point_dtype(header), mode='r',
+                     offset=header.offset_to_points, shape=(header.point_count,))
+
+
+def point_classes(records, header: LasHeader):
+    classes = records['classification']
+    return classes & 0x1F if header.point_format < 6 else classes
+
+
+def scaled_xyz(records, header: LasHeader):
+    x = records['X'] * header.scale[0] + header.offset[0]
+    y = records['Y'] * header.scale[1] + header.offset[1]
+    z = records['Z'] * header.scale[2] + header.offset[2]
+    return x, y, z
+
+
+def grid_header_for_bounds(min_x, min_y, max_x, max_y, cell_size):
+    # Grids start on a whole multiple of the cell size, so every tile gridded
+    # at the same size shares one grid and their cells line up where they meet
+    min_x = np.floor(min_x / cell_size) * cell_size
+    min_y = np.floor(min_y / cell_size) * cell_size
+    ncols = int(np.floor((max_x - min_x) / cell_size)) + 1
+    nrows = int(np.floor((max_y - min_y) / cell_size)) + 1
+    return AscHeader(
+        ncols=ncols,
+        nrows=nrows,
+        xllcorner=float(min_x),
+        yllcorner=float(min_y),
+        cellsize=cell_size,
+        nodata_value=NO_DATA,
+    )
+
+
+class CellBinner:
+    """
+    Accumulates points into the cells of a grid laid out like an ASC file
+    (first row is the northernmost), reducing each cell with min, mean or max.
+    """
+
+    def __init__(self, header: AscHeader, method: str = 'mean'):
+        if method not in GRID_METHODS:
+            raise ValueError(f'Unknown grid method {method}, expected one of {GRID_METHODS}')
+        self.header = header
+        self.method = method
+        size = header.nrows * header.ncols
+        if method == 'mean':
+            self.total = np.zeros(size, dtype=np.float64)
+            self.count = np.zeros(size, dtype=np.int64)
+        else:
+            self.value = np.full(size, np.inf if method == 'min' else -np.inf, dtype=np.float64)
+
+    def cell_index(self, x, y):
+        h = self.header
+        # Rows count up from the south edge the way columns do from the west, so every cell
+        # holds its south and west edges and points on min_x or min_y aren't dropped
+        cols = np.floor((x - h.xllcorner) / h.cellsize).astype(np.int64)
+        rows = h.nrows - 1 - np.floor((y - h.yllcorner) / h.cellsize).astype(np.int64)
+        inside = (cols >= 0) & (cols < h.ncols) & (rows >= 0) & (rows < h.nrows)
+        return rows * h.ncols + cols, inside
+
+    def add(self, x, y, z):
+        index, inside = self.cell_index(x, y)
+        index, z = index[inside], z[inside]
+        if not len(index):
+            return
+        if self.method == 'mean':
+            self.total += np.bincount(index, weights=z, minlength=self.total.size)
+            self.count += np.bincount(index, minlength=self.count.size)
+            return
+        # Sort by cell then elevation, the first point of each cell is its min
+        # (or max, with the elevations negated).
+        key = z if self.method == 'min' else -z
+        order = np.lexsort((key, index))
+        cells, first = np.unique(index[order], return_index=True)
+        best = z[order][first]
+        reduce = np.minimum if self.method == 'min' else np.maximum
+        self.value[cells] = reduce(self.value[cells], best)
+
+    def accumulators(self):
+        # The raw per-cell state, shaped like the grid, so partial grids can be combined
+        shape = (self.header.nrows, self.header.ncols)
+        if self.method == 'mean':
+            return self.total.reshape(shape), self.count.reshape(shape)
+        return (self.value.reshape(shape),)
+
+    def result(self):
+        return finish_cells(self.method, *self.accumulators())
+
+
+def finish_cells(method, *accumulators):
+    if method == 'mean':
+        total, count = accumulators
+        grid = np.full(total.shape, NO_DATA, dtype=np.float32)
+        filled = count > 0
+        grid[filled] = total[filled] / count[filled]
+        return grid
+    value, = accumulators
+    return np.where(np.isfinite(value), value, NO_DATA).astype(np.float32)
+
+
+def bin_las_file(binner: CellBinner, file_name: str, ground_only: bool = False):
+    for header, records in iter_point_chunks(file_name):
+        if ground_only:
+            records = records[point_classes(records, header) == GROUND_CLASS]
+        binner.add(*scaled_xyz(records, header))
+
+
+def _neighbourhood(grid):
+    # 3x3 windows around every cell, with the border padded by nodata
+    padded = np.pad(grid, 1, constant_values=np.nan)
+    rows, cols = grid.shape
+    return np.stack([padded[dy:dy + rows, dx:dx + cols] for dy in range(3) for dx in range(3)], axis=-1)
+
+
+def fill_holes(grid, passes: int = 2):
+    # Cells no point landed in get the mean of their neighbours.  Only a couple of
+    # passes are made so gaps in coverage aren't smeared far into missing areas.
+    grid = np.where(grid == NO_DATA, np.nan, grid)
+    for _ in range(passes):
+        holes = np.isnan(grid)
+        if not holes.any():
+            break
+        window = _neighbourhood(grid)[holes]
+        counts = np.count_nonzero(~np.isnan(window), axis=1)
+        means  = np.nansum(window, axis=1) / np.maximum(counts, 1)
+        grid[holes] = np.where(counts > 0, means, np.nan)
+    return np.where(np.isnan(grid), NO_DATA, grid).astype(np.float32)
+
+
+def suppress_spikes(grid, cell_size: float, slope_percent: float):
+    """
+    Knock down cells that rise above all of their neighbours with a slope steeper
+    than slope_percent, replacing them with the median of the neighbourhood.
+    This plays the same role as GridSurfaceCreate's /spike switch.
+    """
+    values = np.where(grid == NO_DATA, np.nan, grid)
+    window = _neighbourhood(values)
+    window[..., 4] = np.nan
+    # Cells with no neighbours at all can't be compared to anything
+    near = ~np.isnan(window).all(axis=-1)
+    highest = np.full(values.shape, np.nan, dtype=values.dtype)
+    highest[near] = np.nanmax(window[near], axis=-1)
+    with np.errstate(invalid='ignore'):
+        spike = near & ((values - highest) / cell_size * 100 > slope_percent)
+    values[spike] = np.nanmedian(window[spike], axis=-1)
+    return np.where(np.isnan(values), NO_DATA, values).astype(np.float32)
+
+
+def finish_dem(grid, cell_size: float, spike: float = None):
+    grid = fill_holes(grid)
+    if spike:
+        grid = suppress_spikes(grid, cell_size, spike)
+    return grid
+
+
+def grid_las(list_of_las: list, cell_size: float = 1.0, method: str = 'mean', ground_only: bool = False, spike: float = None):
+    """
+    Grid one or more LAS files into a single DEM covering all of them.
+    Returns (AscHeader, float32 grid) with the northernmost row first.
+    """
+    headers = [read_las_header(l) for l in list_of_las]
+    min_x = min(h.min_xyz[0] for h in headers)
+    min_y = min(h.min_xyz[1] for h in headers)
+    max_x = max(h.max_xyz[0] for h in headers)
+    max_y = max(h.max_xyz[1] for h in headers)
+    binner = CellBinner(grid_header_for_bounds(min_x, min_y, max_x, max_y, cell_size), method)
+    for l in list_of_las:
+        bin_las_file(binner, l, ground_only)
+    return binner.header, finish_dem(binner.result(), cell_size, spike)
+
+
+def index_las_tiles(list_of_las: list):
+    # Only the headers are read, which is enough to know where every tile sits
+    index = []
+    for l in list_of_las:
+        h = read_las_header(l)
+        index.append({
+            'file': l,
+            'min_x': h.min_xyz[0], 'min_y': h.min_xyz[1],
+            'max_x': h.max_xyz[0], 'max_y': h.max_xyz[1],
+            'points': h.point_count,
+        })
+    return index
+
+
+def tile_window(mosaic: AscHeader, tile: dict):
+    """
+    The (row, col) slices of the mosaic a tile covers, and a header for that
+    window that lines up exactly with the mosaic's cells.
+    """
+    c   = mosaic.cellsize
+    top = mosaic.yllcorner + mosaic.nrows * c
+    # Pad by a cell on each side in case the header bounds are rounded
+    col0 = max(0, int(np.floor((tile['min_x'] - mosaic.xllcorner) / c)) - 1)
+    col1 = min(mosaic.ncols, int(np.floor((tile['max_x'] - mosaic.xllcorner) / c)) + 2)
+    row0 = max(0, int(np.floor((top - tile['max_y']) / c)) - 1)
+    row1 = min(mosaic.nrows, int(np.floor((top - tile['min_y']) / c)) + 2)
+    header = AscHeader(
+        ncols=col1 - col0,
+        nrows=row1 - row0,
+        xllcorner=mosaic.xllcorner + col0 * c,
+        yllcorner=top - row1 * c,
+        cellsize=c,
+        nodata_value=NO_DATA,
+    )
+    return (slice(row0, row1), slice(col0, col1)), header
+
+
+def _grid_tile_window(tile: dict, mosaic: AscHeader, method: str, ground_only: bool):
+    window, header = tile_window(mosaic, tile)
+    binner = CellBinner(header, method)
+    bin_las_file(binner, tile['file'], ground_only)
+    return window, binner.accumulators()
+
+
+def _star_grid_tile_window(args):
+    return _grid_tile_window(*args)
+
+
+def mosaic_las(list_of_las: list, mosaic_file: str, cell_size: float = 1.0, method: str = 'mean', ground_only: bool = False, spike: float = None, processes: int = None, band_rows: int = 1024):
+    """
+    Grid many LAS tiles into one DEM without ever holding the whole area in memory.
+
+    The tile headers give the union extent, the mosaic and its per-cell
+    accumulators are memory mapped .npy files, and tiles are gridded into their
+    own windows in parallel.  Windows are folded into the mosaic in tile order,
+    and every reduction combines overlapping cells the same way no matter which
+    tile finished first, so overlapping tile edges always come out identical.
+    Returns (AscHeader, memory mapped float32 grid) saved at mosaic_file.
+    """
+    index  = index_las_tiles(list_of_las)
+    header = grid_header_for_bounds(
+        min(t['min_x'] for t in index), min(t['min_y'] for t in index),
+        max(t['max_x'] for t in index), max(t['max_y'] for t in index),
+        cell_size,
+    )
+    shape = (header.nrows, header.ncols)
+    print(f'Mosaicking {len(index)} tiles into a {header.ncols}x{header.nrows} grid')
+
+    if method == 'mean':
+        accumulator_files = [mosaic_file + '.total.npy', mosaic_file + '.count.npy']
+        accumulators = [np.lib.format.open_memmap(accumulator_files[0], mode='w+', dtype=np.float64, shape=shape),
+                        np.lib.format.open_memmap(accumulator_files[1], mode='w+', dtype=np.int64, shape=shape)]
+    else:
+        accumulator_files = [mosaic_file + '.value.npy']
+        accumulators = [np.lib.format.open_memmap(accumulator_files[0], mode='w+', dtype=np.float64, shape=shape)]
+        accumulators[0][:] = np.inf if method == 'min' else -np.inf
+
+    with Pool(processes) as p:
+        jobs = [(t, header, method, ground_only) for t in index]
+        for window, partial in p.imap(_star_grid_tile_window, jobs):
+            if method == 'mean':
+                accumulators[0][window] += partial[0]
+                accumulators[1][window] += partial[1]
+            else:
+                view = accumulators[0][window]
+                reduce = np.minimum if method == 'min' else np.maximum
+                reduce(view, partial[0], out=view)
+
+    # Hole filling and spike suppression look a few cells around each cell, so
+    # each band is finished with a halo of rows above and below it.
+    mosaic = np.lib.format.open_memmap(mosaic_file, mode='w+', dtype=np.float32, shape=shape)
+    halo = 3
+    for start in range(0, header.nrows, band_rows):
+        stop = min(start + band_rows, header.nrows)
+        lo, hi = max(0, start - halo), min(header.nrows, stop + halo)
+        band = finish_cells(method, *[a[lo:hi] for a in accumulators])
+        mosaic[start:stop] = finish_dem(band, cell_size, spike)[start - lo:stop - lo]
+    mosaic.flush()
+
+    del accumulators
+    for a in accumulator_files:
+        os.remove(a)
+    return header, np.load(mosaic_file, mmap_mode='r')
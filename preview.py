@@ -0,0 +1,61 @@
+"""
+Quick previews of the models.  A strided view of each DEM is shaded into a
+PNG and meshed into a small model, with the same base and vertical scale the
+full resolution models get, so settings like --vscale, --base and --filter
+can be tried out in seconds before making the real thing.
+"""
+
+import math
+import os
+import cv2
+import numpy as np
+import asc_parse
+
+PREVIEW_DIR = 'PREVIEW'
+
+# Cells along the longest side of a preview
+PREVIEW_SIZE = 512
+
+
+def preview_names(name: str, format: str = 'stl', directory: str = PREVIEW_DIR):
+    # (hillshade, model) file names for a tile
+    return os.path.join(directory, f'{name}.png'), os.path.join(directory, f'{name}.{format}')
+
+
+def preview_stride(shape, size: int = PREVIEW_SIZE):
+    return max(1, math.ceil(max(shape) / size))
+
+
+def hillshade(heightmap, cellsize: float, azimuth: float = 315.0, altitude: float = 45.0):
+    """Shade a heightmap (row 0 north) lit from azimuth degrees clockwise from north, as uint8."""
+    # Rows run south, so the slope to the north is minus the slope down the rows
+    down, east = np.gradient(heightmap.astype(np.float64), cellsize)
+    azimuth, altitude = np.radians(azimuth), np.radians(altitude)
+    light = (np.sin(azimuth) * np.cos(altitude), np.cos(azimuth) * np.cos(altitude), np.sin(altitude))
+    # Dot product of the light with the surface's unit normal, (-dz/de, -dz/dn, 1)
+    shaded = (-east * light[0] + down * light[1] + light[2]) / np.sqrt(1 + east ** 2 + down ** 2)
+    return np.clip(255 * shaded, 0, 255).astype(np.uint8)
+
+
+def gen_preview(source, name: str, lowest_value, scale_adjustment = 1.0, vscale = 1.0, base = 0.0, format: str = 'stl', size: int = PREVIEW_SIZE, directory: str = PREVIEW_DIR):
+    """
+    Write a hillshade PNG and a small model of a raster source into directory.
+    The model is sized as if the DEM had been gridded at the preview's
+    resolution, just like a level of detail.  Returns the file names.
+    """
+    os.makedirs(directory, exist_ok=True)
+    png_name, model_name = preview_names(name, format, directory)
+    stride = preview_stride(asc_parse.raster_shape(source), size)
+    header, data = asc_parse.read_strided(source, stride)
+    print(f'Previewing {name} at 1/{stride} resolution')
+
+    depth_map = asc_parse.model_heightmap((header, data), lowest_value, vscale)
+    # The heightmap is flipped for meshing, the image wants north up again
+    shaded = hillshade(depth_map[::-1], header.cellsize)
+    # Voids are black, rather than shaded as part of the base
+    void = asc_parse.load_asc((header, data))[::-1] == asc_parse.NO_DATA
+    shaded[void] = 0
+    cv2.imwrite(png_name, shaded)
+
+    asc_parse.mesh_heightmap(depth_map, model_name, lowest_value, stride, scale_adjustment, base, format=format, multiprocessing=False)
+    return png_name, model_name
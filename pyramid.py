@@ -0,0 +1,60 @@
+"""
+Multi-resolution DEM pyramids.  A DEM is gridded once at full resolution,
+and coarser levels of detail are area averaged from it (asc_parse caches
+them next to the DEM), so trying a different print resolution doesn't mean
+re-gridding.
+"""
+
+import dataclasses
+import numpy as np
+
+# Output rows averaged per pass, to keep memory bounded on big rasters
+BAND_ROWS = 256
+
+
+def parse_lods(text: str):
+    # "1,2,4" -> [1, 2, 4]
+    lods = sorted({int(x) for x in text.split(',') if x.strip()})
+    if not lods or lods[0] < 1:
+        raise ValueError(f'Levels of detail must be positive integers, got {text}')
+    return lods
+
+
+def downsample(data, factor: int, nodata):
+    """
+    Area average factor x factor blocks of cells.  Cells equal to nodata don't
+    count towards the average, and a block with no data at all stays nodata.
+    Pass nodata=None for plain heightmaps.  Partial blocks on the bottom and
+    right edges are averaged over the cells they do have.
+    """
+    if factor == 1:
+        return data
+    rows, cols = data.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    out = np.empty((out_rows, out_cols), dtype=np.float32)
+    for start in range(0, out_rows, BAND_ROWS):
+        stop = min(start + BAND_ROWS, out_rows)
+        band = np.full(((stop - start) * factor, out_cols * factor), np.nan, dtype=np.float32)
+        source = data[start * factor:stop * factor]
+        band[:len(source), :cols] = source
+        if nodata is not None:
+            band[band == nodata] = np.nan
+        blocks = band.reshape(stop - start, factor, out_cols, factor)
+        counts = np.count_nonzero(~np.isnan(blocks), axis=(1, 3))
+        sums   = np.nansum(blocks, axis=(1, 3), dtype=np.float64)
+        out[start:stop] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan if nodata is None else nodata)
+    return out
+
+
+def downsample_header(header, factor: int):
+    # Row 0 is the northern edge, so the top stays put and the lower left corner moves
+    ncols, nrows = -(-header.ncols // factor), -(-header.nrows // factor)
+    cellsize = header.cellsize * factor
+    top = header.yllcorner + header.nrows * header.cellsize
+    return dataclasses.replace(
+        header,
+        ncols=ncols,
+        nrows=nrows,
+        yllcorner=top - nrows * cellsize,
+        cellsize=cellsize,
+    )
@@ -0,0 +1,164 @@
+"""
+A small pipelined scheduler.  Every item flows through a chain of stages
+connected by bounded queues, and each stage has its own worker limit, so
+while one tile is downloading another can be gridding and a third meshing.
+"""
+
+import argparse
+import contextlib
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    # Takes an item and returns it (or a new item) for the next stage, or None to drop it
+    func: object
+    workers: int = 1
+    # CPU heavy python stages run in a shared process pool instead of a thread
+    in_process: bool = False
+    # Optional hooks, run in the stage's thread: skip(item) lets an item pass
+    # straight through without running func, done(item) is called once func succeeds.
+    skip: object = None
+    done: object = None
+
+
+def check_stage_workers(workers: dict, names):
+    # A limit for a stage that doesn't exist is a typo, and a stage with no workers would never finish
+    unknown = sorted(set(workers) - set(names))
+    if unknown:
+        raise ValueError(f'Unknown stages {", ".join(unknown)}, the stages are {", ".join(names)}')
+    for name, count in workers.items():
+        if type(count) is not int or count < 1:
+            raise ValueError(f'The {name} stage needs at least 1 worker, got {count!r}')
+    return workers
+
+
+def parse_stage_workers(text: str, names=None):
+    # "download=16,grid=4" -> {'download': 16, 'grid': 4}, checked against names if given
+    workers = {}
+    try:
+        for part in text.split(','):
+            if part.strip():
+                name, count = part.split('=')
+                workers[name.strip()] = int(count)
+        if names is not None:
+            check_stage_workers(workers, names)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'Bad stage workers {text!r}: {e}') from None
+    return workers
+
+
+def run_pipeline(items, stages: list, queue_size: int = 2, processes: int = None, executor: ProcessPoolExecutor = None):
+    """
+    Push every item through the stages in order.  Returns the items that made
+    it through every stage, in the order they finished, and a list of
+    (stage name, item, exception) for the ones that didn't.  In process stages
+    use executor if one is passed in (it's left running), or a pool of their own.
+    """
+    for s in stages:
+        if s.workers < 1:
+            raise ValueError(f'The {s.name} stage needs at least 1 worker, got {s.workers}')
+    queues   = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    failures = []
+    lock     = threading.Lock()
+    owned    = executor is None and any(s.in_process for s in stages)
+    if owned:
+        executor = ProcessPoolExecutor(processes)
+
+    def work(i, stage):
+        while (item := queues[i].get()) is not _DONE:
+            try:
+                if stage.skip is not None and stage.skip(item):
+                    result = item
+                else:
+                    if stage.in_process:
+                        result = executor.submit(stage.func, item).result()
+                    else:
+                        result = stage.func(item)
+                    if stage.done is not None and result is not None:
+                        stage.done(result)
+            except Exception as e:
+                print(f'{stage.name} failed for {item}: {e!r}')
+                with lock:
+                    failures.append((stage.name, item, e))
+                continue
+            if result is not None:
+                queues[i + 1].put(result)
+
+    def supervise(i, stage):
+        workers = [threading.Thread(target=work, args=(i, stage), daemon=True) for _ in range(stage.workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        # Only once every worker here is done can the next stage be told to stop
+        downstream = stages[i + 1].workers if i + 1 < len(stages) else 0
+        for _ in range(downstream):
+            queues[i + 1].put(_DONE)
+
+    supervisors = [threading.Thread(target=supervise, args=(i, s), daemon=True) for i, s in enumerate(stages)]
+    for s in supervisors:
+        s.start()
+    try:
+        if stages:
+            for item in items:
+                queues[0].put(item)
+            for _ in range(stages[0].workers):
+                queues[0].put(_DONE)
+        for s in supervisors:
+            s.join()
+    finally:
+        if owned:
+            executor.shutdown()
+
+    if not stages:
+        return list(items), failures
+    finished = []
+    while not queues[-1].empty():
+        finished.append(queues[-1].get())
+    return finished, failures
+
+
+def run_within_budget(jobs, budget: float, processes: int = None, executor: ProcessPoolExecutor = None):
+    """
+    Run (cost, func, item) jobs in a process pool, starting as many at once
+    as fit in the budget, biggest first.  A job that doesn't fit on its own
+    still runs, just by itself.  Returns what the jobs returned, in the order
+    they finished, and a list of (func, item, exception) for the ones that failed.
+    The pool is executor if one is passed in (it's left running), or a new one.
+    """
+    processes = processes or os.cpu_count()
+    waiting  = sorted(jobs, key=lambda j: -j[0])
+    running  = {}
+    used     = 0
+    finished = []
+    failures = []
+    with contextlib.nullcontext(executor) if executor is not None else ProcessPoolExecutor(processes) as executor:
+        while waiting or running:
+            # The biggest job that fits, so small ones fill in around the big ones
+            fits = next((j for j in waiting if used + j[0] <= budget), None)
+            if fits is None and not running and waiting:
+                fits = waiting[0]
+            if fits is not None and len(running) < processes:
+                waiting.remove(fits)
+                cost, func, item = fits
+                running[executor.submit(func, item)] = fits
+                used += cost
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                cost, func, item = running.pop(future)
+                used -= cost
+                try:
+                    finished.append(future.result())
+                except Exception as e:
+                    print(f'{item} failed: {e!r}')
+                    failures.append((func, item, e))
+    return finished, failures
@@ -0,0 +1,403 @@
+"""
+A local job server.  It keeps a pool of STL workers and a pool of gridding
+processes warm, and a cache of decoded rasters, and runs jobs posted to it
+over HTTP, so making a model doesn't mean paying for imports and pool
+startup every time.
+
+    python server.py --port 8642 --root jobs
+
+Jobs are JSON, paths are relative to the server's root directory:
+
+    {"type": "stl", "raster": "DTM/tile.dtm", "options": {"vscale": 2, "format": "ply"}}
+    {"type": "pipeline", "urls": ["https://.../tile.zip"], "config": {"reduce_by": 2}}
+
+POST /jobs queues one and returns it with its id, GET /jobs/<id> reports on
+it, GET /jobs/<id>/outputs/<n> downloads the n'th file it made, and GET
+/stats reports on the jobs and the raster cache.  Client does all of that
+from Python.
+"""
+
+import argparse
+import dataclasses
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asc_parse
+import convert
+import las_grid
+import scheduler
+from stltools import stlgenerator
+
+PORT = 8642
+
+# Memory for decoded rasters, in MB
+CACHE_MB = 1024
+
+# Jobs run at once, they all share the same pools
+JOB_WORKERS = 2
+
+# Options of stl jobs, and the gen_stl_from_asc arguments they map to
+STL_OPTIONS = {
+    'reduce': 'scale_adjustment',
+    'vscale': 'vscale',
+    'base': 'base',
+    'max_error': 'max_error',
+    'lods': 'lods',
+    'format': 'format',
+}
+
+# Settings of pipeline jobs that name files, they have to stay inside the job's work directory
+PATH_SETTINGS = ('input', 'trace', 'profile')
+
+# Settings of pipeline jobs that can only take a few values
+SETTING_CHOICES = {
+    'gridder': ('native', 'fusion'),
+    'grid_method': las_grid.GRID_METHODS,
+    'mesh_format': stlgenerator.FORMATS,
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_lods(lods):
+    if not isinstance(lods, list) or not lods or not all(type(k) is int and k >= 1 for k in lods):
+        raise ValueError(f'lods has to be a list of positive integers, got {lods!r}')
+
+
+def check_stl_options(options: dict):
+    # Raises ValueError for an option that doesn't exist or has the wrong type, so a bad job is turned away up front
+    unknown = set(options) - set(STL_OPTIONS)
+    if unknown:
+        raise ValueError(f'Unknown stl options: {", ".join(sorted(unknown))}')
+    for key in ('reduce', 'vscale', 'base'):
+        if key in options and not is_number(options[key]):
+            raise ValueError(f'{key} has to be a number, got {options[key]!r}')
+    if options.get('max_error') is not None and not is_number(options['max_error']):
+        raise ValueError(f'max_error has to be a number, got {options["max_error"]!r}')
+    if 'lods' in options:
+        check_lods(options['lods'])
+    if 'format' in options and options['format'] not in stlgenerator.FORMATS:
+        raise ValueError(f'format has to be one of {", ".join(stlgenerator.FORMATS)}, got {options["format"]!r}')
+
+
+def check_settings(settings: dict):
+    # The same for the settings of pipeline jobs, against the types of Config's fields
+    fields = {f.name: f for f in dataclasses.fields(convert.Config)}
+    unknown = (set(settings) - set(fields)) | ({'work_dir'} & set(settings))
+    if unknown:
+        raise ValueError(f'Unknown pipeline settings: {", ".join(sorted(unknown))}')
+    for key, value in settings.items():
+        kind, default = fields[key].type, fields[key].default
+        if value is None and default is None:
+            continue
+        if kind is float:
+            ok, name = is_number(value), 'number'
+        elif kind is tuple:
+            ok, name = isinstance(value, list), 'list'
+        else:
+            ok, name = isinstance(value, kind), kind.__name__
+        if not ok:
+            raise ValueError(f'{key} has to be a {name}, got {value!r}')
+        if key in SETTING_CHOICES and value not in SETTING_CHOICES[key]:
+            raise ValueError(f'{key} has to be one of {", ".join(SETTING_CHOICES[key])}, got {value!r}')
+    if 'lods' in settings:
+        check_lods(settings['lods'])
+    if settings.get('bbox') is not None:
+        bbox = settings['bbox']
+        if len(bbox) != 4 or not all(is_number(v) for v in bbox) or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            raise ValueError(f'bbox has to be [min_x, min_y, max_x, max_y], got {bbox!r}')
+    if 'stage_workers' in settings:
+        scheduler.check_stage_workers(settings['stage_workers'], list(convert.STAGE_WORKERS))
+
+
+@dataclass
+class Job:
+    id: str
+    spec: dict
+    # The work directory, relative to the server's root
+    work_dir: str
+    status: str = 'queued'
+    error: str = None
+    # Files the job made, relative to the server's root
+    outputs: list = field(default_factory=list)
+    failures: list = field(default_factory=list)
+    submitted: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+
+class JobServer:
+    """
+    Runs jobs on a few threads that share one STL worker pool, one process
+    pool and one raster cache, all started up front so they're warm for
+    every job.  Each job gets a work directory of its own under root, unless
+    a pipeline job names one to reuse, so it can pick up where an earlier
+    job's build cache left off.
+    """
+    def __init__(self, root: str, cache_bytes: int = CACHE_MB * 1024 * 1024, job_workers: int = JOB_WORKERS, processes: int = None):
+        self.root = os.path.realpath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.rasters = asc_parse.RasterCache(cache_bytes)
+        # The pools fork, so they're started before any of the server's threads are
+        self.stl_pool = stlgenerator.StlWorkerPool(processes)
+        self.executor = ProcessPoolExecutor(self.stl_pool.processes)
+        # Process pool workers are only started as work comes in, start them all now
+        list(self.executor.map(time.sleep, [0.1] * self.stl_pool.processes))
+        self.runner = ThreadPoolExecutor(job_workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, path: str):
+        # An absolute path for a path relative to root, as long as it doesn't lead out of root
+        full = os.path.realpath(os.path.join(self.root, path))
+        if full != self.root and not full.startswith(self.root + os.sep):
+            raise ValueError(f'{path} is outside of the server\'s root')
+        return full
+
+    def submit(self, spec: dict):
+        # Checked up front, so a bad job is turned away instead of failing later
+        if not isinstance(spec, dict):
+            raise ValueError('A job has to be a JSON object')
+        job_id = uuid.uuid4().hex[:12]
+        work_dir = spec.get('work_dir', os.path.join('jobs', job_id))
+        self.resolve(work_dir)
+        if spec.get('type') == 'stl':
+            if not isinstance(spec.get('raster'), str):
+                raise ValueError('stl jobs need the path of a raster')
+            self.resolve(spec['raster'])
+            check_stl_options(spec.get('options', {}))
+            if spec.get('lowest_value') is not None and not is_number(spec['lowest_value']):
+                raise ValueError(f'lowest_value has to be a number, got {spec["lowest_value"]!r}')
+        elif spec.get('type') == 'pipeline':
+            settings = spec.get('config', {})
+            check_settings(settings)
+            if 'urls' in spec and not (isinstance(spec['urls'], list) and all(isinstance(u, str) for u in spec['urls'])):
+                raise ValueError('urls has to be a list of URLs')
+            for key in PATH_SETTINGS:
+                if settings.get(key):
+                    self.resolve(os.path.join(work_dir, settings[key]))
+        else:
+            raise ValueError('Jobs have a type of "stl" or "pipeline"')
+
+        job = Job(job_id, spec, os.path.normpath(work_dir))
+        with self.lock:
+            # Two runs in one work directory would trip over each other's files
+            if any(j.work_dir == job.work_dir and j.status in ('queued', 'running') for j in self.jobs.values()):
+                raise ValueError(f'Another job is already using {work_dir}')
+            self.jobs[job.id] = job
+        self.runner.submit(self.run, job)
+        return job
+
+    def run(self, job: Job):
+        # Jobs are read by the handler's threads, so they're only changed under the lock
+        with self.lock:
+            job.status, job.started = 'running', time.time()
+        work_dir = self.resolve(job.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+        failures = []
+        try:
+            if job.spec['type'] == 'stl':
+                outputs = self.run_stl(job.spec, work_dir)
+            else:
+                outputs, failures = self.run_pipeline(job, work_dir)
+            outputs = [os.path.relpath(o, self.root) for o in outputs if os.path.exists(o)]
+            with self.lock:
+                job.outputs, job.failures = outputs, failures
+                job.status = 'failed' if failures else 'done'
+        except Exception as e:
+            print(f'Job {job.id} failed: {e!r}')
+            with self.lock:
+                job.status, job.error = 'failed', repr(e)
+        with self.lock:
+            job.finished = time.time()
+
+    def run_stl(self, spec: dict, work_dir: str):
+        # Meshes a raster that's already on the server, decoded from the cache if it was used lately
+        source = self.resolve(spec['raster'])
+        header, data = self.rasters.get(source)
+        name = spec.get('name') or os.path.splitext(os.path.basename(source))[0]
+        options = {STL_OPTIONS[k]: v for k, v in spec.get('options', {}).items()}
+        lowest_value = spec.get('lowest_value')
+        if lowest_value is None:
+            lowest_value = asc_parse.lowest_elevation({source: asc_parse.tile_stats((header, data))})
+        lowest_value = 0.0 if lowest_value is None else lowest_value
+        directory = os.path.join(work_dir, 'STL')
+        asc_parse.gen_stl_from_asc((header, data), name, lowest_value, pool=self.stl_pool, directory=directory, **options)
+        return asc_parse.stl_names(name, options.get('lods', (1,)), options.get('format', 'stl'), directory)
+
+    def run_pipeline(self, job: Job, work_dir: str):
+        config = convert.Config(**job.spec.get('config', {}), work_dir=work_dir)
+        if 'urls' in job.spec:
+            with open(os.path.join(work_dir, config.input), 'w') as f:
+                f.writelines(f'{url}\n' for url in job.spec['urls'])
+        pipeline = convert.Pipeline(config, stl_pool=self.stl_pool, executor=self.executor)
+        _, failures = pipeline.run()
+        return pipeline.outputs, [{'stage': stage, 'tile': tile.name, 'error': repr(error)} for stage, tile, error in failures]
+
+    def describe(self, job_id: str = None):
+        # One job, or every job, as a dict
+        with self.lock:
+            if job_id is None:
+                return [j.to_dict() for j in self.jobs.values()]
+            return self.jobs[job_id].to_dict()
+
+    def output_file(self, job_id: str, index: int):
+        with self.lock:
+            output = self.jobs[job_id].outputs[index]
+        return self.resolve(output)
+
+    def stats(self):
+        with self.lock:
+            statuses = [j.status for j in self.jobs.values()]
+        return {
+            'jobs': {s: statuses.count(s) for s in ('queued', 'running', 'done', 'failed')},
+            'processes': self.stl_pool.processes,
+            'raster_cache': self.rasters.stats(),
+        }
+
+    def close(self):
+        self.runner.shutdown()
+        self.executor.shutdown()
+        self.stl_pool.close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # self.server.jobs is the JobServer
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': f'No such endpoint {self.path}'})
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.jobs.submit(spec)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, self.server.jobs.describe(job.id))
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        parts = self.path.strip('/').split('/')
+        if parts == ['stats']:
+            return self.send_json(200, jobs.stats())
+        if parts == ['jobs']:
+            return self.send_json(200, jobs.describe())
+        if len(parts) >= 2 and parts[0] == 'jobs' and parts[1] in jobs.jobs:
+            if len(parts) == 2:
+                return self.send_json(200, jobs.describe(parts[1]))
+            if len(parts) == 4 and parts[2] == 'outputs' and parts[3].isdigit():
+                try:
+                    file_name = jobs.output_file(parts[1], int(parts[3]))
+                except IndexError:
+                    return self.send_json(404, {'error': f'Job {parts[1]} has no output {parts[3]}'})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(os.path.getsize(file_name)))
+                self.send_header('Content-Disposition', f'attachment; filename="{os.path.basename(file_name)}"')
+                self.end_headers()
+                with open(file_name, 'rb') as f:
+                    while chunk := f.read(CHUNK_SIZE):
+                        self.wfile.write(chunk)
+                return
+        self.send_json(404, {'error': f'No such endpoint {self.path}'})
+
+    def log_message(self, format, *args):
+        # Clients poll, so every request would be a lot of noise.  Jobs print their own progress.
+        pass
+
+
+def serve(jobs: JobServer, host: str = '127.0.0.1', port: int = PORT):
+    # An HTTP server for jobs, call serve_forever() on it, or run it in a thread
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.jobs = jobs
+    return httpd
+
+
+class Client:
+    """Talks to a job server, like Client().wait(Client().submit(spec)['id'])."""
+    def __init__(self, url: str = f'http://127.0.0.1:{PORT}'):
+        self.url = url.rstrip('/')
+
+    def request(self, path: str, body: dict = None):
+        data = None if body is None else json.dumps(body).encode()
+        req = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as r:
+                return json.load(r)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f'{e.code}: {json.load(e).get("error")}') from None
+
+    def submit(self, spec: dict):
+        return self.request('/jobs', spec)
+
+    def status(self, job_id: str):
+        return self.request(f'/jobs/{job_id}')
+
+    def stats(self):
+        return self.request('/stats')
+
+    def wait(self, job_id: str, poll: float = 0.5, timeout: float = None):
+        # The finished job, whether it worked or not
+        start = time.monotonic()
+        while (job := self.status(job_id))['status'] in ('queued', 'running'):
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'Job {job_id} is still {job["status"]} after {timeout}s')
+            time.sleep(poll)
+        return job
+
+    def download(self, job_id: str, index: int, file_name: str):
+        with urllib.request.urlopen(f'{self.url}/jobs/{job_id}/outputs/{index}') as r, open(file_name, 'wb') as f:
+            while chunk := r.read(CHUNK_SIZE):
+                f.write(chunk)
+        return file_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs mini-map-maker jobs posted over HTTP, with warm worker pools and a cache of decoded rasters.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on.  The default is 127.0.0.1, so only this machine can post jobs.')
+    parser.add_argument('--port', type=int, default=PORT, help=f'The port to listen on.  The default is {PORT}.')
+    parser.add_argument('--root', type=str, default='.', help='The directory jobs read their rasters from and keep their work directories in.  Jobs can\'t reach outside of it.  The default is the current directory.')
+    parser.add_argument('--cache_mb', type=float, default=CACHE_MB, help=f'How much memory in MB decoded rasters may take up.  The least recently used ones are dropped past that.  The default is {CACHE_MB}.')
+    parser.add_argument('--jobs', type=int, default=JOB_WORKERS, help=f'How many jobs run at once, sharing the same worker pools.  The default is {JOB_WORKERS}.')
+    parser.add_argument('--processes', type=int, default=None, help='How many worker processes each pool has.  The default is one per core.')
+    args = parser.parse_args()
+
+    jobs = JobServer(args.root, int(args.cache_mb * 1024 * 1024), args.jobs, args.processes)
+    httpd = serve(jobs, args.host, args.port)
+    print(f'Serving jobs from {jobs.root} on http://{args.host}:{args.port}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        jobs.close()
+
+if __name__ == "__main__":
+    if sys.platform.startswith('win'):
+        multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,131 @@
+"""
+Vectorized counterparts of the original one facet at a time STL writers
+(kept in tests/reference_facets.py).  Rather than packing one facet at a
+time, these build every triangle for a band of heightmap rows as a single
+structured numpy array that can be written straight to disk.  The vertex
+data matches the originals byte for byte, facet for facet.
+"""
+
+import numpy as np
+
+#foreach triangle
+#REAL32[3] - Normal vector
+#REAL32[3] - Vertex 1
+#REAL32[3] - Vertex 2
+#REAL32[3] - Vertex 3
+#UINT16 - Attribute byte count
+STL_FACET = np.dtype([
+    ('normal',   '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attr',     '<u2'),
+])
+
+
+def _triangles(*vertices):
+    # Each vertex is an (x, y, z) tuple of scalars or arrays that broadcast
+    # against each other.  Returns an array of shape (..., len(vertices)//3, 3, 3).
+    coords = np.broadcast_arrays(*[np.asarray(c, dtype=np.float64) for v in vertices for c in v])
+    shape  = coords[0].shape
+    return np.stack(coords, axis=-1).reshape(shape + (len(vertices) // 3, 3, 3)).astype(np.float32)
+
+
+def _cell_triangles(heightmap, y_start, y_stop, hs, edge):
+    xs = np.arange(heightmap.shape[1], dtype=np.float64) * hs
+    ys = np.arange(y_start, y_stop + 1, dtype=np.float64)[:, None] * hs
+    x0, x1 = xs[:-1], xs[1:]
+    y0, y1 = ys[:-1], ys[1:]
+    z00 = heightmap[y_start:y_stop,       :-1]
+    z01 = heightmap[y_start:y_stop,       1:]
+    z10 = heightmap[y_start+1:y_stop+1,   :-1]
+    z11 = heightmap[y_start+1:y_stop+1,   1:]
+
+    blocks = []
+    if edge == 'north':
+        blocks.append(_triangles((x0, y0, 0), (x1, y0, z01), (x0, y0, z00),
+                                 (x0, y0, 0), (x1, y0, 0),   (x1, y0, z01)))
+    elif edge == 'south':
+        blocks.append(_triangles((x0, y1, 0), (x0, y1, z10), (x1, y1, z11),
+                                 (x0, y1, 0), (x1, y1, z11), (x1, y1, 0)))
+    blocks.append(_triangles((x0, y0, 0), (x1, y1, 0), (x1, y0, 0),
+                             (x0, y0, 0), (x0, y1, 0), (x1, y1, 0)))
+    blocks.append(_triangles((x0, y0, z00), (x1, y0, z01), (x1, y1, z11),
+                             (x1, y1, z11), (x0, y1, z10), (x0, y0, z00)))
+    return np.concatenate(blocks, axis=-3)
+
+
+def _edge_triangles(heightmap, y_start, y_stop, hs):
+    width = heightmap.shape[1] - 1
+    ys = np.arange(y_start, y_stop + 1, dtype=np.float64) * hs
+    y0, y1 = ys[:-1], ys[1:]
+    xe, xw = 0.0, width * hs
+    ze0, ze1 = heightmap[y_start:y_stop, 0],     heightmap[y_start+1:y_stop+1, 0]
+    zw0, zw1 = heightmap[y_start:y_stop, width], heightmap[y_start+1:y_stop+1, width]
+    return _triangles((xe, y0, 0), (xe, y0, ze0), (xe, y1, ze1),
+                      (xe, y0, 0), (xe, y1, ze1), (xe, y1, 0),
+                      (xw, y0, 0), (xw, y1, zw1), (xw, y0, zw0),
+                      (xw, y0, 0), (xw, y1, 0),   (xw, y1, zw1))
+
+
+def _band_triangles(heightmap, y_start, y_stop, hs, edge=None):
+    rows  = y_stop - y_start
+    edges = _edge_triangles(heightmap, y_start, y_stop, hs)
+    cells = _cell_triangles(heightmap, y_start, y_stop, hs, edge)
+    cells = cells.reshape(rows, -1, 3, 3)
+    return np.concatenate((edges, cells), axis=1).reshape(-1, 3, 3)
+
+
+def facet_normals(triangles):
+    """Unit normals for an (n, 3, 3) array of triangles, following their winding."""
+    v = triangles.astype(np.float64)
+    normals = np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])
+    length  = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, length, out=normals, where=length > 0)
+    return normals.astype(np.float32)
+
+
+def count_row_facets(width, height, y_start, y_stop):
+    """Number of facets row_facets will produce for rows [y_start, y_stop)."""
+    count = (y_stop - y_start) * (4 + 4 * width)
+    if y_start == 0 and y_stop > 0:
+        count += 2 * width
+    if y_start <= height - 1 < y_stop and height - 1 != 0:
+        count += 2 * width
+    return count
+
+
+def row_facets(heightmap, y_start, y_stop, hs):
+    """
+    Build the facets CalculateRow would emit for every row in [y_start, y_stop),
+    in the same order, as an STL_FACET array with real per-triangle normals.
+    """
+    height = heightmap.shape[0] - 1
+    y_stop = min(y_stop, height)
+    bands  = []
+    if y_start == 0 and y_stop > 0:
+        bands.append(_band_triangles(heightmap, 0, 1, hs, 'north'))
+        y_start = 1
+    last = height - 1
+    if y_start < y_stop:
+        mid_stop = min(y_stop, last)
+        if y_start < mid_stop:
+            bands.append(_band_triangles(heightmap, y_start, mid_stop, hs))
+        if y_start <= last < y_stop:
+            bands.append(_band_triangles(heightmap, last, last + 1, hs, 'south'))
+
+    if not bands:
+        return np.zeros(0, dtype=STL_FACET)
+    triangles = np.concatenate(bands)
+    facets = np.zeros(len(triangles), dtype=STL_FACET)
+    facets['vertices'] = triangles
+    facets['normal']   = facet_normals(triangles)
+    return facets
+
+
+def heightmap_facets(heightmap, hs):
+    """Every facet for a heightmap, in the order generate_from_heightmap_array writes them."""
+    return row_facets(heightmap, 0, heightmap.shape[0] - 1, hs)
+
+
+def write_facets(f, facets):
+    """Write an STL_FACET array to an open binary file."""
+    f.write(np.ascontiguousarray(facets, dtype=STL_FACET).view(np.uint8).data)
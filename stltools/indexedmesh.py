@@ -0,0 +1,168 @@
+"""
+Indexed mesh output.  Binary STL repeats every vertex in each of the
+triangles around it, but a heightmap mesh is a regular grid, so it can be
+written as one shared vertex array plus a face index array instead.  Both
+are built vectorized from the heightmap, and faces are generated and written
+a band of rows at a time.  Binary PLY and 3MF writers are provided.
+"""
+
+import io
+import zipfile
+import numpy as np
+from xml.sax.saxutils import escape
+
+# Heightmap rows worth of faces generated and written at a time
+BAND_ROWS = 256
+
+PLY_FACE = np.dtype([
+    ('count',   'u1'),
+    ('indices', '<u4', (3,)),
+])
+
+_3MF_CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+ <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+ <Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>
+'''
+
+_3MF_RELS = '''<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+ <Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>
+'''
+
+
+def _ring(rows, cols):
+    # Indices of the grid's border vertices, counter-clockwise from (0, 0), like simplify._ring_offsets
+    south = np.arange(0, cols)
+    east  = np.arange(0, rows) * (cols + 1) + cols
+    north = rows * (cols + 1) + np.arange(cols, 0, -1)
+    west  = np.arange(rows, 0, -1) * (cols + 1)
+    return np.concatenate((south, east, north, west))
+
+
+def count_grid_vertices(height, width):
+    # Every heightmap vertex on top, the border again at z=0, and the base's center
+    rows, cols = height - 1, width - 1
+    return height * width + 2 * (rows + cols) + 1
+
+
+def count_grid_faces(height, width):
+    # Two per cell on top, two per border edge for the sides, one per border edge for the base
+    rows, cols = height - 1, width - 1
+    return 2 * rows * cols + 6 * (rows + cols)
+
+
+def grid_vertices(heightmap, hs):
+    """The shared vertices of a heightmap's watertight mesh, as a float32 (n, 3) array."""
+    height, width = heightmap.shape
+    ys, xs = np.mgrid[0:height, 0:width]
+    top = np.stack((xs * hs, ys * hs, heightmap.astype(np.float64)), axis=-1).reshape(-1, 3)
+    bottom = top[_ring(height - 1, width - 1)].copy()
+    bottom[:, 2] = 0
+    center = np.array([[(width - 1) * hs / 2, (height - 1) * hs / 2, 0]])
+    return np.concatenate((top, bottom, center)).astype(np.float32)
+
+
+def grid_face_bands(heightmap, band_rows=BAND_ROWS):
+    """
+    Yield the faces of the mesh grid_vertices belongs to, as uint32 (n, 3)
+    index arrays: the top surface a band of rows at a time, then the sides
+    and the base.  The top is split along the same diagonal as the STL.
+    """
+    height, width = heightmap.shape
+    rows, cols = height - 1, width - 1
+    for y_start in range(0, rows, band_rows):
+        y_stop = min(y_start + band_rows, rows)
+        i00 = (np.arange(y_start, y_stop)[:, None] * width + np.arange(cols)).ravel()
+        i01, i10, i11 = i00 + 1, i00 + width, i00 + width + 1
+        cells = np.stack((np.stack((i00, i01, i11), axis=-1), np.stack((i11, i10, i00), axis=-1)), axis=1)
+        yield cells.reshape(-1, 3).astype(np.uint32)
+
+    top = _ring(rows, cols)
+    bottom = height * width + np.arange(len(top))
+    top_next, bottom_next = np.roll(top, -1), np.roll(bottom, -1)
+    yield np.concatenate((np.stack((bottom, bottom_next, top_next), axis=-1),
+                          np.stack((bottom, top_next, top), axis=-1))).astype(np.uint32)
+
+    # The base is fanned from its center, wound to face down
+    center = np.full(len(bottom), height * width + len(bottom))
+    yield np.stack((center, bottom_next, bottom), axis=-1).astype(np.uint32)
+
+
+def index_triangles(triangles):
+    """Turn an (n, 3, 3) triangle soup into shared (vertices, faces), for meshes that aren't a grid."""
+    # Each float32 vertex viewed as one 12 byte key, which np.unique sorts several times faster than rows
+    flat = np.ascontiguousarray(triangles.reshape(-1, 3), dtype=np.float32)
+    keys, inverse = np.unique(flat.view(np.dtype((np.void, 12))).ravel(), return_inverse=True)
+    return keys.view(np.float32).reshape(-1, 3), inverse.reshape(-1, 3).astype(np.uint32)
+
+
+def _face_bands(faces):
+    # Writers take either one face array or an iterable of them
+    return [faces] if isinstance(faces, np.ndarray) else faces
+
+
+def write_ply(destination, vertices, faces, face_count, objectname="DEM 3D Model"):
+    with open(destination, 'wb') as f:
+        f.write((
+            'ply\n'
+            'format binary_little_endian 1.0\n'
+            f'comment {objectname}\n'
+            f'element vertex {len(vertices)}\n'
+            'property float x\n'
+            'property float y\n'
+            'property float z\n'
+            f'element face {face_count}\n'
+            'property list uchar uint vertex_indices\n'
+            'end_header\n'
+        ).encode())
+        f.write(np.ascontiguousarray(vertices, dtype='<f4').data)
+        written = 0
+        for band in _face_bands(faces):
+            records = np.empty(len(band), dtype=PLY_FACE)
+            records['count'] = 3
+            records['indices'] = band
+            f.write(records.view(np.uint8).data)
+            written += len(band)
+    if written != face_count:
+        raise ValueError(f'{destination} was declared with {face_count} faces but got {written}')
+
+
+def write_3mf(destination, vertices, faces, face_count, objectname="DEM 3D Model"):
+    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', _3MF_CONTENT_TYPES)
+        z.writestr('_rels/.rels', _3MF_RELS)
+        with z.open('3D/3dmodel.model', 'w', force_zip64=True) as raw, io.TextIOWrapper(raw, encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<model unit="millimeter" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+                    f' <metadata name="Title">{escape(objectname)}</metadata>\n'
+                    ' <resources>\n'
+                    '  <object id="1" type="model">\n'
+                    '   <mesh>\n'
+                    '    <vertices>\n')
+            for start in range(0, len(vertices), BAND_ROWS * 1024):
+                np.savetxt(f, vertices[start:start + BAND_ROWS * 1024], fmt='     <vertex x="%.9g" y="%.9g" z="%.9g"/>')
+            f.write('    </vertices>\n'
+                    '    <triangles>\n')
+            written = 0
+            for band in _face_bands(faces):
+                np.savetxt(f, band, fmt='     <triangle v1="%d" v2="%d" v3="%d"/>')
+                written += len(band)
+            f.write('    </triangles>\n'
+                    '   </mesh>\n'
+                    '  </object>\n'
+                    ' </resources>\n'
+                    ' <build>\n'
+                    '  <item objectid="1"/>\n'
+                    ' </build>\n'
+                    '</model>\n')
+    if written != face_count:
+        raise ValueError(f'{destination} was declared with {face_count} faces but got {written}')
+
+
+WRITERS = {
+    'ply': write_ply,
+    '3mf': write_3mf,
+}
@@ -0,0 +1,225 @@
+"""
+Error-bounded simplification of heightmap meshes.
+
+The top surface is split into an adaptive quadtree of square blocks whose
+sides are powers of two, aligned to multiples of their size.  A block that
+is flat enough is drawn as a fan around its center vertex, anything rougher
+is split into four, and what's still too rough at MIN_BLOCK_SIZE keeps its
+full resolution cells.  Every block of a level is the same shape, so a whole
+level is checked at once with array operations instead of block by block.
+
+Fans pick up every vertex their neighbours put on their edges, so there are
+no cracks, and the sides and base are built from the same border vertices,
+so the result stays watertight.
+"""
+
+import numpy as np
+from dataclasses import dataclass
+from numpy.lib.stride_tricks import sliding_window_view
+from . import facetarray
+
+# Blocks this many cells across that still aren't flat enough are written at
+# full resolution instead of being split down to single cells.
+MIN_BLOCK_SIZE = 4
+
+# Roughly how many vertices' worth of blocks, or triangles, are worked on at once
+CHUNK_SIZE = 1 << 18
+
+
+@dataclass
+class MeshPlan:
+    # Block size -> (block rows, block cols) of the blocks drawn as fans
+    fans: dict
+    # The cells drawn at full resolution
+    full_cells: np.ndarray
+    # The vertices the top surface uses
+    active: np.ndarray
+    triangle_count: int
+
+
+def _barycentric(px, py, a, b, c):
+    denom = (b[1] - c[1]) * (a[0] - c[0]) + (c[0] - b[0]) * (a[1] - c[1])
+    l1 = ((b[1] - c[1]) * (px - c[0]) + (c[0] - b[0]) * (py - c[1])) / denom
+    l2 = ((c[1] - a[1]) * (px - c[0]) + (a[0] - c[0]) * (py - c[1])) / denom
+    return l1, l2, 1 - l1 - l2
+
+
+def fan_weights(size: int):
+    """
+    (5, size + 1, size + 1) weights that give a fan's surface at every vertex
+    of a block from its center and its four corners, counter-clockwise from (x0, y0).
+    """
+    py, px = np.mgrid[0:size + 1, 0:size + 1]
+    c = size // 2
+    corners = [(0, 0), (size, 0), (size, size), (0, size)]
+    weights = np.zeros((5, size + 1, size + 1))
+    done = np.zeros(px.shape, dtype=bool)
+    for i in range(4):
+        j = (i + 1) % 4
+        l1, l2, l3 = _barycentric(px, py, (c, c), corners[i], corners[j])
+        inside = (l1 >= -1e-9) & (l2 >= -1e-9) & (l3 >= -1e-9) & ~done
+        weights[0][inside] += l1[inside]
+        weights[1 + i][inside] += l2[inside]
+        weights[1 + j][inside] += l3[inside]
+        done |= inside
+    return weights
+
+
+def block_errors(heightmap, size: int, by, bx):
+    """Largest vertical distance between each (by, bx) block of a level and a four triangle fan around its center."""
+    if not len(by):
+        # Blocks this big may not even fit in a narrow heightmap
+        return np.empty(0)
+    windows = sliding_window_view(heightmap, (size + 1, size + 1))[::size, ::size]
+    weights = fan_weights(size)
+    c = size // 2
+    errors = np.empty(len(by))
+    step = max(1, CHUNK_SIZE // (size + 1) ** 2)
+    for i in range(0, len(by), step):
+        block = windows[by[i:i + step], bx[i:i + step]]
+        control = np.stack((block[:, c, c], block[:, 0, 0], block[:, 0, size], block[:, size, size], block[:, size, 0]), axis=1)
+        approx = np.tensordot(control, weights, axes=1)
+        errors[i:i + step] = np.abs(block - approx).max(axis=(1, 2))
+    return errors
+
+
+def _ring_offsets(rows, cols):
+    # (y, x) offsets of the vertices around a rows x cols rectangle, counter-clockwise from its (x0, y0) corner
+    ys = np.concatenate((np.zeros(cols, int), np.arange(0, rows), np.full(cols, rows), np.arange(rows, 0, -1)))
+    xs = np.concatenate((np.arange(0, cols), np.full(rows, cols), np.arange(cols, 0, -1), np.zeros(rows, int)))
+    return ys, xs
+
+
+def _fan_rings(active, size, by, bx):
+    # For chunks of a level's fans: their index in by/bx, and the (y, x) of the active vertices around each, in order
+    ry, rx = _ring_offsets(size, size)
+    step = max(1, CHUNK_SIZE // (4 * size))
+    for i in range(0, len(by), step):
+        ys = by[i:i + step, None] * size + ry
+        xs = bx[i:i + step, None] * size + rx
+        fan, position = np.nonzero(active[ys, xs])
+        yield i + fan, ys[fan, position], xs[fan, position]
+
+
+def plan_mesh(heightmap, max_error):
+    """
+    Split the heightmap's cells into fans and full resolution cells, and
+    count the triangles the simplified model will have.
+    """
+    rows, cols = heightmap.shape[0] - 1, heightmap.shape[1] - 1
+    # Extra vertices a fan picks up on its edges can move its surface by as much
+    # as the fan's own error, so fans are held to half the allowed error.
+    tolerance = max_error / 2
+    size = MIN_BLOCK_SIZE
+    while size * 2 <= max(rows, cols):
+        size *= 2
+
+    fans = {}
+    pending = np.ones((-(-rows // size), -(-cols // size)), dtype=bool)
+    while True:
+        # Blocks that run off the edge can't be fans, they're split until they fit
+        whole = np.zeros_like(pending)
+        whole[:rows // size, :cols // size] = True
+        by, bx = np.nonzero(pending & whole)
+        flat = block_errors(heightmap, size, by, bx) <= tolerance
+        fans[size] = (by[flat], bx[flat])
+        pending[by[flat], bx[flat]] = False
+        if size <= MIN_BLOCK_SIZE:
+            break
+        size //= 2
+        pending = pending.repeat(2, axis=0).repeat(2, axis=1)[:-(-rows // size), :-(-cols // size)]
+    full_cells = pending.repeat(size, axis=0).repeat(size, axis=1)[:rows, :cols]
+
+    active = np.zeros(heightmap.shape, dtype=bool)
+    for dy in (0, 1):
+        for dx in (0, 1):
+            active[dy:dy + rows, dx:dx + cols] |= full_cells
+    for size, (by, bx) in fans.items():
+        for dy in (0, size):
+            for dx in (0, size):
+                active[by * size + dy, bx * size + dx] = True
+
+    # Two per full cell, one per active vertex around each fan, and three per border vertex for the sides and base
+    count = 2 * int(np.count_nonzero(full_cells))
+    for size, (by, bx) in fans.items():
+        count += sum(len(fan) for fan, _, _ in _fan_rings(active, size, by, bx))
+    ry, rx = _ring_offsets(rows, cols)
+    count += 3 * int(np.count_nonzero(active[ry, rx]))
+    return MeshPlan(fans, full_cells, active, count)
+
+
+def _top_points(heightmap, ys, xs, hs):
+    return np.stack((xs * hs, ys * hs, heightmap[ys, xs]), axis=-1)
+
+
+def _fan(center, ring_points):
+    following = np.roll(ring_points, -1, axis=0)
+    return np.stack((np.broadcast_to(center, ring_points.shape), ring_points, following), axis=1)
+
+
+def triangle_chunks(heightmap, hs, plan: MeshPlan):
+    """
+    Yield the triangles of the simplified model as float32 (n, 3, 3) arrays,
+    a chunk at a time so the whole model never has to be in memory at once.
+    """
+    rows, cols = heightmap.shape[0] - 1, heightmap.shape[1] - 1
+
+    # Full resolution cells, split along the same diagonal as the unsimplified mesh
+    band_rows = max(1, CHUNK_SIZE // max(cols, 1))
+    for y_start in range(0, rows, band_rows):
+        y, x = np.nonzero(plan.full_cells[y_start:y_start + band_rows])
+        y += y_start
+        v00 = _top_points(heightmap, y, x, hs)
+        v01 = _top_points(heightmap, y, x + 1, hs)
+        v10 = _top_points(heightmap, y + 1, x, hs)
+        v11 = _top_points(heightmap, y + 1, x + 1, hs)
+        yield np.concatenate((np.stack((v00, v01, v11), axis=1), np.stack((v11, v10, v00), axis=1))).astype(np.float32)
+
+    # Each fan joins its center to every pair of neighbouring active vertices around it
+    for size, (by, bx) in plan.fans.items():
+        for fan, ys, xs in _fan_rings(plan.active, size, by, bx):
+            if not len(fan):
+                continue
+            points = _top_points(heightmap, ys, xs, hs)
+            centers = _top_points(heightmap, by[fan] * size + size // 2, bx[fan] * size + size // 2, hs)
+            # The next vertex around the same fan, wrapping around from its last to its first
+            following = np.arange(1, len(fan) + 1)
+            last = np.append(fan[1:] != fan[:-1], True)
+            first = np.flatnonzero(np.insert(fan[1:] != fan[:-1], 0, True))
+            following[last] = first
+            yield np.stack((centers, points, points[following]), axis=1).astype(np.float32)
+
+    # Sides: a strip down to z=0 under every pair of border vertices
+    ry, rx = _ring_offsets(rows, cols)
+    on = plan.active[ry, rx]
+    top    = _top_points(heightmap, ry[on], rx[on], hs)
+    bottom = top.copy()
+    bottom[:, 2] = 0
+    top_next, bottom_next = np.roll(top, -1, axis=0), np.roll(bottom, -1, axis=0)
+    # The base is one flat polygon, fanned from its center and wound to face down
+    base_center = np.array((cols * hs / 2, rows * hs / 2, 0))
+    yield np.concatenate((
+        np.stack((bottom, bottom_next, top_next), axis=1),
+        np.stack((bottom, top_next, top), axis=1),
+        _fan(base_center, bottom[::-1]),
+    )).astype(np.float32)
+
+
+def simplified_triangles(heightmap, hs, max_error, plan: MeshPlan = None):
+    """
+    Triangles (n, 3, 3) for a watertight model of the heightmap whose top
+    surface is never more than max_error (in output units) from the original.
+    """
+    plan = plan or plan_mesh(heightmap, max_error)
+    return np.concatenate(list(triangle_chunks(heightmap, hs, plan)))
+
+
+def to_facets(triangles):
+    facets = np.zeros(len(triangles), dtype=facetarray.STL_FACET)
+    facets['vertices'] = triangles
+    facets['normal']   = facetarray.facet_normals(triangles)
+    return facets
+
+
+def simplified_facets(heightmap, hs, max_error, plan: MeshPlan = None):
+    return to_facets(simplified_triangles(heightmap, hs, max_error, plan))
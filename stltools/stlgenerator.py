@@ -4,31 +4,175 @@ model using various data sets.
 https://github.com/r-barnes/DEMto3D
 """
 
-import functools
 import math
+import os
+import time
 import numpy as np
 from struct import pack
-from . import writefacets
-from multiprocessing import Pool
+from . import facetarray
+from . import indexedmesh
+from . import simplify
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count, resource_tracker, shared_memory
+
+# Default ceiling (in bytes) on how much facet data may be in flight at once
+# while streaming an STL to disk.
+DEFAULT_MAX_MEMORY = 512 * 1024 * 1024
+
+# Building a band allocates roughly this many times its final size in
+# temporary arrays (float64 vertices, normals, concatenation copies).
+BAND_OVERHEAD = 6
+
+# Rough peak bytes per heightmap cell while meshing, on top of the bands of an
+# STL in flight: the loaded raster and its scaled copies, the whole vertex and
+# face arrays of an indexed mesh, or the whole triangle soup of a simplified
+# indexed mesh.  Simplified STLs are streamed like full resolution ones.
+MESH_BYTES_PER_CELL = {
+    'stl': 24,
+    'indexed': 128,
+    'simplified': 512,
+}
+
+# Mesh file formats generate_from_heightmap_array can write
+FORMATS = ('stl',) + tuple(indexedmesh.WRITERS)
+
+# How many published heightmaps each worker keeps attached between tasks.  An
+# unlinked heightmap is only freed once every worker has let go of it.
+ATTACHED_HEIGHTMAPS = 2
 
 def CalculateRow(heightmap, y, h_scale):
-    facets = bytearray()
+    return facetarray.row_facets(heightmap, y, y+1, h_scale).tobytes()
+
+def CalculateBand(heightmap, y_start, y_stop, h_scale):
+    return facetarray.row_facets(heightmap, y_start, y_stop, h_scale)
+
+def rows_per_band(width, max_memory=DEFAULT_MAX_MEMORY, bands_in_flight=1):
+    # The widest rows are the first and last, which carry a north/south edge
+    row_bytes = (4 + 6 * width) * facetarray.STL_FACET.itemsize * BAND_OVERHEAD
+    return max(1, int(max_memory // (row_bytes * max(1, bands_in_flight))))
+
+def _open_shared(name):
+    # Workers only borrow the heightmap, the process that made it unlinks it.
+    # Before python 3.13 attaching also registers it with the resource
+    # tracker, which would try to unlink it a second time at shutdown.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+# Heightmaps this worker process has attached to, most recently used last
+_attached = OrderedDict()
+
+def _attach(name, shape, dtype):
+    if name in _attached:
+        _attached.move_to_end(name)
+    else:
+        shm = _open_shared(name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        while len(_attached) > ATTACHED_HEIGHTMAPS:
+            _, (old, _) = _attached.popitem(last=False)
+            old.close()
+    return _attached[name][1]
+
+def CalculateSharedBand(descriptor, y_start, y_stop, h_scale):
+    # Runs in a worker, the heightmap itself is only attached to, never pickled
+    return CalculateBand(_attach(*descriptor), y_start, y_stop, h_scale)
+
+class SharedHeightmap:
+    """
+    A heightmap copied once into shared memory, so workers can be sent a
+    small (name, shape, dtype) descriptor instead of the whole array.
+    """
+    def __init__(self, heightmap):
+        heightmap = np.ascontiguousarray(heightmap)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(heightmap.nbytes, 1))
+        np.ndarray(heightmap.shape, dtype=heightmap.dtype, buffer=self.shm.buf)[...] = heightmap
+        self.descriptor = (self.shm.name, heightmap.shape, heightmap.dtype.str)
+
+    def __enter__(self):
+        return self.descriptor
+
+    def __exit__(self, *exc):
+        self.shm.close()
+        self.shm.unlink()
+
+class StlWorkerPool:
+    """
+    A pool of processes that lives across many STLs, so the processes are
+    started once per run instead of once per tile.  Use it as a context
+    manager, and pass it to generate_from_heightmap_array as pool.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self.pool = Pool(self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def stream_bands(heightmap, h_scale, band_rows, pool=None, bands_in_flight=1):
+    """
+    Yield the facets of a heightmap one band of rows at a time, in file order.
+    With a StlWorkerPool, the heightmap is published to shared memory once and
+    up to bands_in_flight bands are computed concurrently, but no more, so
+    memory use stays bounded no matter how large the model is.
+    """
     height = heightmap.shape[0] - 1
-    width  = heightmap.shape[1] - 1
-    facets += writefacets.writeEastFacet(x=0,     y=y, heightmap=heightmap, hs=h_scale)
-    facets += writefacets.writeWestFacet(x=width, y=y, heightmap=heightmap, hs=h_scale)
-    for x in range(width):
-        if y == 0:
-            facets += writefacets.writeNorthFacet(x=x, y=y,   heightmap=heightmap, hs=h_scale)
-        elif y == height-1:
-            facets += writefacets.writeSouthFacet(x=x, y=y+1, heightmap=heightmap, hs=h_scale)
-        facets += writefacets.writeBottomFacet(x=x, y=y, z=0, hs=h_scale)
-        facets += writefacets.writeTopFacet   (x=x, y=y, hs=h_scale, heightmap=heightmap)
-    return facets
+    bands  = [(y, min(y + band_rows, height)) for y in range(0, height, band_rows)]
+    if pool is None:
+        for y_start, y_stop in bands:
+            yield y_stop, CalculateBand(heightmap, y_start, y_stop, h_scale)
+        return
+
+    with SharedHeightmap(heightmap) as descriptor:
+        pending = deque()
+        try:
+            for y_start, y_stop in bands:
+                pending.append((y_stop, pool.pool.apply_async(CalculateSharedBand, (descriptor, y_start, y_stop, h_scale))))
+                if len(pending) >= bands_in_flight:
+                    y_done, result = pending.popleft()
+                    yield y_done, result.get()
+            while pending:
+                y_done, result = pending.popleft()
+                yield y_done, result.get()
+        finally:
+            # Don't unlink the heightmap out from under bands still being computed
+            for _, result in pending:
+                result.wait()
+
+def estimate_memory(rows, cols, max_memory=DEFAULT_MAX_MEMORY, max_error=None, format='stl'):
+    """Roughly how much memory meshing a rows x cols heightmap takes with these settings."""
+    cells = rows * cols
+    if max_error is not None and format == 'stl':
+        return cells * MESH_BYTES_PER_CELL['stl'] + simplify.CHUNK_SIZE * 2 * facetarray.STL_FACET.itemsize * BAND_OVERHEAD
+    if max_error is not None:
+        return cells * MESH_BYTES_PER_CELL['simplified']
+    if format != 'stl':
+        return cells * MESH_BYTES_PER_CELL['indexed']
+    facets = facetarray.count_row_facets(max(cols - 1, 0), max(rows - 1, 0), 0, max(rows - 1, 0))
+    return cells * MESH_BYTES_PER_CELL['stl'] + min(max_memory, facets * facetarray.STL_FACET.itemsize * BAND_OVERHEAD)
+
+def write_header(f, objectname, numFacets):
+    # Write the file header
+    f.write(pack('80s', objectname.encode()))
+    #Following the header is a 4-byte little-endian unsigned integer
+    #indicating the number of triangular facets in the file. Following that
+    #is data describing each triangle in turn. The file simply ends after
+    #the last triangle.
+    f.write(pack('<I', numFacets))
 
 np.set_printoptions(threshold=np.inf)
 
-def generate_from_heightmap_array(heightmap, destination, hsize=1, vsize=1, base=0, hsep=0.6, anchorsize=0.75, sep_dep=0.1, tab_dep=0.3, tab_size=0.5, objectname="DEM 3D Model", multiprocessing=True, hmin = None, hmax = None):
+def generate_from_heightmap_array(heightmap, destination, hsize=1, vsize=1, base=0, hsep=0.6, anchorsize=0.75, sep_dep=0.1, tab_dep=0.3, tab_size=0.5, objectname="DEM 3D Model", multiprocessing=True, hmin = None, hmax = None, max_memory=DEFAULT_MAX_MEMORY, mmap_output=False, max_error=None, pool=None, format='stl'):
     #A binary STL file has an 80-character header (which is generally ignored,
     #but should never begin with "solid" because that may lead some software to
     #assume that this is an ASCII STL file). 
@@ -42,9 +186,9 @@ def generate_from_heightmap_array(heightmap, destination, hsize=1, vsize=1, base
     hmin = hmin or min([hm.min() for hm in heightmap])
     hmax = hmax or max([hm.max() for hm in heightmap])
     vsize /= 750
-    heightmap       -= hmin                                              #Set base elevation to 0
-    heightmap       *= vsize#/hmax                                        #Convert heightmap from input units to output units
-    heightmap       += base                                              #Add the indicated amount of base (in output units)
+    #Set base elevation to 0, convert heightmap from input units to output units
+    #and add the indicated amount of base (in output units)
+    heightmap        = [(hm - hmin) * vsize + base for hm in heightmap]
     h_scale = hsize/min((heightmap[0].shape[1], heightmap[0].shape[0]))  #Find the horizontal scale
     tab_size         = math.ceil(tab_size/h_scale)                       #Convert tab size from output units to cells
     separation_array = np.zeros(shape=(1,heightmap[0].shape[1]))+sep_dep #Separation array equal to width of piece set to sep_dep height
@@ -61,37 +205,81 @@ def generate_from_heightmap_array(heightmap, destination, hsize=1, vsize=1, base
         heightmap = np.concatenate((pad_array, separation_array, heightmap, separation_array, pad_array), axis=0)
 
 
-    percentComplete = 0
     height = heightmap.shape[0] - 1
     width  = heightmap.shape[1] - 1
-    with open(destination, 'wb') as f:
-        # Write the number of facets
-        numTopBottomFacets  = 4 * width * height
-        numNorthSouthFacets = 4 * width 
-        numEastWestFacets   = 4 * height 
-
-        if multiprocessing:
-            pool   = Pool()
-            facets = pool.starmap(CalculateRow, [(heightmap,y,h_scale) for y in range(height)])
-            facets = b''.join(facets)
+    numFacets = facetarray.count_row_facets(width, height, 0, height)
+
+    plan = None
+    if max_error is not None:
+        # A rough heightmap can take as many triangles simplified as it does at full
+        # resolution, and then the full resolution writers are the faster, leaner way to write it.
+        start = time.perf_counter()
+        plan = simplify.plan_mesh(heightmap, max_error)
+        full_count = numFacets if format == 'stl' else indexedmesh.count_grid_faces(*heightmap.shape)
+        if plan.triangle_count >= full_count:
+            print("Simplifying wouldn't leave fewer than {0} facets, writing the full resolution mesh ({1:.2f}s)".format(full_count, time.perf_counter() - start))
+            plan = None
+
+    if format != 'stl':
+        # Indexed formats share vertices between faces instead of repeating them
+        start = time.perf_counter()
+        if plan is not None:
+            vertices, faces = indexedmesh.index_triangles(simplify.simplified_triangles(heightmap, h_scale, max_error, plan))
+            face_count = len(faces)
         else:
-            facets = bytearray()
-            # Generate the bottom plane.
-            for y in range(height):
-                if int(float(y) / height * 100) != percentComplete:
-                    percentComplete = int(float(y) / height * 100)
-                    print("Writing STL File... {0}% Complete".format(percentComplete))
-                facets += CalculateRow(heightmap, y, h_scale)
-
-        # Write the file header
-        f.write(pack('80s', objectname.encode()))
-        #Following the header is a 4-byte little-endian unsigned integer
-        #indicating the number of triangular facets in the file. Following that
-        #is data describing each triangle in turn. The file simply ends after
-        #the last triangle.
-        f.write(pack('<i', numTopBottomFacets + numNorthSouthFacets + numEastWestFacets))
-
-        f.write(facets)
+            vertices = indexedmesh.grid_vertices(heightmap, h_scale)
+            faces = indexedmesh.grid_face_bands(heightmap)
+            face_count = indexedmesh.count_grid_faces(*heightmap.shape)
+        indexedmesh.WRITERS[format](destination, vertices, faces, face_count, objectname)
+        print("Wrote {0} vertices and {1} faces in {2:.2f}s".format(len(vertices), face_count, time.perf_counter() - start))
+        print("File saved as: " + destination)
+        return
+
+    if plan is not None:
+        # The facet count is known up front, so they're written a chunk at a time
+        with open(destination, 'wb') as f:
+            write_header(f, objectname, plan.triangle_count)
+            for triangles in simplify.triangle_chunks(heightmap, h_scale, plan):
+                facetarray.write_facets(f, simplify.to_facets(triangles))
+        print("Simplified {0} facets to {1} ({2:.1f}% fewer) in {3:.2f}s".format(
+            numFacets, plan.triangle_count, 100 - 100 * plan.triangle_count / max(numFacets, 1), time.perf_counter() - start))
+        print("File saved as: " + destination)
+        return
+
+    with open(destination, 'wb') as f:
+        write_header(f, objectname, numFacets)
+        if mmap_output:
+            f.truncate(f.tell() + numFacets * facetarray.STL_FACET.itemsize)
+
+    # A pool that's passed in is shared with other STLs, one made here is only for this one
+    own_pool = pool is None and multiprocessing
+    if own_pool:
+        pool = StlWorkerPool()
+    elif not multiprocessing:
+        pool = None
+    bands_in_flight = pool.processes if pool is not None else 1
+    band_rows = rows_per_band(width, max_memory, bands_in_flight)
+
+    # The header is already on disk, so each band can be written out (or
+    # copied into the mapped file) as soon as it's ready.
+    try:
+        if mmap_output and numFacets:
+            out = np.memmap(destination, dtype=facetarray.STL_FACET, mode='r+', offset=84, shape=(numFacets,))
+            written = 0
+            for y_done, facets in stream_bands(heightmap, h_scale, band_rows, pool, bands_in_flight):
+                out[written:written + len(facets)] = facets
+                written += len(facets)
+                print("Writing STL File... {0}% Complete".format(int(y_done / height * 100)))
+            out.flush()
+            del out
+        elif not mmap_output:
+            with open(destination, 'ab') as f:
+                for y_done, facets in stream_bands(heightmap, h_scale, band_rows, pool, bands_in_flight):
+                    facetarray.write_facets(f, facets)
+                    print("Writing STL File... {0}% Complete".format(int(y_done / height * 100)))
+    finally:
+        if own_pool:
+            pool.close()
 
     # Finished writing to file
     print("File saved as: " + destination)
@@ -0,0 +1,41 @@
+import functools
+import os
+import sys
+import threading
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# The modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory, handler=QuietHandler):
+    # A local http.server for directory on a free port, stopped when the test is done
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=str(directory)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f'http://127.0.0.1:{httpd.server_address[1]}'
+
+
+@pytest.fixture
+def tile_server(tmp_path):
+    """Zipped synthetic LAS tiles behind a local http.server.  Returns their URLs."""
+    directory = tmp_path / 'srv'
+    directory.mkdir()
+    for i in range(4):
+        las = directory / f't{i}.las'
+        benchmark.write_synthetic_las(str(las), 24, seed=i)
+        with zipfile.ZipFile(directory / f't{i}.zip', 'w') as z:
+            z.write(las, las.name)
+        las.unlink()
+    httpd, url = serve_directory(directory)
+    yield [f'{url}/t{i}.zip' for i in range(4)]
+    httpd.shutdown()
+    httpd.server_close()
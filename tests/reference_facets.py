@@ -1,6 +1,7 @@
 """
 A collection of methods that will write a single polygonal facet
-to a binary STL file.
+to a binary STL file.  This is the original one facet at a time writer,
+kept only as the reference stltools.facetarray is tested against.
 https://github.com/r-barnes/DEMto3D
 """
 
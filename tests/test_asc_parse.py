@@ -0,0 +1,131 @@
+import json
+import os
+import numpy as np
+import pytest
+import asc_parse
+from asc_parse import NO_DATA
+
+
+def write(file_name, text):
+    with open(file_name, 'w') as f:
+        f.write(text)
+    return str(file_name)
+
+
+BODY = '1 2 3\n4 5 6\n'
+
+
+def test_corner_headers(tmp_path):
+    name = write(tmp_path / 'a.asc', 'ncols 3\nnrows 2\nxllcorner 10\nyllcorner 20\ncellsize 0.5\n' + BODY)
+    header, data = asc_parse.read_asc(name)
+    assert (header.ncols, header.nrows, header.xllcorner, header.yllcorner, header.cellsize) == (3, 2, 10, 20, 0.5)
+    assert data.tolist() == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_center_headers_are_moved_to_the_corner(tmp_path):
+    name = write(tmp_path / 'a.asc', 'NCOLS 3\nNROWS 2\nXLLCENTER 10.25\nYLLCENTER 20.25\nCELLSIZE 0.5\n' + BODY)
+    header, _ = asc_parse.read_asc(name)
+    assert (header.xllcorner, header.yllcorner) == (10.0, 20.0)
+
+
+def test_the_files_nodata_value_is_remapped(tmp_path):
+    name = write(tmp_path / 'a.asc', 'ncols 3\nnrows 2\nxllcorner 0\nyllcorner 0\ncellsize 1\nNODATA_value -32768\n1 -32768 3\n-32768 5 -9999.5\n')
+    header, data = asc_parse.read_asc(name)
+    assert header.nodata_value == -32768
+    assert data.tolist() == [[1, NO_DATA, 3], [NO_DATA, 5, -9999.5]]
+    # The sidecar holds the remapped grid too
+    assert np.array_equal(np.load(name + asc_parse.SIDECAR_SUFFIX), data)
+
+
+@pytest.mark.parametrize('body', ['1 2 3\n4 5\n', '1 2 3\n4 x 6\n', '1 2 3\n4 5 6 7\n'])
+def test_malformed_bodies_are_refused(tmp_path, body):
+    name = write(tmp_path / 'a.asc', 'ncols 3\nnrows 2\nxllcorner 0\nyllcorner 0\ncellsize 1\n' + body)
+    with pytest.raises(ValueError):
+        asc_parse.read_asc(name)
+    assert not os.path.exists(name + asc_parse.SIDECAR_SUFFIX)
+
+
+def test_sidecar_is_reused_until_the_asc_changes(tmp_path):
+    name = write(tmp_path / 'a.asc', 'ncols 3\nnrows 2\nxllcorner 0\nyllcorner 0\ncellsize 1\n' + BODY)
+    sidecar = name + asc_parse.SIDECAR_SUFFIX
+    asc_parse.read_asc(name)
+    assert os.path.exists(sidecar)
+    # Reads after the first are memory mapped from the sidecar, not parsed
+    _, data = asc_parse.read_asc(name)
+    assert isinstance(data, np.memmap) and data.tolist() == [[1, 2, 3], [4, 5, 6]]
+    del data
+
+    # Edited after the sidecar was made
+    write(name, 'ncols 3\nnrows 2\nxllcorner 0\nyllcorner 0\ncellsize 1\n7 8 9\n1 2 3\n')
+    earlier = os.path.getmtime(name) - 10
+    os.utime(sidecar, (earlier, earlier))
+    _, data = asc_parse.read_asc(name)
+    assert not isinstance(data, np.memmap) and data.tolist() == [[7, 8, 9], [1, 2, 3]]
+    # The rebuilt sidecar is used from then on
+    _, data = asc_parse.read_asc(name)
+    assert isinstance(data, np.memmap) and data.tolist() == [[7, 8, 9], [1, 2, 3]]
+
+
+def test_sidecars_of_the_wrong_shape_are_ignored(tmp_path):
+    name = write(tmp_path / 'a.asc', 'ncols 3\nnrows 2\nxllcorner 0\nyllcorner 0\ncellsize 1\n' + BODY)
+    np.save(name + asc_parse.SIDECAR_SUFFIX, np.zeros((3, 2), dtype=np.float32))
+    later = os.path.getmtime(name) + 10
+    os.utime(name + asc_parse.SIDECAR_SUFFIX, (later, later))
+    _, data = asc_parse.read_asc(name)
+    assert data.tolist() == [[1, 2, 3], [4, 5, 6]]
+
+
+def write_dtm(file_name, low):
+    data = np.full((4, 5), low + 10, dtype=np.float32)
+    data[1, 2] = low
+    data[0, 0] = NO_DATA
+    asc_parse.write_dtm(str(file_name), asc_parse.AscHeader(ncols=5, nrows=4, xllcorner=0.0, yllcorner=0.0, cellsize=1.0), data)
+    return str(file_name)
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    # The tiles read for their stats
+    scanned = []
+    original = asc_parse.tile_stats
+    monkeypatch.setattr(asc_parse, 'tile_stats', lambda source: scanned.append(source) or original(source))
+    return scanned
+
+
+def test_stats_index_is_reused_until_a_tile_changes(tmp_path, scans):
+    tiles = [write_dtm(tmp_path / 'a.dtm', 50.0), write_dtm(tmp_path / 'b.dtm', 30.0)]
+    index_file = str(tmp_path / asc_parse.STATS_INDEX)
+    assert asc_parse.base_for_stls(tiles, index_file) == 30.0
+    assert scans == tiles
+    stats = json.load(open(index_file))
+    assert stats[tiles[1]] == {**stats[tiles[1]], 'min': 30.0, 'max': 40.0, 'nodata': 1, 'nrows': 4, 'ncols': 5}
+
+    scans.clear()
+    assert asc_parse.base_for_stls(tiles, index_file) == 30.0
+    assert scans == []
+
+    # Regridding a tile makes it scanned again, and only it
+    write_dtm(tiles[0], 20.0)
+    later = os.path.getmtime(tiles[0]) + 10
+    os.utime(tiles[0], (later, later))
+    assert asc_parse.base_for_stls(tiles, index_file) == 20.0
+    assert scans == [tiles[0]]
+    assert json.load(open(index_file))[tiles[0]]['mtime'] == later
+
+
+def test_stats_index_sits_next_to_the_tiles(tmp_path, scans):
+    tiles = [write_dtm(tmp_path / 'a.dtm', 50.0)]
+    assert asc_parse.base_for_stls(tiles) == 50.0
+    assert os.path.exists(tmp_path / asc_parse.STATS_INDEX)
+    # A given base skips the scan altogether
+    scans.clear()
+    assert asc_parse.base_for_stls([write_dtm(tmp_path / 'b.dtm', 1.0)], lowest_value=5) == 5.0
+    assert scans == []
+
+
+def test_tiles_dropped_from_the_list_drop_out_of_the_index(tmp_path, scans):
+    tiles = [write_dtm(tmp_path / 'a.dtm', 50.0), write_dtm(tmp_path / 'b.dtm', 30.0)]
+    index_file = str(tmp_path / asc_parse.STATS_INDEX)
+    asc_parse.base_for_stls(tiles, index_file)
+    assert asc_parse.base_for_stls(tiles[:1], index_file) == 50.0
+    assert list(json.load(open(index_file))) == tiles[:1]
@@ -0,0 +1,33 @@
+import json
+import build_cache
+
+
+def test_records_are_saved_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_cache, 'SAVE_INTERVAL', 3600)
+    manifest = tmp_path / 'build_cache.json'
+    source = tmp_path / 'source.txt'
+    source.write_text('points')
+    cache = build_cache.BuildCache(str(manifest))
+    outputs = []
+    for i in range(100):
+        output = tmp_path / f'out{i}.txt'
+        output.write_text(str(i))
+        outputs.append(str(output))
+        cache.record('grid', [str(output)], [str(source)], {'reduce': 1.0})
+    # Nothing is written until the interval is up or the cache is flushed
+    assert not manifest.exists()
+    cache.flush()
+    assert len(json.loads(manifest.read_text())['artifacts']) == 100
+
+    again = build_cache.BuildCache(str(manifest))
+    assert all(again.is_fresh('grid', [o], [str(source)], {'reduce': 1.0}) for o in outputs)
+    assert not again.is_fresh('grid', outputs[:1], [str(source)], {'reduce': 2.0})
+
+
+def test_records_are_saved_once_the_interval_is_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_cache, 'SAVE_INTERVAL', 0)
+    manifest = tmp_path / 'build_cache.json'
+    output = tmp_path / 'out.txt'
+    output.write_text('model')
+    build_cache.BuildCache(str(manifest)).record('stl', [str(output)], [], {})
+    assert str(output) in json.loads(manifest.read_text())['artifacts']
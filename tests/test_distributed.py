@@ -0,0 +1,107 @@
+import json
+import os
+import socket
+import threading
+import time
+import pytest
+import convert
+import distributed
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def coordinate(tile_urls, **options):
+    tiles = [convert.Tile(url.rsplit('/', 1)[1].removesuffix('.zip'), url) for url in tile_urls]
+    return distributed.Coordinator(convert.Config(vertical_scale=2), tiles, **options)
+
+
+def test_several_local_workers_run_end_to_end(tile_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    coordinator = coordinate(tile_server)
+    failures = distributed.run_coordinator(coordinator, ('127.0.0.1', 0), local_workers=2, results_file='results.json', processes=1)
+    assert failures == []
+
+    with open('results.json') as f:
+        results = json.load(f)
+    assert len(results['tiles']) == 4
+    # The base is the lowest of the lowest points the workers reported
+    minimums = {t['name']: t['grid']['result']['stats']['min'] for t in results['tiles']}
+    assert results['base_elevation'] == min(minimums.values())
+    for tile in results['tiles']:
+        assert tile['grid']['status'] == tile['model']['status'] == 'done'
+        # Models are made by the worker that gridded the tile, which already has its DEM
+        assert tile['model']['worker'] == tile['grid']['worker']
+        (model,) = tile['model']['result']['outputs']
+        assert model['file'].endswith(os.path.join('STL', f'{tile["name"]}.stl'))
+        assert os.path.getsize(model['file']) == model['bytes'] > 0
+
+
+def test_lease_expires_when_a_worker_is_killed(tile_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    coordinator = coordinate(tile_server, lease_seconds=2.0, heartbeat_seconds=0.5)
+    address = ('127.0.0.1', free_port())
+    run = threading.Thread(target=distributed.run_coordinator, args=(coordinator, address), kwargs={'results_file': 'results.json'})
+    run.start()
+
+    (doomed,) = distributed.start_local_workers(1, address, 'doomed', processes=1)
+    deadline = time.monotonic() + 60
+    while True:
+        assert time.monotonic() < deadline, 'The worker never leased a tile'
+        with coordinator.lock:
+            leased = [t for t in coordinator.tasks if t.status == 'leased']
+            if leased:
+                # Killed while holding the lock, so it can't report the tile first
+                doomed.kill()
+                doomed.wait()
+                lost, dead_worker = leased[0], leased[0].worker
+                break
+        time.sleep(0.01)
+
+    (survivor,) = distributed.start_local_workers(1, address, 'survivor', processes=1)
+    run.join(timeout=120)
+    survivor.wait(timeout=30)
+    assert not run.is_alive()
+
+    assert coordinator.failures() == []
+    # The lost tile's lease ran out and it went to the other worker
+    assert lost.attempts == 2
+    assert lost.worker != dead_worker
+    assert all(t.status == 'done' for t in coordinator.tasks)
+    models = [t for t in coordinator.tasks if t.round == 'model']
+    assert len(models) == 4
+    for t in models:
+        assert os.path.exists(os.path.join('survivor', 'worker0', 'STL', f'{t.name}.stl'))
+        assert t.result['outputs'][0]['file'] == os.path.abspath(os.path.join('survivor', 'worker0', 'STL', f'{t.name}.stl'))
+
+
+def test_late_reports_are_ignored(tile_server):
+    coordinator = coordinate(tile_server[:1], lease_seconds=0.1)
+    worker = coordinator.handle({'op': 'hello', 'host': 'test', 'pid': 1})['worker']
+    task = coordinator.handle({'op': 'lease', 'worker': worker})['task']
+    time.sleep(0.2)
+    with coordinator.lock:
+        coordinator.expire()
+    assert coordinator.handle({'op': 'report', 'worker': worker, 'lease': task['lease'], 'ok': True, 'result': {}}) == {'ok': False}
+    assert coordinator.tasks[0].status == 'queued'
+
+
+def test_tiles_that_keep_failing_are_given_up_on(tile_server):
+    coordinator = coordinate(tile_server[:1], max_attempts=2)
+    worker = coordinator.handle({'op': 'hello', 'host': 'test', 'pid': 1})['worker']
+    for _ in range(2):
+        task = coordinator.handle({'op': 'lease', 'worker': worker})['task']
+        assert coordinator.handle({'op': 'report', 'worker': worker, 'lease': task['lease'], 'ok': False, 'error': 'boom'}) == {'ok': True}
+    assert coordinator.finished.is_set()
+    assert [t.error for t in coordinator.failures()] == ['boom']
+    assert coordinator.handle({'op': 'lease', 'worker': worker}) == {'done': True}
+
+
+def test_unsupported_settings_are_refused(tile_server):
+    tiles = [convert.Tile('t0', tile_server[0])]
+    for config in (convert.Config(merge_las=True), convert.Config(bbox=(0, 0, 1, 1)), convert.Config(external_files=True)):
+        with pytest.raises(ValueError):
+            distributed.Coordinator(config, tiles)
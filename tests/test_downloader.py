@@ -0,0 +1,99 @@
+import hashlib
+import json
+import re
+import pytest
+from conftest import QuietHandler, serve_directory
+from downloader import Downloader, DownloadError
+
+DATA = bytes(range(256)) * 400
+ETAG = f'"{hashlib.md5(DATA).hexdigest()}"'
+
+
+class RangeHandler(QuietHandler):
+    # Serves DATA at any path, honouring Range and If-Range the way S3 does
+    def do_GET(self):
+        start = 0
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(match.group(1))
+        if start >= len(DATA):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(DATA) - 1}/{len(DATA)}')
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(DATA[start:])
+
+
+@pytest.fixture
+def plain_server(tmp_path):
+    """http.server, which ignores Range, serving DATA as data.bin"""
+    directory = tmp_path / 'srv'
+    directory.mkdir()
+    (directory / 'data.bin').write_bytes(DATA)
+    httpd, url = serve_directory(directory)
+    yield url
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    httpd, url = serve_directory(tmp_path, RangeHandler)
+    yield url
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def downloader():
+    return Downloader(concurrency=2, retries=2, backoff=0)
+
+
+def test_stale_part_is_replaced_when_the_server_ignores_range(plain_server, tmp_path):
+    destination = tmp_path / 'data.bin'
+    (tmp_path / 'data.bin.part').write_bytes(b'stale' * 10000)
+    result = downloader().download(f'{plain_server}/data.bin', str(destination))
+    assert destination.read_bytes() == DATA
+    assert result.resumed_from == 0 and result.bytes == len(DATA)
+    assert not (tmp_path / 'data.bin.part').exists()
+    assert not (tmp_path / 'data.bin.part.json').exists()
+
+
+def test_missing_files_fail_without_retrying(plain_server, tmp_path):
+    with pytest.raises(DownloadError, match='404') as e:
+        downloader().download(f'{plain_server}/missing.bin', str(tmp_path / 'missing.bin'))
+    assert not e.value.retry
+    assert not (tmp_path / 'missing.bin').exists()
+
+
+def test_partial_downloads_resume(range_server, tmp_path):
+    destination = tmp_path / 'data.bin'
+    (tmp_path / 'data.bin.part').write_bytes(DATA[:10000])
+    (tmp_path / 'data.bin.part.json').write_text(json.dumps({'etag': ETAG}))
+    result = downloader().download(f'{range_server}/data.bin', str(destination))
+    assert destination.read_bytes() == DATA
+    assert result.resumed_from == 10000
+    assert result.bytes == len(DATA) - 10000
+
+
+def test_changed_files_are_downloaded_again(range_server, tmp_path):
+    # The part's ETag doesn't match any more, so If-Range gets the whole new file
+    destination = tmp_path / 'data.bin'
+    (tmp_path / 'data.bin.part').write_bytes(b'x' * 10000)
+    (tmp_path / 'data.bin.part.json').write_text(json.dumps({'etag': '"0123456789abcdef0123456789abcdef"'}))
+    result = downloader().download(f'{range_server}/data.bin', str(destination))
+    assert destination.read_bytes() == DATA
+    assert result.resumed_from == 0 and result.bytes == len(DATA)
+
+
+def test_parts_longer_than_the_file_start_over(range_server, tmp_path):
+    destination = tmp_path / 'data.bin'
+    (tmp_path / 'data.bin.part').write_bytes(DATA + b'extra')
+    result = downloader().download(f'{range_server}/data.bin', str(destination))
+    assert destination.read_bytes() == DATA
+    assert result.attempts == 2
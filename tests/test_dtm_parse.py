@@ -0,0 +1,78 @@
+import struct
+import numpy as np
+import asc_parse
+import dtm_parse
+
+NODATA = -9999.0
+
+
+def grid():
+    # Every cell different, so a flipped row or column order can't read back the same
+    data = np.arange(5 * 3, dtype=np.float32).reshape(5, 3) * 1.5 + 100
+    data[0, 2] = NODATA
+    return data
+
+
+def header(**fields):
+    return dtm_parse.DtmHeader(ncols=3, nrows=5, origin_x=500000.5, origin_y=4000000.5, column_spacing=1.0, row_spacing=1.0, name='tile', **fields)
+
+
+def test_round_trip(tmp_path):
+    file_name = str(tmp_path / 'tile.dtm')
+    dtm_parse.write_dtm(file_name, header(), grid(), NODATA, band_cols=2)
+    read, data = dtm_parse.read_dtm(file_name, nodata=NODATA)
+    assert np.array_equal(data, grid())
+    assert (read.ncols, read.nrows, read.origin_x, read.origin_y, read.name) == (3, 5, 500000.5, 4000000.5, 'tile')
+    assert (read.min_z, read.max_z) == (100.0, 100 + 14 * 1.5)
+
+
+def test_header_fields_and_layout_on_disk(tmp_path):
+    file_name = tmp_path / 'tile.dtm'
+    dtm_parse.write_dtm(str(file_name), header(), grid(), NODATA)
+    raw = file_name.read_bytes()
+    assert len(raw) == dtm_parse.HEADER_SIZE + 5 * 3 * 4
+    assert raw.startswith(dtm_parse.SIGNATURE)
+    assert raw[21:25] == b'tile'
+    assert struct.unpack_from('<f', raw, 82)[0] == 3.0
+    assert struct.unpack_from('<2d', raw, 86) == (500000.5, 4000000.5)
+    assert struct.unpack_from('<2d', raw, 126) == (1.0, 1.0)
+    assert struct.unpack_from('<2i', raw, 142) == (3, 5)
+    # Float elevations
+    assert struct.unpack_from('<h', raw, 154)[0] == 2
+    # Columns west to east, each from the south row up, voids as -1
+    values = np.frombuffer(raw, '<f4', offset=dtm_parse.HEADER_SIZE)
+    assert values[:5].tolist() == grid()[::-1, 0].tolist()
+    assert values[10:].tolist() == grid()[:0:-1, 2].tolist() + [dtm_parse.DTM_NODATA]
+
+
+def test_voids_are_mapped_to_nodata(tmp_path):
+    file_name = str(tmp_path / 'tile.dtm')
+    dtm_parse.write_dtm(file_name, header(), grid(), NODATA)
+    _, data = dtm_parse.read_dtm(file_name)
+    assert data[0, 2] == dtm_parse.DTM_NODATA
+    _, data = dtm_parse.read_dtm(file_name, nodata=NODATA)
+    assert data[0, 2] == NODATA
+    assert np.count_nonzero(data == NODATA) == 1
+
+
+def test_bias_is_added_to_integer_elevations(tmp_path):
+    # A version 3.1 file of 2 byte integers, 1000 below their real elevations
+    columns = np.array([[1, 2], [3, dtm_parse.DTM_NODATA]], dtype='<i2')
+    fields = dtm_parse._FIELDS.pack(dtm_parse.SIGNATURE, b'biased', 3.1, 10.0, 20.0, 1001.0, 1003.0, 0.0, 2.0, 2.0,
+                                    2, 2, 1, 1, 0, 0, 0, 0, 0)
+    raw = (fields + dtm_parse._BIAS.pack(1000.0)).ljust(dtm_parse.HEADER_SIZE, b'\0') + columns.tobytes()
+    file_name = tmp_path / 'biased.dtm'
+    file_name.write_bytes(raw)
+    read, data = dtm_parse.read_dtm(str(file_name), nodata=NODATA)
+    assert (read.version, read.bias, read.z_bytes) == (3.1, 1000.0, 0)
+    # North row first, and voids stay voids whatever the bias
+    assert data.tolist() == [[1002.0, NODATA], [1001.0, 1003.0]]
+
+
+def test_asc_headers_survive_the_trip(tmp_path):
+    asc = asc_parse.AscHeader(ncols=3, nrows=5, xllcorner=500000.0, yllcorner=4000000.0, cellsize=1.0)
+    file_name = str(tmp_path / 'tile.dtm')
+    asc_parse.write_dtm(file_name, asc, grid())
+    assert asc_parse.raster_header(file_name) == asc
+    _, data = asc_parse.read_dtm(file_name)
+    assert np.array_equal(data, grid())
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import reference_facets
+from stltools import facetarray
+
+
+def calculate_row(heightmap, y, hs):
+    # The original row writer, one facet at a time
+    facets = bytearray()
+    height = heightmap.shape[0] - 1
+    width  = heightmap.shape[1] - 1
+    facets += reference_facets.writeEastFacet(x=0,     y=y, heightmap=heightmap, hs=hs)
+    facets += reference_facets.writeWestFacet(x=width, y=y, heightmap=heightmap, hs=hs)
+    for x in range(width):
+        if y == 0:
+            facets += reference_facets.writeNorthFacet(x=x, y=y,   heightmap=heightmap, hs=hs)
+        elif y == height-1:
+            facets += reference_facets.writeSouthFacet(x=x, y=y+1, heightmap=heightmap, hs=hs)
+        facets += reference_facets.writeBottomFacet(x=x, y=y, z=0, hs=hs)
+        facets += reference_facets.writeTopFacet   (x=x, y=y, hs=hs, heightmap=heightmap)
+    return facets
+
+
+@pytest.mark.parametrize('shape', [(9, 7), (2, 5), (3, 3)])
+def test_vertices_match_the_facet_writers(shape):
+    heightmap = np.random.default_rng(0).uniform(1, 10, shape)
+    expected = b''.join(calculate_row(heightmap, y, 0.5) for y in range(shape[0] - 1))
+    expected = np.frombuffer(expected, dtype=facetarray.STL_FACET)
+    facets = facetarray.heightmap_facets(heightmap, 0.5)
+    assert len(facets) == facetarray.count_row_facets(shape[1] - 1, shape[0] - 1, 0, shape[0] - 1)
+    assert facets['vertices'].tobytes() == expected['vertices'].tobytes()
@@ -0,0 +1,84 @@
+import zipfile
+import xml.etree.ElementTree as ET
+import numpy as np
+import pytest
+import benchmark
+from stltools import indexedmesh, simplify, stlgenerator
+
+NAMESPACE = {'m': 'http://schemas.microsoft.com/3dmanufacturing/core/2015/02'}
+
+
+def heightmap(rows=7, cols=11):
+    return benchmark.synthetic_heightmap(max(rows, cols))[:rows, :cols] / 10
+
+
+def read_ply(file_name):
+    data = open(file_name, 'rb').read()
+    end = data.index(b'end_header\n') + len(b'end_header\n')
+    header = data[:end].decode().splitlines()
+    counts = {line.split()[1]: int(line.split()[2]) for line in header if line.startswith('element')}
+    vertices = np.frombuffer(data, '<f4', counts['vertex'] * 3, end).reshape(-1, 3)
+    records = np.frombuffer(data, indexedmesh.PLY_FACE, counts['face'], end + vertices.nbytes)
+    assert end + vertices.nbytes + records.nbytes == len(data)
+    assert (records['count'] == 3).all()
+    return counts, vertices, records['indices']
+
+
+def check_closed(faces, vertex_count):
+    # Every edge is shared by exactly two faces, which go along it in opposite directions
+    assert faces.max() < vertex_count
+    edges = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])).astype(np.int64)
+    directed = edges[:, 0] * vertex_count + edges[:, 1]
+    reversed_ = edges[:, 1] * vertex_count + edges[:, 0]
+    assert len(np.unique(directed)) == len(directed)
+    assert np.array_equal(np.sort(directed), np.sort(reversed_))
+
+
+@pytest.mark.parametrize('shape', [(7, 11), (2, 2), (30, 3)])
+def test_ply_counts_and_edges(tmp_path, shape):
+    hm = heightmap(*shape)
+    destination = str(tmp_path / 'model.ply')
+    indexedmesh.write_ply(destination, indexedmesh.grid_vertices(hm, 0.5), indexedmesh.grid_face_bands(hm, band_rows=2), indexedmesh.count_grid_faces(*shape))
+    counts, vertices, faces = read_ply(destination)
+    assert counts == {'vertex': indexedmesh.count_grid_vertices(*shape), 'face': indexedmesh.count_grid_faces(*shape)}
+    assert np.array_equal(vertices[:hm.size, 2], hm.ravel())
+    check_closed(faces, len(vertices))
+
+
+def test_3mf_is_valid_xml_and_closed(tmp_path):
+    hm = heightmap()
+    destination = str(tmp_path / 'model.3mf')
+    indexedmesh.write_3mf(destination, indexedmesh.grid_vertices(hm, 0.5), indexedmesh.grid_face_bands(hm), indexedmesh.count_grid_faces(*hm.shape), objectname='Hills & <valleys>')
+    with zipfile.ZipFile(destination) as z:
+        assert {'[Content_Types].xml', '_rels/.rels', '3D/3dmodel.model'} <= set(z.namelist())
+        ET.fromstring(z.read('[Content_Types].xml'))
+        ET.fromstring(z.read('_rels/.rels'))
+        model = ET.fromstring(z.read('3D/3dmodel.model'))
+    assert model.find('m:metadata', NAMESPACE).text == 'Hills & <valleys>'
+    vertices = model.findall('.//m:vertex', NAMESPACE)
+    triangles = model.findall('.//m:triangle', NAMESPACE)
+    assert len(vertices) == indexedmesh.count_grid_vertices(*hm.shape)
+    assert len(triangles) == indexedmesh.count_grid_faces(*hm.shape)
+    faces = np.array([[int(t.get(v)) for v in ('v1', 'v2', 'v3')] for t in triangles])
+    check_closed(faces, len(vertices))
+
+
+def test_indexed_simplified_meshes_are_closed(tmp_path):
+    y, x = np.mgrid[0:65, 0:65] / 65
+    hm = np.sin(4 * x) * np.cos(3 * y) * 3 + 10
+    vertices, faces = indexedmesh.index_triangles(simplify.simplified_triangles(hm, 1.0, 0.05))
+    check_closed(faces, len(vertices))
+
+
+def test_face_counts_are_checked(tmp_path):
+    hm = heightmap()
+    with pytest.raises(ValueError, match='declared'):
+        indexedmesh.write_ply(str(tmp_path / 'model.ply'), indexedmesh.grid_vertices(hm, 1.0), indexedmesh.grid_face_bands(hm), 1)
+
+
+def test_benchmark_counts_the_faces_it_writes(tmp_path):
+    hm = benchmark.synthetic_heightmap(32)
+    destination = str(tmp_path / 'model.ply')
+    stlgenerator.generate_from_heightmap_array(hm, destination, format='ply', multiprocessing=False, **benchmark.STL_OPTIONS)
+    counts, _, _ = read_ply(destination)
+    assert counts['face'] == benchmark.ply_faces(32)
@@ -0,0 +1,95 @@
+import json
+import pytest
+import instrument
+import scheduler
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    return instrument.Tracer(str(tmp_path / 'trace.jsonl'))
+
+
+def test_spans_record_their_stage(tracer, tmp_path):
+    source, made = tmp_path / 'in.las', tmp_path / 'out.dtm'
+    source.write_bytes(b'x' * 1000)
+    with tracer.span('grid', 't0', [str(source)], [str(made)]):
+        made.write_bytes(b'y' * 300)
+    (record,) = tracer.records()
+    assert (record['stage'], record['tile'], record['status']) == ('grid', 't0', 'ok')
+    assert (record['input_bytes'], record['output_bytes']) == (1000, 300)
+    assert record['wall'] >= 0 and record['cpu'] >= 0
+    assert record['exit_status'] is None and record['tools'] == []
+
+
+def test_failed_spans_are_recorded_and_raised(tracer, tmp_path):
+    made = tmp_path / 'out.dtm'
+    with pytest.raises(KeyError):
+        with tracer.span('grid', 't0', [], [str(made)]):
+            made.write_bytes(b'half')
+            raise KeyError('boom')
+    (record,) = tracer.records()
+    assert record['status'] == 'failed' and 'boom' in record['error']
+    # A half written output isn't counted
+    assert record['output_bytes'] == 0
+
+
+def test_failing_tools_fail_their_tile(tracer):
+    def unzip(item):
+        instrument.run_tool('true')
+        instrument.run_tool('exit 3')
+        return item
+
+    stage = scheduler.Stage('unzip', instrument.Traced(tracer, 'unzip', unzip))
+    finished, failures = scheduler.run_pipeline(['t0'], [stage])
+    assert finished == []
+    ((name, item, error),) = failures
+    assert (name, item) == ('unzip', 't0')
+    assert isinstance(error, instrument.ToolError) and error.exit_status == 3
+    (record,) = tracer.records()
+    assert record['status'] == 'failed' and record['exit_status'] == 3
+    assert [t['exit_status'] for t in record['tools']] == [0, 3]
+
+
+def test_tools_outside_a_span_still_raise():
+    instrument.run_tool('true')
+    with pytest.raises(instrument.ToolError):
+        instrument.run_tool('exit 1')
+
+
+def test_summary_adds_up_each_stage(tracer, tmp_path):
+    made = tmp_path / 'out'
+    made.write_bytes(b'z' * 2_000_000)
+    for tile in ('t0', 't1'):
+        with tracer.span('grid', tile, [], [str(made)]):
+            pass
+    tracer.cached('grid', 't2')
+    with pytest.raises(RuntimeError):
+        with tracer.span('stl', 't0'):
+            raise RuntimeError
+    # Spans from another run in the same file are left out
+    instrument.Tracer(tracer.trace_file).cached('grid', 'other')
+
+    header, grid, stl = tracer.summary().splitlines()
+    assert header.split() == ['stage', 'ok', 'failed', 'cached', 'wall', 's', 'cpu', 's', 'peak', 'MB', 'input', 'MB', 'output', 'MB']
+    grid = grid.split()
+    assert grid[:4] == ['grid', '2', '0', '1']
+    assert grid[-1] == '4.0'
+    assert stl.split()[:4] == ['stl', '0', '1', '0']
+    assert len([json.loads(line) for line in open(tracer.trace_file)]) == 5
+
+
+def test_profiles_are_saved_or_skipped_out_loud(tmp_path, monkeypatch, capsys):
+    tracer = instrument.Tracer(str(tmp_path / 'trace.jsonl'), str(tmp_path / 'profiles'))
+    with tracer.span('grid', 't0'):
+        sum(range(1000))
+    assert (tmp_path / 'profiles' / 'grid-t0.prof').exists()
+
+    class Busy:
+        def enable(self):
+            raise ValueError('Another profiling tool is already active')
+
+    monkeypatch.setattr(instrument.cProfile, 'Profile', Busy)
+    with tracer.span('grid', 't1'):
+        pass
+    assert 'Not profiling grid for t1' in capsys.readouterr().out
+    assert not (tmp_path / 'profiles' / 'grid-t1.prof').exists()
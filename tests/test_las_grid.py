@@ -0,0 +1,147 @@
+import struct
+import zipfile
+import numpy as np
+import pytest
+import benchmark
+import las_grid
+from asc_parse import NO_DATA
+
+
+def binner(method='mean'):
+    return las_grid.CellBinner(las_grid.grid_header_for_bounds(0.0, 0.0, 10.0, 10.0, 1.0), method)
+
+
+def test_bounds_are_inside_the_grid():
+    index, inside = binner().cell_index(np.array([0.0, 5.0, 10.0]), np.array([0.0, 5.0, 10.0]))
+    assert inside.all()
+    # 11 x 11 cells, row 0 is the north edge
+    assert index.tolist() == [10 * 11 + 0, 5 * 11 + 5, 0 * 11 + 10]
+
+
+def test_boundary_points_go_north_and_east():
+    # A point on a cell boundary belongs to the cell it's the south west corner of, on both axes
+    b = binner()
+    index, inside = b.cell_index(np.array([3.0, 3.0]), np.array([3.0, 2.999]))
+    assert inside.all()
+    rows, cols = np.divmod(index, b.header.ncols)
+    assert cols.tolist() == [3, 3]
+    assert rows.tolist() == [10 - 3, 10 - 2]
+
+
+def test_points_outside_are_dropped():
+    _, inside = binner().cell_index(np.array([-0.001, 11.0, 5.0, 5.0]), np.array([5.0, 5.0, -0.001, 11.0]))
+    assert not inside.any()
+
+
+def write_tile(file_name, x_offset=0.0, y_offset=0.0, size=24, seed=0):
+    # A synthetic LAS tile moved x_offset, y_offset meters from the usual origin
+    benchmark.write_synthetic_las(file_name, size, seed)
+    with open(file_name, 'r+b') as f:
+        raw = bytearray(f.read(227))
+        offset = list(struct.unpack_from('<3d', raw, 155))
+        bounds = list(struct.unpack_from('<6d', raw, 179))
+        offset[0] += x_offset
+        offset[1] += y_offset
+        bounds[0:2] = [b + x_offset for b in bounds[0:2]]
+        bounds[2:4] = [b + y_offset for b in bounds[2:4]]
+        struct.pack_into('<3d', raw, 155, *offset)
+        struct.pack_into('<6d', raw, 179, *bounds)
+        f.seek(0)
+        f.write(raw)
+    return file_name
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_zips_grid_the_same_as_their_las(tmp_path, monkeypatch, compression):
+    # Chunks smaller than the tile, and not a whole number of them
+    monkeypatch.setattr(las_grid, 'CHUNK_SIZE', 333)
+    las = write_tile(str(tmp_path / 'tile.las'))
+    with zipfile.ZipFile(tmp_path / 'tile.zip', 'w', compression) as z:
+        z.write(las, 'tile.las')
+    from_las = las_grid.grid_las([las], cell_size=0.5)
+    from_zip = las_grid.grid_las([str(tmp_path / 'tile.zip')], cell_size=0.5)
+    assert from_zip[0] == from_las[0]
+    assert np.array_equal(from_zip[1], from_las[1])
+
+
+def test_truncated_zips_are_refused(tmp_path):
+    las = write_tile(str(tmp_path / 'tile.las'))
+    data = open(las, 'rb').read()
+    with zipfile.ZipFile(tmp_path / 'tile.zip', 'w') as z:
+        z.writestr('tile.las', data[:-1000])
+    with pytest.raises(ValueError, match='early'):
+        las_grid.grid_las([str(tmp_path / 'tile.zip')])
+
+
+@pytest.fixture(scope='module')
+def tiles(tmp_path_factory):
+    # Four neighbouring tiles, overlapping by a couple of meters like real ones do
+    directory = tmp_path_factory.mktemp('tiles')
+    return [write_tile(str(directory / f't{i}.las'), 22 * (i % 2), 22 * (i // 2), seed=i) for i in range(4)]
+
+
+@pytest.mark.parametrize('method', ['mean', 'max'])
+def test_mosaics_match_across_worker_counts_and_bands(tiles, tmp_path, method):
+    options = dict(cell_size=0.5, method=method, spike=40)
+    header, reference = las_grid.mosaic_las(tiles, str(tmp_path / 'reference.npy'), processes=1, **options)
+    reference = np.array(reference)
+    # Bands of a few rows put band edges, and so halos, all over the tile borders
+    for processes, band_rows in ((2, 5), (3, 1), (1, 7)):
+        other_header, mosaic = las_grid.mosaic_las(tiles, str(tmp_path / f'{processes}.npy'), processes=processes, band_rows=band_rows, **options)
+        assert other_header == header
+        assert np.array_equal(mosaic, reference)
+    # And it's the same DEM as gridding every tile in one go
+    whole_header, whole = las_grid.grid_las(tiles, **options)
+    assert whole_header == header
+    assert np.allclose(whole, reference, atol=1e-4)
+
+
+def test_holes_get_the_mean_of_their_neighbours():
+    grid = np.full((5, 5), 10.0, dtype=np.float32)
+    grid[0, 1:] = 20.0
+    grid[1, 1] = NO_DATA
+    grid[0, 0] = NO_DATA
+    filled = las_grid.fill_holes(grid)
+    # Five neighbours at 10 and two at 20, the other hole doesn't count
+    assert filled[1, 1] == pytest.approx((5 * 10 + 2 * 20) / 7)
+    # A corner only has the neighbours inside the grid
+    assert filled[0, 0] == pytest.approx((20 + 10) / 2)
+
+
+def test_big_gaps_are_only_filled_in_from_their_edges():
+    grid = np.full((9, 9), 5.0, dtype=np.float32)
+    grid[2:7, 2:7] = NO_DATA
+    filled = las_grid.fill_holes(grid)
+    assert (filled[2:7, 2:7][[0, -1]] == 5).all() and (filled[3:6, 3:6][[0, -1]] == 5).all()
+    # Two passes reach two cells in, the middle of the gap stays empty
+    assert filled[4, 4] == NO_DATA
+    assert (las_grid.fill_holes(grid, passes=3) == 5).all()
+
+
+def test_only_steep_spikes_are_knocked_down():
+    grid = np.full((5, 6), 100.0, dtype=np.float32)
+    grid[1, 1] = 110.0    # 1000% above its neighbours
+    grid[3, 4] = 100.3    # only 30%
+    grid[2, 2] = 90.0     # pits are left alone
+    grid[4, 0] = NO_DATA
+    result = las_grid.suppress_spikes(grid, 1.0, 50)
+    assert result[1, 1] == 100.0
+    assert result[3, 4] == np.float32(100.3)
+    assert result[2, 2] == 90.0
+    assert result[4, 0] == NO_DATA
+    # A gentler slope limit catches the smaller bump too
+    assert las_grid.suppress_spikes(grid, 1.0, 20)[3, 4] == 100.0
+
+
+def test_spikes_are_measured_against_the_cell_size():
+    grid = np.full((3, 3), 100.0, dtype=np.float32)
+    grid[1, 1] = 103.0
+    # 3m over 10m cells is a 30% slope, over 1m cells it's 300%
+    assert las_grid.suppress_spikes(grid, 10.0, 50)[1, 1] == 103.0
+    assert las_grid.suppress_spikes(grid, 1.0, 50)[1, 1] == 100.0
+
+
+def test_lone_cells_are_left_as_they_are():
+    grid = np.full((3, 3), NO_DATA, dtype=np.float32)
+    grid[1, 1] = 50.0
+    assert np.array_equal(las_grid.suppress_spikes(grid, 1.0, 10), grid)
@@ -0,0 +1,76 @@
+import cv2
+import numpy as np
+import pytest
+import asc_parse
+import preview
+from stltools import facetarray
+from asc_parse import NO_DATA
+
+
+def write_raster(file_name, data, cellsize=1.0):
+    header = asc_parse.AscHeader(ncols=data.shape[1], nrows=data.shape[0], xllcorner=0.0, yllcorner=0.0, cellsize=cellsize)
+    asc_parse.write_dtm(str(file_name), header, data)
+    return str(file_name)
+
+
+def stl_z(file_name):
+    facets = np.frombuffer(open(file_name, 'rb').read(), dtype=facetarray.STL_FACET, offset=84)
+    return facets['vertices'][..., 2].ravel()
+
+
+def test_flat_ground_is_shaded_by_the_lights_altitude():
+    shaded = preview.hillshade(np.full((4, 4), 100.0), 1.0, altitude=30)
+    assert (shaded == int(255 * 0.5)).all()
+
+
+@pytest.mark.parametrize('azimuth, lit', [(0, 'north'), (90, 'east'), (180, 'south'), (270, 'west')])
+def test_slopes_facing_the_light_are_brightest(azimuth, lit):
+    rows, cols = np.mgrid[0:5, 0:5].astype(np.float64)
+    # Row 0 is north, so ground that climbs down the rows faces north
+    facing = {'north': rows, 'south': -rows, 'west': cols, 'east': -cols}
+    brightness = {side: preview.hillshade(z, 1.0, azimuth=azimuth).mean() for side, z in facing.items()}
+    assert max(brightness, key=brightness.get) == lit
+
+
+def test_previews_are_capped_in_size(tmp_path):
+    rows, cols = np.mgrid[0:1100, 0:700]
+    data = (100 + np.sin(rows / 50) + np.cos(cols / 40)).astype(np.float32)
+    data[:200, :100] = NO_DATA
+    source = write_raster(tmp_path / 'big.dtm', data)
+    png, model = preview.gen_preview(source, 'big', 100.0, directory=str(tmp_path / 'PREVIEW'))
+    image = cv2.imread(png, cv2.IMREAD_UNCHANGED)
+    stride = preview.preview_stride(data.shape)
+    assert stride == 3
+    assert image.shape == (367, 234) and max(image.shape) <= preview.PREVIEW_SIZE
+    # Voids are black
+    assert (image[:200 // 3, :100 // 3] == 0).all()
+    assert image[200 // 3 + 1:, 100 // 3 + 1:].min() > 0
+    # A model of the 367 x 234 vertex heightmap the PNG shows
+    facets = facetarray.count_row_facets(233, 366, 0, 366)
+    assert len(stl_z(model)) == 3 * facets
+
+
+def test_previews_get_the_full_models_base_and_scale(tmp_path):
+    data = np.full((40, 24), 120.0, dtype=np.float32)
+    data[0, 0] = 150.0
+    data[8:12, 8:12] = NO_DATA
+    source = write_raster(tmp_path / 'tile.dtm', data)
+    settings = dict(scale_adjustment=2.0, vscale=1.5, base=3.0)
+    lowest = 110.0
+
+    def expected(value, factor):
+        # How high a cell ends up: the same base and vertical scale, sized for the model's resolution
+        vsize = 1 / np.sqrt(settings['scale_adjustment'] * factor + 0.5) / 750
+        return (value - lowest + settings["base"]) * vsize
+
+    _, model = preview.gen_preview(source, 'tile', lowest, size=10, directory=str(tmp_path / 'PREVIEW'), **settings)
+    asc_parse.gen_stl_from_asc(source, 'tile', lowest, directory=str(tmp_path / 'STL'), multiprocessing=False, **settings)
+    full = stl_z(str(tmp_path / 'STL' / 'tile.stl'))
+    small = stl_z(model)
+    stride = preview.preview_stride(data.shape, 10)
+    assert stride == 4
+    for z, factor in ((full, 1), (small, stride)):
+        top = z[z > 0]
+        assert top.max() == pytest.approx(expected(150 * settings['vscale'], factor), rel=1e-5)
+        # Voids are filled in with the lowest elevation, then scaled like the rest
+        assert top.min() == pytest.approx(expected(lowest * settings['vscale'], factor), rel=1e-5)
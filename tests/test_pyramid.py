@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import asc_parse
+import pyramid
+
+NODATA = -9999.0
+
+
+def test_parse_lods():
+    assert pyramid.parse_lods('4, 1,2,2') == [1, 2, 4]
+    for text in ('', '0,1', '-2', 'x'):
+        with pytest.raises(ValueError):
+            pyramid.parse_lods(text)
+
+
+def test_blocks_are_averaged_without_their_nodata():
+    data = np.array([
+        [1, 3, NODATA, NODATA],
+        [5, 7, NODATA, 8],
+        [NODATA, NODATA, 2, 2],
+        [NODATA, NODATA, 2, 6],
+    ], dtype=np.float32)
+    assert pyramid.downsample(data, 2, NODATA).tolist() == [[4, 8], [NODATA, 3]]
+
+
+def test_partial_edge_blocks_average_the_cells_they_have(monkeypatch):
+    # Small bands, so the band boundaries are crossed too
+    monkeypatch.setattr(pyramid, 'BAND_ROWS', 2)
+    data = np.arange(7 * 5, dtype=np.float32).reshape(7, 5)
+    level = pyramid.downsample(data, 3, NODATA)
+    assert level.shape == (3, 2)
+    for r in range(3):
+        for c in range(2):
+            assert level[r, c] == pytest.approx(data[r * 3:r * 3 + 3, c * 3:c * 3 + 3].mean())
+
+
+def test_plain_heightmaps_have_no_nodata():
+    data = np.full((2, 2), NODATA, dtype=np.float32)
+    assert (pyramid.downsample(data, 2, None) == NODATA).all()
+    assert pyramid.downsample(data, 1, NODATA) is data
+
+
+def test_level_headers_keep_the_northern_edge():
+    header = asc_parse.AscHeader(ncols=7, nrows=5, xllcorner=100.0, yllcorner=200.0, cellsize=0.5)
+    level = pyramid.downsample_header(header, 2)
+    assert (level.ncols, level.nrows, level.cellsize) == (4, 3, 1.0)
+    # Same west and north edges, the extra half block hangs off the south and east
+    assert level.xllcorner == 100.0
+    assert level.yllcorner + level.nrows * level.cellsize == 200.0 + 5 * 0.5
+    assert level.yllcorner == 199.5
@@ -0,0 +1,184 @@
+import argparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import pytest
+import asc_parse
+import scheduler
+
+NAMES = ['download', 'grid']
+
+
+def test_parse_stage_workers():
+    assert scheduler.parse_stage_workers('download=16, grid=4', NAMES) == {'download': 16, 'grid': 4}
+
+
+@pytest.mark.parametrize('text', ['grdi=3', 'download=0', 'grid=-1', 'grid=x', 'grid'])
+def test_parse_stage_workers_rejects(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        scheduler.parse_stage_workers(text, NAMES)
+
+
+def test_check_stage_workers():
+    with pytest.raises(ValueError):
+        scheduler.check_stage_workers({'grid': 0}, NAMES)
+
+
+def test_run_pipeline_rejects_stages_without_workers():
+    stages = [scheduler.Stage('a', lambda x: x), scheduler.Stage('b', lambda x: x, workers=0)]
+    with pytest.raises(ValueError):
+        scheduler.run_pipeline([1, 2], stages)
+
+
+def test_run_pipeline_reports_failures():
+    def fail_on_two(x):
+        if x == 2:
+            raise RuntimeError('two')
+        return x
+    finished, failures = scheduler.run_pipeline([1, 2, 3], [scheduler.Stage('a', fail_on_two, workers=2), scheduler.Stage('b', lambda x: x * 10)])
+    assert sorted(finished) == [10, 30]
+    assert [(name, item) for name, item, _ in failures] == [('a', 2)]
+
+
+def test_stages_overlap():
+    # The first stage's second item only goes ahead once the second stage has had
+    # the first one, which never happens if a stage waits for the one before it to finish
+    second_started = threading.Event()
+    overlapped = []
+
+    def first(x):
+        if x == 1:
+            overlapped.append(second_started.wait(timeout=5))
+        return x
+
+    def second(x):
+        second_started.set()
+        return x
+
+    finished, failures = scheduler.run_pipeline([0, 1], [scheduler.Stage('a', first), scheduler.Stage('b', second)])
+    assert sorted(finished) == [0, 1] and failures == []
+    assert overlapped == [True]
+
+
+def test_queues_bound_the_tiles_in_flight():
+    release = threading.Event()
+    started = []
+
+    def fast(x):
+        started.append(x)
+        return x
+
+    def blocked(x):
+        release.wait(timeout=5)
+        return x
+
+    result = []
+    run = threading.Thread(target=lambda: result.append(scheduler.run_pipeline(range(10), [scheduler.Stage('a', fast), scheduler.Stage('b', blocked)], queue_size=1)))
+    run.start()
+    time.sleep(0.3)
+    # One item in b, one waiting in b's queue, and one done by a that it can't hand on yet
+    assert len(started) == 3
+    release.set()
+    run.join(timeout=10)
+    finished, failures = result[0]
+    assert sorted(finished) == list(range(10)) and failures == []
+
+
+class FakePool:
+    """
+    Stands in for the process pool and scheduler.wait: jobs only finish when the
+    scheduler waits, oldest first, so every decision it makes can be checked.
+    """
+    def __init__(self):
+        self.running = []
+        self.started = []
+        self.batches = []
+
+    def submit(self, func, item):
+        future = Future()
+        future.job = (func, item)
+        self.running.append(future)
+        self.started.append(item)
+        self.batches.append([f.job[1] for f in self.running])
+        return future
+
+    def wait(self, futures, return_when=None):
+        future = self.running.pop(0)
+        func, item = future.job
+        try:
+            future.set_result(func(item))
+        except Exception as e:
+            future.set_exception(e)
+        return {future}, set()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(scheduler, 'wait', pool.wait)
+    return pool
+
+
+def jobs(*costs):
+    return [(cost, str, cost) for cost in costs]
+
+
+def test_biggest_jobs_that_fit_go_first(pool):
+    finished, failures = scheduler.run_within_budget(jobs(2, 6, 3, 5, 4), 10, processes=4, executor=pool)
+    assert pool.started == [6, 4, 5, 3, 2]
+    assert max(sum(batch) for batch in pool.batches) <= 10
+    assert sorted(finished) == ['2', '3', '4', '5', '6'] and failures == []
+
+
+def test_jobs_bigger_than_the_budget_run_alone(pool):
+    scheduler.run_within_budget(jobs(15, 3, 2), 10, processes=4, executor=pool)
+    assert pool.started == [3, 2, 15]
+    assert pool.batches[-1] == [15]
+
+
+def test_no_more_jobs_than_processes(pool):
+    scheduler.run_within_budget(jobs(*[1] * 5), 100, processes=2, executor=pool)
+    assert max(len(batch) for batch in pool.batches) == 2
+
+
+def test_failed_jobs_are_reported(pool):
+    def mesh(cost):
+        if cost == 3:
+            raise RuntimeError('too rough')
+        return cost
+    finished, failures = scheduler.run_within_budget([(c, mesh, c) for c in (1, 3, 5)], 10, processes=2, executor=pool)
+    assert sorted(finished) == [1, 5]
+    assert [(func, item) for func, item, _ in failures] == [(mesh, 3)]
+
+
+def test_real_pools_run_every_job():
+    with ThreadPoolExecutor(2) as executor:
+        finished, failures = scheduler.run_within_budget(jobs(4, 8, 1, 7), 10, executor=executor)
+    assert sorted(finished) == ['1', '4', '7', '8'] and failures == []
+
+
+@pytest.fixture
+def cells(monkeypatch):
+    # Tiles of rows x cols cells need rows * cols bytes to mesh
+    monkeypatch.setattr(asc_parse.stlgenerator, 'estimate_memory', lambda rows, cols, *args: rows * cols)
+    return lambda *sizes: [(None, np.zeros((n, n))) for n in sizes]
+
+
+def test_small_tiles_are_meshed_side_by_side(cells):
+    tile_level, row_level = asc_parse.plan_meshing(cells(10, 10, 10, 100), 1000, processes=2)
+    assert tile_level == [(100, 0), (100, 1), (100, 2)]
+    assert row_level == [(10000, 3)]
+
+
+def test_tiles_too_big_to_share_have_their_rows_split(cells):
+    # Each fits in the budget, but not one for every process at once
+    tile_level, row_level = asc_parse.plan_meshing(cells(20, 20, 20), 1000, processes=3)
+    assert tile_level == []
+    assert [i for _, i in row_level] == [0, 1, 2]
+
+
+def test_too_few_small_tiles_to_keep_every_process_busy(cells):
+    tile_level, row_level = asc_parse.plan_meshing(cells(10, 100), 1000, processes=2)
+    assert tile_level == []
+    assert row_level == [(100, 0), (10000, 1)]
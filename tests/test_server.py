@@ -0,0 +1,91 @@
+import os
+import threading
+import numpy as np
+import pytest
+import asc_parse
+import benchmark
+import server
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    root = tmp_path_factory.mktemp('root')
+    (root / 'DTM').mkdir()
+    header = asc_parse.AscHeader(ncols=48, nrows=48, xllcorner=500000.0, yllcorner=4000000.0, cellsize=1.0)
+    asc_parse.write_dtm(str(root / 'DTM' / 'tile.dtm'), header, benchmark.synthetic_heightmap(48))
+    # No sidecar yet, so the first jobs to read it write one
+    asc_parse.write_asc(str(root / 'DTM' / 'shared.asc'), header, benchmark.synthetic_heightmap(48, seed=1), sidecar=False)
+
+    jobs = server.JobServer(str(root), processes=1)
+    httpd = server.serve(jobs, port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    client = server.Client(f'http://127.0.0.1:{httpd.server_address[1]}')
+    client.root = root
+    yield client
+    httpd.shutdown()
+    httpd.server_close()
+    jobs.close()
+
+
+def test_stl_jobs_hit_the_raster_cache_the_second_time(client):
+    spec = {'type': 'stl', 'raster': 'DTM/tile.dtm', 'options': {'vscale': 2}}
+    first = client.wait(client.submit(spec)['id'], timeout=60)
+    assert first['status'] == 'done'
+    misses = client.stats()['raster_cache']['misses']
+    second = client.wait(client.submit({**spec, 'options': {'vscale': 3, 'format': 'ply'}})['id'], timeout=60)
+    assert second['status'] == 'done'
+    cache = client.stats()['raster_cache']
+    assert cache['misses'] == misses
+    assert cache['hits'] >= 1
+
+
+def test_outputs_download(client, tmp_path):
+    job = client.wait(client.submit({'type': 'stl', 'raster': 'DTM/tile.dtm', 'name': 'downloaded'})['id'], timeout=60)
+    assert job['outputs'] == [f'jobs/{job["id"]}/STL/downloaded.stl']
+    file_name = client.download(job['id'], 0, str(tmp_path / 'model.stl'))
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    count = int.from_bytes(data[80:84], 'little')
+    assert count > 0 and len(data) == 84 + 50 * count
+    with pytest.raises(Exception):
+        client.download(job['id'], 1, str(tmp_path / 'missing.stl'))
+
+
+def test_concurrent_jobs_for_the_same_raster(client):
+    # Both jobs miss the raster cache at once and both cache the same raster's sidecar
+    specs = [{'type': 'stl', 'raster': 'DTM/shared.asc', 'name': f'shared{i}', 'work_dir': f'shared{i}'} for i in range(2)]
+    jobs = [client.submit(spec)['id'] for spec in specs]
+    for job_id in jobs:
+        assert client.wait(job_id, timeout=60)['status'] == 'done'
+    directory = client.root / 'DTM'
+    _, data = asc_parse.read_asc(str(directory / 'shared.asc'), use_cache=False)
+    assert np.array_equal(np.load(directory / 'shared.asc.npy'), data)
+    assert not [f for f in os.listdir(directory) if f.endswith('.tmp')]
+    models = [(client.root / f'shared{i}' / 'STL' / f'shared{i}.stl').read_bytes() for i in range(2)]
+    assert models[0][84:] == models[1][84:]
+
+
+@pytest.mark.parametrize('spec', [
+    # Paths out of the root
+    {'type': 'stl', 'raster': '../outside.dtm'},
+    {'type': 'stl', 'raster': 'DTM/tile.dtm', 'work_dir': '../escape'},
+    {'type': 'pipeline', 'config': {'trace': '../../../trace.jsonl'}},
+    # Settings and options that don't exist, or have the wrong type
+    {'type': 'stl', 'raster': 'DTM/tile.dtm', 'options': {'colour': 'red'}},
+    {'type': 'stl', 'raster': 'DTM/tile.dtm', 'options': {'lods': 'x'}},
+    {'type': 'stl', 'raster': 'DTM/tile.dtm', 'options': {'format': 'obj'}},
+    {'type': 'pipeline', 'config': {'reduce': 2}},
+    {'type': 'pipeline', 'config': {'reduce_by': 'two'}},
+    {'type': 'pipeline', 'config': {'stage_workers': {'download': 0}}},
+    {'type': 'something'},
+])
+def test_bad_jobs_are_turned_away(client, spec):
+    with pytest.raises(RuntimeError, match='^400'):
+        client.submit(spec)
+
+
+def test_stats_count_jobs(client):
+    stats = client.stats()
+    assert stats['processes'] == 1
+    assert stats['jobs']['queued'] + stats['jobs']['running'] == 0
+    assert stats['jobs']['done'] >= 1
@@ -0,0 +1,74 @@
+import numpy as np
+from stltools import facetarray, simplify, stlgenerator
+
+
+def heightmap(n=131, noise=0.0, seed=0):
+    y, x = np.mgrid[0:n, 0:n] / n
+    surface = np.sin(4 * x) * np.cos(3 * y) * 3 + 10
+    return surface + np.random.default_rng(seed).normal(0, noise, surface.shape)
+
+
+def open_edges(triangles):
+    # Every edge of a closed mesh is shared by exactly two triangles
+    edges = np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]))
+    keys = np.ascontiguousarray(edges, dtype=np.float32).view(np.dtype((np.void, 12)))[..., 0]
+    keys = np.sort(keys, axis=1)
+    _, counts = np.unique(np.ascontiguousarray(keys).view(np.dtype((np.void, 24))).ravel(), return_counts=True)
+    return int(np.count_nonzero(counts != 2))
+
+
+def surface_error(hm, triangles):
+    # Largest vertical distance at any grid vertex between the heightmap and the top surface
+    worst = 0.0
+    for tri in triangles[(triangles[:, :, 2] > 0).all(axis=1)].astype(np.float64):
+        x0, x1 = int(tri[:, 0].min()), int(np.ceil(tri[:, 0].max()))
+        y0, y1 = int(tri[:, 1].min()), int(np.ceil(tri[:, 1].max()))
+        py, px = np.mgrid[y0:y1 + 1, x0:x1 + 1]
+        l1, l2, l3 = simplify._barycentric(px, py, tri[0], tri[1], tri[2])
+        inside = (l1 >= -1e-9) & (l2 >= -1e-9) & (l3 >= -1e-9)
+        z = l1 * tri[0, 2] + l2 * tri[1, 2] + l3 * tri[2, 2]
+        worst = max(worst, float(np.abs(z - hm[py, px])[inside].max(initial=0)))
+    return worst
+
+
+def test_smooth_heightmap_is_simplified_within_the_error():
+    hm = heightmap()
+    plan = simplify.plan_mesh(hm, 0.05)
+    triangles = simplify.simplified_triangles(hm, 1.0, 0.05, plan)
+    assert len(triangles) == plan.triangle_count
+    assert len(triangles) < 2 * 130 * 130
+    assert open_edges(triangles) == 0
+    assert surface_error(hm, triangles) <= 0.05
+
+
+def test_odd_shapes_stay_watertight():
+    # Edges that aren't a whole number of blocks are filled in with smaller blocks and full cells
+    hm = heightmap(97)[:, :61]
+    triangles = simplify.simplified_triangles(hm, 1.0, 0.05)
+    assert open_edges(triangles) == 0
+    assert surface_error(hm, triangles) <= 0.05
+
+
+def test_chunks_match_the_plan():
+    hm = heightmap(200, noise=0.05)
+    plan = simplify.plan_mesh(hm, 0.05)
+    assert sum(len(t) for t in simplify.triangle_chunks(hm, 1.0, plan)) == plan.triangle_count
+
+
+def test_rough_heightmap_falls_back_to_full_resolution(tmp_path, capsys):
+    # Simplified meshes never have more than the STL writer's four facets a cell, but they
+    # can have more faces than an indexed grid mesh, and then the grid is written instead
+    hm = heightmap(64, noise=1.0)
+    simplified, full = tmp_path / 'simplified.ply', tmp_path / 'full.ply'
+    stlgenerator.generate_from_heightmap_array(hm, str(simplified), vsize=7500, max_error=0.001, multiprocessing=False, format='ply', anchorsize=0)
+    assert "wouldn't leave fewer" in capsys.readouterr().out
+    stlgenerator.generate_from_heightmap_array(hm, str(full), vsize=7500, multiprocessing=False, format='ply', anchorsize=0)
+    assert simplified.read_bytes() == full.read_bytes()
+
+
+def test_simplified_stl_is_streamed_with_the_planned_count(tmp_path):
+    destination = tmp_path / 'model.stl'
+    stlgenerator.generate_from_heightmap_array(heightmap(), str(destination), max_error=0.05, multiprocessing=False)
+    data = destination.read_bytes()
+    count = int.from_bytes(data[80:84], 'little')
+    assert len(data) == 84 + count * facetarray.STL_FACET.itemsize
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import benchmark
+import convert
+import scheduler
+from stltools import stlgenerator
+
+
+def test_shared_heightmaps_are_attached_once_and_evicted_oldest_first():
+    heightmaps = [benchmark.synthetic_heightmap(16, seed=i) for i in range(stlgenerator.ATTACHED_HEIGHTMAPS + 1)]
+    shared = [stlgenerator.SharedHeightmap(h) for h in heightmaps]
+    try:
+        names = [s.descriptor[0] for s in shared]
+        first = stlgenerator._attach(*shared[0].descriptor)
+        assert np.array_equal(first, heightmaps[0])
+        # Attaching again reuses the mapping instead of opening the shared memory again
+        assert stlgenerator._attach(*shared[0].descriptor) is first
+        del first
+        for s, h in zip(shared[1:], heightmaps[1:]):
+            assert np.array_equal(stlgenerator._attach(*s.descriptor), h)
+        assert list(stlgenerator._attached) == names[1:]
+    finally:
+        while stlgenerator._attached:
+            _, (shm, _) = stlgenerator._attached.popitem()
+            shm.close()
+        for s in shared:
+            s.__exit__(None, None, None)
+
+
+def test_one_pool_meshes_several_tiles(tmp_path):
+    heightmaps = [benchmark.synthetic_heightmap(40, seed=i) for i in range(2)]
+    # A small memory limit splits every model into many bands
+    options = dict(vsize=2, max_memory=64 * 1024, **benchmark.STL_OPTIONS)
+    with stlgenerator.StlWorkerPool(2) as pool:
+        workers = [p.pid for p in pool.pool._pool]
+        for i, h in enumerate(heightmaps):
+            stlgenerator.generate_from_heightmap_array(h, str(tmp_path / f'pooled{i}.stl'), pool=pool, **options)
+        # The same processes did every tile
+        assert [p.pid for p in pool.pool._pool] == workers
+    for i, h in enumerate(heightmaps):
+        stlgenerator.generate_from_heightmap_array(h, str(tmp_path / f'single{i}.stl'), multiprocessing=False, **options)
+        assert (tmp_path / f'pooled{i}.stl').read_bytes() == (tmp_path / f'single{i}.stl').read_bytes()
+
+
+def test_pipeline_closes_its_pool_when_a_stage_raises(tmp_path, monkeypatch):
+    pools = []
+
+    class Pool:
+        def __init__(self):
+            self.closed = False
+            pools.append(self)
+
+        def close(self):
+            self.closed = True
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(stlgenerator, 'StlWorkerPool', Pool)
+    monkeypatch.setattr(scheduler, 'run_pipeline', broken)
+    pipeline = convert.Pipeline(convert.Config(work_dir=str(tmp_path), trace='trace.jsonl'))
+    with pytest.raises(RuntimeError):
+        pipeline.run([])
+    assert len(pools) == 1 and pools[0].closed
@@ -0,0 +1,79 @@
+import time
+import numpy as np
+import pytest
+import asc_parse
+import las_grid
+import tile_index
+
+
+def surface(x, y):
+    # A different whole number in every cell, so a shifted row or column can't match
+    return (x * 100 + y).astype(np.float32)
+
+
+def write_tile(file_name, xll, yll, ncols, nrows, cellsize=1.0):
+    header = asc_parse.AscHeader(ncols=ncols, nrows=nrows, xllcorner=xll, yllcorner=yll, cellsize=cellsize)
+    # Cell centers, north row first
+    y, x = np.mgrid[nrows - 1:-1:-1, 0:ncols]
+    asc_parse.write_dtm(file_name, header, surface(xll + (x + 0.5) * cellsize, yll + (y + 0.5) * cellsize))
+    return file_name
+
+
+def test_parse_bbox():
+    assert tile_index.parse_bbox('1,2,3.5,4') == (1.0, 2.0, 3.5, 4.0)
+    for text in ('1,2,3', '3,2,1,4', '1,4,3,2', '1,2,x,4'):
+        with pytest.raises(ValueError):
+            tile_index.parse_bbox(text)
+
+
+def test_only_overlapping_tiles_are_picked(tmp_path):
+    tiles = [write_tile(str(tmp_path / f'{x}_{y}.dtm'), x, y, 10, 10) for x in (0, 10, 20, 30) for y in (0, 10, 20)]
+    index = tile_index.TileIndex.build(tiles, str(tmp_path / tile_index.INDEX_FILE))
+    assert index.query((12, 2, 18, 8)) == [str(tmp_path / '10_0.dtm')]
+    assert index.query((15, 5, 25, 15)) == [str(tmp_path / f'{x}_{y}.dtm') for x in (10, 20) for y in (0, 10)]
+    # Touching a tile's edge isn't overlapping it
+    assert index.query((10, 10, 20, 20)) == [str(tmp_path / '10_10.dtm')]
+    assert index.query((100, 100, 110, 110)) == []
+
+
+def test_index_is_reused_until_a_tile_changes(tmp_path, monkeypatch):
+    tile = write_tile(str(tmp_path / 'a.dtm'), 0, 0, 10, 10)
+    index_file = str(tmp_path / tile_index.INDEX_FILE)
+    tile_index.TileIndex.build([tile], index_file)
+    headers = []
+    original = asc_parse.raster_header
+    monkeypatch.setattr(tile_index.asc_parse, 'raster_header', lambda r: headers.append(r) or original(r))
+    assert tile_index.TileIndex.build([tile], index_file).bounds == {tile: (0, 0, 10, 10)}
+    assert headers == []
+    time.sleep(0.01)
+    write_tile(tile, 5, 0, 10, 10)
+    assert tile_index.TileIndex.build([tile], index_file).bounds == {tile: (5, 0, 15, 10)}
+    assert headers == [tile]
+
+
+def test_crop_across_a_seam_matches_cell_for_cell(tmp_path):
+    west = write_tile(str(tmp_path / 'west.dtm'), 100.0, 200.0, 10, 8, 0.5)
+    east = write_tile(str(tmp_path / 'east.dtm'), 105.0, 200.0, 10, 8, 0.5)
+    header, grid = tile_index.crop([west, east], (103.2, 201.1, 107.9, 203.0))
+    # Snapped out to whole cells
+    assert (header.xllcorner, header.yllcorner, header.ncols, header.nrows) == (103.0, 201.0, 10, 4)
+    y, x = np.mgrid[header.nrows - 1:-1:-1, 0:header.ncols]
+    expected = surface(103.0 + (x + 0.5) * 0.5, 201.0 + (y + 0.5) * 0.5)
+    assert np.array_equal(grid, expected)
+
+
+def test_tiles_off_the_grid_are_refused(tmp_path):
+    west = write_tile(str(tmp_path / 'west.dtm'), 100.0, 200.0, 10, 8, 0.5)
+    east = write_tile(str(tmp_path / 'east.dtm'), 105.2, 200.0, 10, 8, 0.5)
+    with pytest.raises(ValueError, match='off the grid'):
+        tile_index.crop([west, east], (103, 201, 108, 203))
+
+
+def test_gridded_tiles_share_one_grid():
+    # LAS tiles whose points start part way into a cell still get grids on whole cells
+    west = las_grid.grid_header_for_bounds(100.3, 200.7, 104.9, 203.2, 0.5)
+    east = las_grid.grid_header_for_bounds(105.1, 200.2, 109.6, 203.9, 0.5)
+    assert (west.xllcorner, west.yllcorner) == (100.0, 200.5)
+    assert (east.xllcorner, east.yllcorner) == (105.0, 200.0)
+    # And the last points still land inside them
+    assert west.xllcorner + west.ncols * 0.5 > 104.9 and west.yllcorner + west.nrows * 0.5 > 203.2
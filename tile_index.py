@@ -0,0 +1,136 @@
+"""
+A spatial index of raster tiles, built from their headers alone, for
+cropping a bounding box out of a big dataset.  Only the tiles that overlap
+the box are opened, only the windows of them inside it are read (memory
+mapped), and those are stitched into one DEM, so the cost goes with the
+size of the crop rather than the size of the dataset.
+"""
+
+import json
+import math
+import os
+import numpy as np
+import asc_parse
+from asc_parse import AscHeader, NO_DATA
+
+# Tile bounds are cached next to the rasters, like the elevation stats
+INDEX_FILE = 'tile_index.json'
+
+
+def parse_bbox(text: str):
+    # "min_x,min_y,max_x,max_y" -> (min_x, min_y, max_x, max_y)
+    values = [float(x) for x in text.split(',')]
+    if len(values) != 4 or values[0] >= values[2] or values[1] >= values[3]:
+        raise ValueError(f'A bounding box is min_x,min_y,max_x,max_y, got {text}')
+    return tuple(values)
+
+
+def bbox_name(bbox):
+    return 'crop_' + '_'.join(f'{v:g}' for v in bbox)
+
+
+def raster_bounds(header: AscHeader):
+    return (header.xllcorner, header.yllcorner,
+            header.xllcorner + header.ncols * header.cellsize, header.yllcorner + header.nrows * header.cellsize)
+
+
+def overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class TileIndex:
+    """
+    Tile bounds bucketed on a grid about one tile across, so a query only
+    looks at the tiles in the buckets it covers instead of every tile.
+    """
+    def __init__(self, bounds: dict):
+        # bounds maps file name -> (min_x, min_y, max_x, max_y)
+        self.bounds = bounds
+        self.order = {f: i for i, f in enumerate(bounds)}
+        self.bucket_size = max((max(b[2] - b[0], b[3] - b[1]) for b in bounds.values()), default=1.0)
+        self.buckets = {}
+        for f, b in bounds.items():
+            for key in self.bucket_keys(b):
+                self.buckets.setdefault(key, []).append(f)
+
+    def bucket_range(self, bbox):
+        size = self.bucket_size
+        return (range(math.floor(bbox[0] / size), math.floor(bbox[2] / size) + 1),
+                range(math.floor(bbox[1] / size), math.floor(bbox[3] / size) + 1))
+
+    def bucket_keys(self, bbox):
+        xs, ys = self.bucket_range(bbox)
+        return [(i, j) for i in xs for j in ys]
+
+    @classmethod
+    def build(cls, list_of_rasters: list, index_file: str = None):
+        """
+        Index raster files by the bounds in their headers.  Bounds are saved
+        to index_file, and only tiles that changed since are read again.
+        """
+        if index_file is None:
+            index_file = os.path.join(os.path.dirname(list_of_rasters[0]) if list_of_rasters else '', INDEX_FILE)
+        cached = {}
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                cached = json.load(f)
+
+        entries = {}
+        for r in list_of_rasters:
+            entry = cached.get(r)
+            if entry is None or entry['mtime'] != os.path.getmtime(r):
+                entry = {'mtime': os.path.getmtime(r), 'bounds': raster_bounds(asc_parse.raster_header(r))}
+            entries[r] = entry
+
+        with open(index_file, 'w') as f:
+            json.dump(entries, f, indent=1)
+        return cls({r: tuple(e['bounds']) for r, e in entries.items()})
+
+    def query(self, bbox):
+        # The tiles that overlap bbox, in the order they were indexed
+        xs, ys = self.bucket_range(bbox)
+        if len(xs) * len(ys) > len(self.bounds):
+            candidates = self.bounds
+        else:
+            candidates = {f for key in self.bucket_keys(bbox) for f in self.buckets.get(key, ())}
+        return sorted((f for f in candidates if overlaps(self.bounds[f], bbox)), key=self.order.get)
+
+
+def crop(list_of_rasters: list, bbox):
+    """
+    Stitch the parts of list_of_rasters inside bbox into one (header, grid).
+    The crop is snapped out to the cells of the first tile, and every tile
+    must share its grid: the same cell size, with corners on its cell edges.
+    Where tiles overlap, the first one with data wins.
+    """
+    first = asc_parse.raster_header(list_of_rasters[0])
+    size = first.cellsize
+    min_x = first.xllcorner + math.floor((bbox[0] - first.xllcorner) / size) * size
+    min_y = first.yllcorner + math.floor((bbox[1] - first.yllcorner) / size) * size
+    ncols = math.ceil((bbox[2] - min_x) / size - 1e-9)
+    nrows = math.ceil((bbox[3] - min_y) / size - 1e-9)
+    header = AscHeader(ncols=ncols, nrows=nrows, xllcorner=min_x, yllcorner=min_y, cellsize=size)
+    top = min_y + nrows * size
+    grid = np.full((nrows, ncols), NO_DATA, dtype=np.float32)
+
+    for r in list_of_rasters:
+        tile = asc_parse.raster_header(r)
+        if not np.isclose(tile.cellsize, size):
+            raise ValueError(f'{r} has {tile.cellsize} cells, but {list_of_rasters[0]} has {size}')
+        # Where the tile's first row and column land in the crop
+        row = (top - (tile.yllcorner + tile.nrows * size)) / size
+        col = (tile.xllcorner - min_x) / size
+        if not (np.isclose(row, round(row), atol=1e-6) and np.isclose(col, round(col), atol=1e-6)):
+            # Rounding it onto the grid would shift it by part of a cell and leave a seam
+            raise ValueError(f'{r} starts at ({tile.xllcorner}, {tile.yllcorner}), which is off the grid of {list_of_rasters[0]}')
+        row, col = round(row), round(col)
+        rows = slice(max(0, row), min(nrows, row + tile.nrows))
+        cols = slice(max(0, col), min(ncols, col + tile.ncols))
+        if rows.start >= rows.stop or cols.start >= cols.stop:
+            continue
+        print(f'Cropping {r}')
+        window = asc_parse.read_window(r, slice(rows.start - row, rows.stop - row), slice(cols.start - col, cols.stop - col))
+        target = grid[rows, cols]
+        empty = target == NO_DATA
+        target[empty] = window[empty]
+    return header, grid